@@ -1,6 +1,5 @@
 import os as _os
 import numpy as _np
-import pandas as _pd
 from GipsyX_Wrapper.gxlib import (gx_aux, gx_compute, gx_convert, gx_eterna, gx_extract,
                    gx_filter, gx_ionex, gx_merge, gx_tdps, gx_trees)
 
@@ -60,7 +59,7 @@ class gd2e_class:
         self.tropNom_type = tropNom_type
         self.tree_options = tree_options
         # self.selected_rnx = gx_convert.select_rnx(tmp_dir=self.tmp_dir,rnx_dir=self.rnx_dir,stations_list=self.stations_list,years_list=self.years_list,cddis=self.cddis)
-        self.staDb_path= gx_aux.gen_staDb(self.tmp_dir,self.project_name,self.stations_list,self.IGS_logs_dir) if staDb_path is None else staDb_path
+        self.staDb_path= gx_aux.gen_staDb(self.tmp_dir,self.project_name,self.stations_list,self.IGS_logs_dir,num_cores=self.num_cores) if staDb_path is None else staDb_path
         self.gnss_products_dir = _os.path.abspath(gnss_products_dir)
         self.ionex_type=ionex_type
         self.IONEX_products = _os.path.abspath(IONEX_products)
@@ -166,27 +165,52 @@ class gd2e_class:
         return gx_filter.filter_tdps(sigma_cut=sigma_cut,tdps=self.solutions(single_station=single_station))
 
     
+    def _filtered_solutions_stream(self,stations_list,sigma_cut):
+        '''Yields filtered solutions station by station so ENV conversion holds only one chunk of solutions in memory'''
+        for station in stations_list:
+            solutions = gx_extract.gather_solutions(num_cores=self.num_cores,project_name=self.project_name,stations_list=[station],
+                                                    tmp_dir=self.tmp_dir,tqdm=self.tqdm)[0]
+            yield gx_filter.filter_tdps(sigma_cut=sigma_cut,tdps=solutions)
+
+    def _env_gather_path(self):
+        env_gather_path = _os.path.join(self.tmp_dir,'gd2e/env_gathers',self.project_name_core) #saning to core where all mGNSS env_gathers are located
+        if not _os.path.exists(env_gather_path): _os.makedirs(env_gather_path)
+        return env_gather_path
+
+    def _env_path(self,station):
+        return _os.path.join(self._env_gather_path(),'{}{}.zstd'.format(station.lower(),gx_aux.mode2label(self.mode))) #naming convention as site_gps.zstd 
+
+    def env_paths(self,sigma_cut=0.05,stations_list=None):
+        '''Paths of env gathers dumps. Missing gathers are computed and dumped station by station so only one is held in memory'''
+        stations_list = self.stations_list if stations_list is None else stations_list
+        for station in stations_list:
+            if not _os.path.exists(self._env_path(station)): self.envs(sigma_cut=sigma_cut,dump=True,stations_list=[station])
+        return [self._env_path(station) for station in stations_list]
+
     def envs(self,sigma_cut=0.05,dump=False,force=False,stations_list=None):
-        '''checks is dump files exist. if not -> gathers filtered solutions and sends to _xyz2env (with dump option True or False)
+        '''checks is dump files exist. if not -> streams filtered solutions of the missing stations to _xyz2env (with dump option True or False)
         stations_list var can be used to specified block-like load which is useful for big datasets analysis'''
         dump = False if dump is None else dump
         stations_list = self.stations_list if stations_list is None else stations_list
-        env_gather_path = _os.path.join(self.tmp_dir,'gd2e/env_gathers',self.project_name_core) #saning to core where all mGNSS env_gathers are located
-        if not _os.path.exists(env_gather_path): _os.makedirs(env_gather_path)
+        env_gather_path = self._env_gather_path()
         envs = _np.ndarray((len(stations_list)),dtype=object)
-        incomplete=False
+        missing = []
         for i in range(envs.shape[0]):
-            env_path = _os.path.join(env_gather_path,'{}{}.zstd'.format(stations_list[i].lower(),gx_aux.mode2label(self.mode))) #naming convention as site_gps.zstd 
+            env_path = self._env_path(stations_list[i])
             if force:
                 if _os.path.exists(env_path): _os.remove(env_path)
             if _os.path.exists(env_path):
                 envs[i] = gx_aux._dump_read(env_path)
             else: 
-                incomplete=True
-                break
-        if incomplete:
-            envs = gx_aux._xyz2env(dataset=self.filtered_solutions(sigma_cut=sigma_cut), #filtered_solutions takes most of the time
+                missing.append(i)
+        if len(missing) > 0:
+            no_output = _np.setdiff1d(_np.core.defchararray.upper([stations_list[i] for i in missing]),
+                                      gx_aux._check_stations(stations_list=[stations_list[i] for i in missing],tmp_dir=self.tmp_dir,project_name=self.project_name))
+            if no_output.shape[0] > 0: #checked before streaming so no partial set of gathers is dumped
+                raise ValueError('No gd2e output in {} for station(s): {}'.format(self.project_name,', '.join(no_output)))
+            missing_envs = gx_aux._xyz2env(dataset=self._filtered_solutions_stream([stations_list[i] for i in missing],sigma_cut=sigma_cut), #filtered_solutions takes most of the time
                         reference_df=self.refence_xyz_df,mode=self.mode,dump = env_gather_path if dump else None)
+            for i,env in zip(missing,missing_envs): envs[i] = env
         return envs
     def gen_tdps_penna(self,period=13.9585147,A_East=2, A_North=4, A_Vertical=6):
         gx_tdps.gen_penna_tdp(tmp_path=self.tmp_dir,
@@ -208,38 +232,26 @@ class gd2e_class:
     def get_chalmers(self):
         return gx_aux.get_chalmers(self.staDb_path)
 
-    def analyze_env(self,envs=None,mode=None,remove_outliers=True,restore_otl=True,sampling=1800,force=False,otl_env=False,begin=None,end=None,return_sets=False):
-        '''should accept stations_list and break it into chunks. Not envs which take long to read and occupy lots of RAM'''
+    def analyze_env(self,envs=None,mode=None,remove_outliers=True,restore_otl=True,sampling=1800,force=False,otl_env=False,begin=None,end=None,return_sets=False,engine='eterna',window=None,step=None,otl_backend='hardisp'):
+        '''Stations are streamed through the pool. If envs is None, workers load env gathers dumps of their stations (see env_paths),
+        so memory is bounded by num_cores and not by the number of stations.
+        window and step (days) give sliding window analysis (station x window x constituent table).
+        otl_backend of synthetic OTL is hardisp or native (in-process, uses eterna_path catalogue)'''
         if begin is None: 
             begin, end = gx_aux.check_date_margins(begin=begin, end=end, years_list=self.years_list)
         mode = self.mode if mode is None else mode
+        envs = self.env_paths() if envs is None else envs
 
-        if envs is None:
-            stations_sublists = gx_aux.split10(array=self.stations_list,split_arrays_size=self.num_cores)
-            
-            # envs = self.envs() if envs is None else envs #can break the envs into blocks of up to ten stations
-            buf=[]
-            for stations_sublist in stations_sublists:
-                print('Chunking the stations_list. Processing',stations_sublist)
-                #for each sublist run analyze_env. concat the output afterwards
-                envs = self.envs(stations_list = stations_sublist)
-                buf.append(
-                    gx_eterna.analyze_env(  envs,
-                                            self.stations_list,self.eterna_path,self.tmp_dir,self.staDb_path,self.project_name,
-                                            remove_outliers,restore_otl=restore_otl,blq_file = self.blq_file,sampling = sampling,hardisp_path = self.hardisp_path,
-                                            force=force,num_cores = self.num_cores,mode=mode,otl_env=otl_env,begin = begin,end = end,return_sets = return_sets))
-            return _pd.concat(buf,axis=0) #concatanating partial dataframes
+        return gx_eterna.analyze_env(  envs,
+                                        self.stations_list,self.eterna_path,self.tmp_dir,self.staDb_path,self.project_name,
+                                        remove_outliers,restore_otl=restore_otl,blq_file = self.blq_file,sampling = sampling,hardisp_path = self.hardisp_path,
+                                        force=force,num_cores = self.num_cores,mode=mode,otl_env=otl_env,begin = begin,end = end,return_sets = return_sets,engine=engine,window=window,step=step,
+                                        otl_backend=otl_backend)
 
-        else:return gx_eterna.analyze_env(  envs,
-                                            self.stations_list,self.eterna_path,self.tmp_dir,self.staDb_path,self.project_name,
-                                            remove_outliers,restore_otl=restore_otl,blq_file = self.blq_file,sampling = sampling,hardisp_path = self.hardisp_path,
-                                            force=force,num_cores = self.num_cores,mode=mode,otl_env=otl_env,begin = begin,end = end,return_sets = return_sets)
-        
 
 
-    def analyze_wetz(self,wetz_gather=None,parameter='WetZ',begin=None,end=None,sampling=1800,force=False,return_sets=False,otl_env=False,v_type='value'):
-        '''v_type can be value, nomvalue and sigma. Be careful as it does not create separate dirs but overwrites each v_type. 
-        Need to use force option to get the values'''
+    def analyze_wetz(self,wetz_gather=None,parameter='WetZ',begin=None,end=None,sampling=1800,force=False,return_sets=False,otl_env=False,v_type='value',engine='eterna'):
+        '''v_type can be value, nomvalue and sigma. ETERNA runs are cached by input content so each v_type gets its own results without force'''
         if begin is None: 
             begin, end = gx_aux.check_date_margins(begin=begin, end=end, years_list=self.years_list)
         if wetz_gather is None: #wetz_gather may be fascilitated by mGNSS class so different cionstellation solutions will be in sync
@@ -270,7 +282,8 @@ class gd2e_class:
                                     end = end,
                                     return_sets = return_sets,
                                     v_type=v_type,
-                                    parameter=parameter)
+                                    parameter=parameter,
+                                    engine=engine)
     def wetz(self):
         '''Returns WetZ values dataframe'''
         return gx_aux.wetz(self.filtered_solutions())
@@ -13,17 +13,19 @@ import numpy as _np
 import pandas as _pd
 import pyarrow as _pa
 import tqdm as _tqdm
-from shutil import move as _move
+from shutil import move as _move, rmtree as _rmtree
+from contextlib import contextmanager as _contextmanager
 
-PYGCOREPATH = "{}/lib/python{}.{}".format(_os.environ['GCOREBUILD'],\
-              _sys.version_info[0], _sys.version_info[1])
-if PYGCOREPATH not in _sys.path:
-    _sys.path.insert(0, PYGCOREPATH)
-    
-import gcore.EarthCoordTrans as _eo
-import gcore.StationDataBase as StationDataBase
+if 'GCOREBUILD' in _os.environ: #gcore is not needed by gx_aux itself (see gx_geodesy) but other modules expect the path set
+    PYGCOREPATH = "{}/lib/python{}.{}".format(_os.environ['GCOREBUILD'],\
+                  _sys.version_info[0], _sys.version_info[1])
+    if PYGCOREPATH not in _sys.path:
+        _sys.path.insert(0, PYGCOREPATH)
 
+from .gx_compress import decompress_file as _decompress_file
 from .gx_const import J2000origin
+from .gx_geodesy import rot_xyz2env as _rot_xyz2env, staDb_llh as _staDb_llh
+from .gx_stadb import staDb_crc as _staDb_crc, staDb_ref_xyz as _staDb_ref_xyz
 from .gx_hardisp import blq2hardisp as _blq2hardisp
 
 if _pa.__version__ !='0.13.0':
@@ -62,13 +64,40 @@ def prepare_dir_struct_gathers(tmp_dir,project_name):
 
 # service functions for uncompressing
 def uncompress(file_path):
-    process = _Popen(['uncompress',file_path])
-    process.wait()
+    '''Decompresses .Z or .gz file in-process replacing it with decompressed version as uncompress does'''
+    return _decompress_file(file_path,remove_src=True)
     
 def uncompress_mp(filelist,num_cores=10):
     with _Pool(processes=num_cores) as p:
         p.map(uncompress,filelist)
 
+_scratch_dirs = {} #worker-private scratch dirs created by the current process, base_dir: scratch_dir
+
+def worker_scratch(base_dir):
+    '''Returns scratch directory private to the current worker process, e.g. base_dir/12345/. Created once per worker and reused for all tasks.
+    base_dir should be specific to the run (e.g. /cache/rnx2dr or /run_dir/tmp_igs2jpl/esa) so different runs never share scratch dirs'''
+    base_dir = _os.path.abspath(base_dir)
+    scratch_dir = _os.path.join(base_dir,str(_os.getpid()))
+    if (_scratch_dirs.get(base_dir) != scratch_dir) or (not _os.path.exists(scratch_dir)): #pid changes in forked workers
+        if not _os.path.exists(scratch_dir): _os.makedirs(scratch_dir)
+        _scratch_dirs[base_dir] = scratch_dir
+    return scratch_dir
+
+def clean_scratch(scratch_dir):
+    '''Removes scratch directory contents, the directory itself is kept for the next task of the worker'''
+    for entry in _os.listdir(scratch_dir):
+        entry_path = _os.path.join(scratch_dir,entry)
+        if _os.path.isdir(entry_path) and not _os.path.islink(entry_path): _rmtree(entry_path)
+        else: _os.remove(entry_path)
+
+@_contextmanager
+def working_dir(path):
+    '''Runs the block with path as cwd and restores the previous cwd afterwards (even on exceptions)'''
+    prev_dir = _os.getcwd()
+    _os.chdir(path)
+    try: yield path
+    finally: _os.chdir(prev_dir)
+
 def _update_mindex(dataframe, lvl_name,loc=0,axis=1):
     '''Inserts a level named as lvl_name into dataframe_in in loc position. 
     Level can be inserted either in columns (default axis=1) or index (axis=0)'''
@@ -134,8 +163,84 @@ def _project_name_construct(project_name,PPPtype,pos_s,wetz_s,tropNom_input,ElMi
         project_name += '_nootl'
     return project_name
 
-def gen_staDb(tmp_dir,project_name,stations_list,IGS_logs_dir):
-    '''Creates a staDb file from IGS logs'''
+_logs_cache_lbl = 'logs_cache.zstd'
+
+def _station_logs(IGS_logs_dir,stations_list):
+    '''Paths to the last log (sorted as before) of each station. Logs dir is globbed once for all stations'''
+    all_logs = _pd.Series(sorted(_glob.glob(IGS_logs_dir + '/*/*.log')))
+    names = all_logs.apply(_os.path.basename)
+    logs = _np.ndarray((len(stations_list)),dtype=object)
+    for i in range(len(stations_list)):
+        station_logs = all_logs[names.str.startswith(stations_list[i].lower()).values]
+        if station_logs.shape[0] == 0: raise ValueError('No IGS log found for {} in {}'.format(stations_list[i],IGS_logs_dir))
+        logs[i] = station_logs.iloc[-1] #should be the last log created in case multiple exist
+    return logs
+
+def _parse_log(file):
+    '''Parses a single IGS log into staDb ID, STATE, RX and ANT records of the station. Returns records as text block'''
+    with open(file, 'r') as f:
+        data = f.read()
+    buf = ''
+# Site ID
+    matches_ID = _re.findall(_regex_ID, data)
+# Site Location, only one location line per BIGF log
+    matches_loc = _re.findall(_regex_loc, data)
+    buf += ("{ID}  ID  {IERS} {loc_2} {loc_1}\n".format(ID=matches_ID[0][1], IERS=matches_ID[0][3] if matches_ID[0][3] != '' else 'UNKNOWN',
+                                                    loc_2=matches_loc[0][1], loc_1=matches_loc[0][2]))
+
+    buf += ("{ID}  STATE 1-01-01 00:00:00 {X:.15e}  {Y:.15e} {Z:.15e} {X_v:.15e}  {Y_v:.15e} {Z_v:.15e}\n".format(ID=matches_ID[0][1],
+                                                                                                            X=float(matches_loc[0][4]) if matches_loc[0][4] != '' else 0,
+                                                                                                            Y=float(matches_loc[0][5]) if matches_loc[0][5] != '' else 0,
+                                                                                                            Z=float(matches_loc[0][6]) if matches_loc[0][6] != '' else 0,
+                                                                                                            X_v=0, Y_v=0, Z_v=0))
+# Receiver Information
+    for rec in _re.finditer(_regex_rec, data):
+        rec = rec.groups()
+        buf += ("{ID}  RX {d_inst} {t_inst}:00 {rec_type} # {rec_num} {rec_fw_v}\n".format(ID=matches_ID[0][1], d_inst=rec[5], t_inst=rec[6] if rec[6] != '' else '00:00',
+                                                                                        rec_type=rec[0], rec_num=rec[2], rec_fw_v=rec[3]))
+# Antenna Information
+    for ant in _re.finditer(_regex_ant, data):
+        ant = ant.groups()
+        # Each field is whitespace delimited:
+        # Field 0:         Station identifier (arbitrary string length)
+        # Field 1:         Record key, must be 'ANT'
+        # Field 2:         Date of epoch in calendar format YYYY-MM-DD (year, month, day as integers) 
+        # Field 3:         Time of epoch in HH:MM:SS format (hours, minutes, seconds as integers)
+        # Field 4:         Antenna type
+        # Field 5:         Radome type
+        # Field 6,7,8:     Site vector in meters (east, north, vertical)
+        # Field 9:         Comments starting with '#' 
+
+        buf += ("{ID}  ANT {d_inst} {t_inst}:00 {ant_type} {radome_type} {east} {north} {vertical} # {ant_num}\n".
+            format(ID=matches_ID[0][1], d_inst=ant[12], t_inst=ant[13] if ant[13]!= '' else '00:00', ant_type=ant[0],
+                    radome_type=ant[8] if ant[8]!= '' else 'NONE', vertical=ant[4], north=ant[5], east=ant[6], ant_num=ant[2]))
+    return buf
+
+def _parsed_logs(logs,cache_path,num_cores):
+    '''Returns staDb text blocks for logs. Blocks are cached in cache_path by log path, mtime and size so only new or changed logs are parsed.
+    Changed logs are parsed in parallel'''
+    unique_logs = _pd.unique(logs)
+    stat = [_os.stat(log) for log in unique_logs]
+    current = _pd.DataFrame({'mtime':[s.st_mtime_ns for s in stat],'size':[s.st_size for s in stat]},index=_pd.Index(unique_logs,name='path'))
+    cache = _dump_read(cache_path) if _os.path.exists(cache_path) else _pd.DataFrame(columns=['mtime','size','block'],index=_pd.Index([],name='path'))
+
+    cached = current.join(cache[['mtime','size']],rsuffix='_cached',how='left')
+    outdated = current.index[~((cached['mtime'] == cached['mtime_cached'])&(cached['size'] == cached['size_cached'])).values]
+    if outdated.shape[0] > 0:
+        print('Parsing {} new or changed IGS logs'.format(outdated.shape[0]))
+        num_cores = min(int(num_cores),outdated.shape[0])
+        with _Pool(processes = num_cores) as p:
+            blocks = p.map(_parse_log, outdated.tolist())
+        parsed = current.loc[outdated].copy()
+        parsed['block'] = blocks
+        cache = _pd.concat([cache[~cache.index.isin(outdated)],parsed])
+        tmp_path = '{}.{}.tmp'.format(cache_path,_os.getpid())
+        _dump_write(tmp_path,cache,num_cores=num_cores)
+        _os.replace(tmp_path,cache_path)
+    return cache.loc[logs,'block'].tolist()
+
+def gen_staDb(tmp_dir,project_name,stations_list,IGS_logs_dir,num_cores=8):
+    '''Creates a staDb file from IGS logs. Parsed logs are cached in tmp_dir/staDb/ and shared by all projects'''
     #Making staDb directory in tmp folder 
     staDb_dir = tmp_dir + '/staDb/' + project_name + '/'
     staDb_path = staDb_dir + project_name + '.staDb'
@@ -146,63 +251,14 @@ def gen_staDb(tmp_dir,project_name,stations_list,IGS_logs_dir):
     if not _os.path.exists(staDb_dir):
         _os.makedirs(staDb_dir)
     #getting paths to all log files needed    
-    logs = _np.ndarray((len(stations_list)),dtype=object)
-    
-    for i in range(len(stations_list)):
-        logs[i] = sorted(_glob.glob(IGS_logs_dir + '/*/' + stations_list[i].lower() +'*'+'.log'))[-1] #should be the last log created in case multiple exist
+    logs = _station_logs(IGS_logs_dir,stations_list)
+    blocks = _parsed_logs(logs,cache_path=_os.path.join(tmp_dir,'staDb',_logs_cache_lbl),num_cores=num_cores)
 
-    
     buf = ("KEYWORDS: ID STATE ANT RX\n")  # POSTSEISMIC, LINK, END
-    for file in logs:
-        with open(file, 'r') as f:
-            data = f.read()
-    # Site ID
-        matches_ID = _re.findall(_regex_ID, data)
-    # Site Location, only one location line per BIGF log
-        matches_loc = _re.findall(_regex_loc, data)
-        buf += ("{ID}  ID  {IERS} {loc_2} {loc_1}\n".format(ID=matches_ID[0][1], IERS=matches_ID[0][3] if matches_ID[0][3] != '' else 'UNKNOWN',
-                                                        loc_2=matches_loc[0][1], loc_1=matches_loc[0][2]))
-
-        buf += ("{ID}  STATE 1-01-01 00:00:00 {X:.15e}  {Y:.15e} {Z:.15e} {X_v:.15e}  {Y_v:.15e} {Z_v:.15e}\n".format(ID=matches_ID[0][1],
-                                                                                                                X=float(matches_loc[0][4]) if matches_loc[0][4] != '' else 0,
-                                                                                                                Y=float(matches_loc[0][5]) if matches_loc[0][5] != '' else 0,
-                                                                                                                Z=float(matches_loc[0][6]) if matches_loc[0][6] != '' else 0,
-                                                                                                                X_v=0, Y_v=0, Z_v=0))
-    # Receiver Information
-        rec = []
-        matches_rec = _re.finditer(_regex_rec, data)
-        for matchNum, match in enumerate(matches_rec):
-            for groupNum in range(0, len(match.groups())):
-                groupNum = groupNum + 1
-            rec.append(match.groups())
-            buf += ("{ID}  RX {d_inst} {t_inst}:00 {rec_type} # {rec_num} {rec_fw_v}\n".format(ID=matches_ID[0][1], d_inst=rec[matchNum][5], t_inst=rec[
-                matchNum][6] if rec[matchNum][6] != '' else '00:00', rec_type=rec[matchNum][0], rec_num=rec[matchNum][2], rec_fw_v=rec[matchNum][3]))
-    # Antenna Information
-        ant = []
-        matches_ant = _re.finditer(_regex_ant, data)
-        for matchNum, match in enumerate(matches_ant):
-            for groupNum in range(0, len(match.groups())):
-                groupNum = groupNum + 1
-            ant.append(match.groups())
-
-            # Each field is whitespace delimited:
-            # Field 0:         Station identifier (arbitrary string length)
-            # Field 1:         Record key, must be 'ANT'
-            # Field 2:         Date of epoch in calendar format YYYY-MM-DD (year, month, day as integers) 
-            # Field 3:         Time of epoch in HH:MM:SS format (hours, minutes, seconds as integers)
-            # Field 4:         Antenna type
-            # Field 5:         Radome type
-            # Field 6,7,8:     Site vector in meters (east, north, vertical)
-            # Field 9:         Comments starting with '#' 
-
-            buf += ("{ID}  ANT {d_inst} {t_inst}:00 {ant_type} {radome_type} {east} {north} {vertical} # {ant_num}\n".
-                format(ID=matches_ID[0][1], d_inst=ant[matchNum][12], t_inst=ant[matchNum][13] if ant[matchNum][13]!= '' else '00:00', ant_type=ant[matchNum][0],
-                        radome_type=ant[matchNum][8] if ant[matchNum][8]!= '' else 'NONE', vertical=ant[matchNum][4], north=ant[matchNum][5], east=ant[matchNum][6], ant_num=ant[matchNum][2]))
-
+    buf += ''.join(blocks)
     #we read the existing staDb, do the crc, compare, overwrite if different
     if _os.path.exists(staDb_path):
-        with open(staDb_path,'rb') as ex_staDb:
-            crc_ex = _binascii.crc32(ex_staDb.read())& 0xffffffff
+        crc_ex = _staDb_crc(staDb_path)
         crc = _binascii.crc32(buf.encode('ascii'))& 0xffffffff
         if crc_ex!=crc:
             print('Overwriting existing staDb file')
@@ -222,14 +278,9 @@ def get_chalmers(staDb_path,as_df=False):
     // Records starting with // are treated as comments
     
     OR returns a dataframe if as_df (needed for plotting)'''
-    staDb = StationDataBase.StationDataBase(dataBase=staDb_path)  # creating staDb object + read as after GipsyX 1.3
-
-    
     max_t = 3.0e8  # maximum time value for the dataset on which available sites will be added to OTL computation with SPOTL
-    names_stdb = _np.asarray(staDb.getStationList(), dtype=object)
-    llh_stdb = _np.asarray(staDb.dumpLatLonHeights(epoch=max_t,
-                                                    stationList=staDb.getStationList()))
-    nllh = _np.column_stack((names_stdb, llh_stdb.T))
+    llh_stdb = _staDb_llh(staDb_path,epoch=max_t)
+    nllh = _np.column_stack((llh_stdb.index.values.astype(object), llh_stdb.values))
     nllh =  nllh[nllh[:,0].argsort()]
     if as_df:
         return _pd.DataFrame(nllh,columns=['SITE','LAT','LON','HEIGHT'])
@@ -316,28 +367,59 @@ def get_drInfo(tmp_dir,num_cores,tqdm,selected_rnx):
                             drinfo_df = _pd.concat(p.map(_drInfo2df, dr_good_station_year),axis=0,ignore_index=True)
                     drinfo_df['station_name'] = drinfo_df['station_name'].astype('category')
                     drinfo_df['length'] = (drinfo_df['end'] - drinfo_df['begin']).astype('timedelta64[h]').astype(int)
-                    #Saving extracted data for furthe processing
-                    _dump_write(data = drinfo_df,filename=filename,cname='zstd',num_cores=num_cores)
-                #gather should be separate, otherwise conflict and corrupted files
+                    #Saving extracted data for furthe processing. Partition is written to tmp and renamed so concurrent nodes never see partial files
+                    tmp_filename = '{}.{}.tmp'.format(filename,_os.getpid())
+                    _dump_write(data = drinfo_df,filename=tmp_filename,cname='zstd',num_cores=num_cores)
+                    _os.replace(tmp_filename,filename)
                 else:
                     print('{} good files found for {}{} out of {}. Skipping.'.format(dr_good_station_year.shape[0],station,year,dr_station_year.shape[0]))
             else: print('{} exists'.format(filename))
 
+def drInfo_partitions(tmp_dir,stations_list=None,years_list=None):
+    '''drInfo is an append-only partitioned table: one {drinfo_dir}/{yyyy}/{station}{yy}.zstd file per station-year written by get_drInfo.
+    Returns a dataframe of partitions (station, year, path, mtime, size) optionally limited to stations_list and years_list.
+    Only file names are listed, no partitions are read'''
+    drinfo_dir = _os.path.join(_os.path.abspath(tmp_dir),rnx_dr_lbl,drInfo_lbl)
+    paths = _np.asarray(sorted(_glob.glob('{}/[0-9][0-9][0-9][0-9]/*.zstd'.format(drinfo_dir))),dtype=object)
+    partitions = _pd.DataFrame({'station':[_os.path.basename(path)[:-7] for path in paths],
+                                'year':[int(_os.path.basename(_os.path.dirname(path))) for path in paths],
+                                'path':paths})
+    if stations_list is not None:
+        partitions = partitions[partitions['station'].isin([str(station).lower() for station in stations_list])]
+    if years_list is not None:
+        partitions = partitions[partitions['year'].isin([int(year) for year in years_list])]
+    stats = [_os.stat(path) for path in partitions['path']]
+    partitions['mtime'] = [stat.st_mtime_ns for stat in stats]
+    partitions['size'] = [stat.st_size for stat in stats]
+    return partitions.reset_index(drop=True)
+
+def drInfo_version(partitions):
+    '''Version of the selected drInfo partitions (output of drInfo_partitions) as crc32 of names, mtimes and sizes.
+    Changes whenever a station-year is added or regenerated'''
+    buf = partitions[['path','mtime','size']].astype(str).apply(lambda row: ' '.join(row),axis=1).str.cat(sep='\n')
+    return "%08X" % (_binascii.crc32(buf.encode('utf-8')) & 0xFFFFFFFF)
+
+def read_drInfo(tmp_dir,stations_list=None,years_list=None,partitions=None):
+    '''Reads only the drInfo partitions needed: stations_list and years_list limit the station-years loaded.
+    partitions may be passed directly if already listed with drInfo_partitions'''
+    if partitions is None: partitions = drInfo_partitions(tmp_dir=tmp_dir,stations_list=stations_list,years_list=years_list)
+    if partitions.shape[0] == 0:
+        raise ValueError('No drInfo partitions found for stations {} and years {}. Run get_drInfo first'.format(stations_list,years_list))
+    drinfo = _pd.concat([_dump_read(path) for path in partitions['path']],axis=0)
+    drinfo['station_name'] = drinfo['station_name'].astype(str).astype('category')
+    return drinfo
+
 def gather_drInfo(tmp_dir,num_cores,tqdm):
-    #After all stationyear files were generated => gather them to single dr_info file. Will be rewritten on every call (dr_info unique files will get updated if new files were added)
-    #should be run only once with single core
-    tmp_dir = _os.path.abspath(tmp_dir); num_cores = int(num_cores) #safety precaution if str value is specified
-    rnx_dir = _os.path.join(tmp_dir,rnx_dr_lbl)
-    drinfo_dir = _os.path.join(rnx_dir,drInfo_lbl)
-    tmp = []
-    drInfo_files = sorted(_glob.glob('{}/*/*.zstd'.format(drinfo_dir)))
-    for drInfo_file in drInfo_files:
-        tmp.append(_dump_read(drInfo_file))
-    print('gather_drInfo: Concatenating partial drinfo files to proj_tmp/rnx_dr/drInfo.zstd')
-    _dump_write(data = _pd.concat(tmp,axis=0),filename='{}/{}.zstd'.format(rnx_dir,drInfo_lbl),cname='zstd',num_cores=num_cores)
-    print('gather_drInfo: Done')
+    '''drInfo partitions written by get_drInfo are read directly by get_merge_table and gen_tropnom, so no consolidated file is rewritten anymore.
+    Station-years are appended by get_drInfo as new partition files and can be produced by several nodes at once.
+    Prints a summary of the available partitions'''
+    partitions = drInfo_partitions(tmp_dir=tmp_dir)
+    print('gather_drInfo: {} station-year partitions found for {} stations, years {}-{}'.format(partitions.shape[0],
+                partitions['station'].unique().shape[0],partitions['year'].min(),partitions['year'].max()))
+    print('gather_drInfo: drInfo version {}'.format(drInfo_version(partitions)))
     print('Now run gen_tropNom() to update the tropnominals. Sites will be taken from recently generated staDb so be careful (need to change it to drInfo sites')
-    
+    return partitions
+
 def mode2label(mode):
     mode_table = _pd.DataFrame(data = [['GPS','_g'],['GLONASS','_r'],['GPS+GLONASS','_gr']],columns = ['mode','label'])
     '''expects one of the modes (GPS, GLONASS or GPS+GLONASS and returs g,r or gr respectively for naming conventions)'''
@@ -348,66 +430,90 @@ def names2labels(constituents):
     return constituents_labels
     
 '''section of solution to ENV conversion'''
-def _xyz2env(dataset,reference_df,mode,dump=None):
+def env_rotations(reference_df,stations):
+    '''Returns reference XYZ (n_stations,3) from staDb table (output of get_ref_xyz_sites) and stacked XYZ->ENV rotation matrices (n_stations,3,3).
+    Computed once per station so the transform of all epochs is a single batched product. First STATE record of the station is used'''
+    ref_table = reference_df.drop_duplicates(subset='Station').set_index('Station')[['X','Y','Z']]
+    stations = _np.asarray(stations,dtype=object)
+    missing = ~_np.isin(stations,ref_table.index.values)
+    if missing.any(): raise ValueError('No reference XYZ in staDb for {}'.format(stations[missing].tolist()))
+    ref_xyz = ref_table.loc[stations].values.astype(_np.float64)
+    rot = _rot_xyz2env(ref_xyz) #XYZ -> ENV
+    return ref_xyz, rot
+
+def xyz2env_batch(station_idx,value,nomvalue,sigma,ref_xyz,rot):
+    '''Batched XYZ to ENV transform for a long table of epochs of several stations.
+    station_idx (n,) indexes ref_xyz (s,3) and rot (s,3,3) of env_rotations. value, nomvalue and sigma are (n,3) XYZ arrays in m.
+    Returns (n,9) array of value, nomvalue and sigma (east, north, up each) in mm. Same as tdp2EnvDiff.py but in mm'''
+    ref = ref_xyz[station_idx]
+    xyz = _np.stack([value - ref, nomvalue - ref, sigma],axis=1) #(n,kind,XYZ)
+    env = _np.einsum('nij,nkj->nki',rot[station_idx],xyz)*1000 #(n,kind,ENV)
+    return env.reshape(-1,9)
+
+def _station_name(solutions):
+    return solutions.columns.levels[1].str.split('.',expand=True).levels[2][0].upper() #get station name from .Station.XXXX.blabla
+
+def _xyz2env_chunk(chunk,reference_df,mode):
+    '''Converts a chunk of (station_name, solutions) pairs to ENV frames with one batched transform'''
+    stations = [station_name for station_name,_ in chunk]
+    ref_xyz, rot = env_rotations(reference_df,stations)
+    lengths = [solutions.shape[0] for _,solutions in chunk]
+    station_idx = _np.repeat(_np.arange(len(chunk)),lengths)
+
+    value,nomvalue,sigma = [],[],[]
+    for station_name,solutions in chunk:
+        XYZ_columns = '.Station.{}.State.Pos.'.format(station_name)+ _pd.Series(['X','Y','Z'])
+        value.append(solutions['value'][XYZ_columns].values)
+        nomvalue.append(solutions['nomvalue'][XYZ_columns].values)
+        sigma.append(solutions['sigma'][XYZ_columns].values)
+    env = xyz2env_batch(station_idx,_np.concatenate(value),_np.concatenate(nomvalue),_np.concatenate(sigma),ref_xyz,rot)
+
+    frames = []
+    for (station_name,solutions),env_station in zip(chunk,_np.split(env,_np.cumsum(lengths)[:-1])):
+        m_index= _pd.MultiIndex.from_product([[station_name],['value','nomvalue','sigma'],['east','north','up']])
+        frame = _pd.DataFrame(env_station,columns = m_index).set_index(solutions.index)
+        frames.append(_pd.concat([frame],keys=[mode],axis=1))
+    return frames
+
+def _xyz2env(dataset,reference_df,mode,dump=None,chunk_size=10):
     '''Correct way of processing smooth0_0.tdp file. Same as tdp2EnvDiff.py
     tdp2EnvDiff outputs in cm. We need in mm.
     Outputs a MultiIndex DataFrame with value and nomvalue subsections to control tdp_in procedure
     mode is used bu mGNSS_class to process synchronized series with multiple constellations. Prevents collecting envs
     In case encounters dump option -> dumps each gather as a {station}_{mode}.zstd
+    dataset may be an array of filtered solutions or any iterable (generator) of them. Solutions are consumed in chunks of chunk_size stations,
+    each chunk transformed with one batched einsum, so a generator keeps only one chunk of solutions in memory
     '''
-        #     if dump: gx_aux._dump_write(filename, data, num_cores=24, cname='zstd')
-    envs = _np.ndarray((len(dataset)),dtype=object)
-
-    for i in range(len(dataset)):
-        # Creating MultiIndex:
-        station_name = dataset[i].columns.levels[1].str.split('.',expand=True).levels[2][0].upper() #get station name from .Station.XXXX.blabla
+    envs = []; chunk = []; chunk_pos = []
+    for solutions in dataset:
+        station_name = _station_name(solutions)
         env_path = _os.path.join(dump,'{}{}.zstd'.format(station_name.lower(),mode2label(mode))) if dump is not None else None
-
         if dump is not None and _os.path.exists(env_path):
-            envs[i] = _dump_read(env_path)
-        else:
-            m_index= _pd.MultiIndex.from_product([[station_name],['value','nomvalue','sigma'],['east','north','up']])
-            frame = _pd.DataFrame(columns = m_index)
-
-            XYZ_columns = '.Station.{}.State.Pos.'.format(station_name)+ _pd.Series(['X','Y','Z'])
-            xyz_value = dataset[i]['value'][XYZ_columns]
-            xyz_nomvalue = dataset[i]['nomvalue'][XYZ_columns]
-            xyz_sigma = dataset[i]['sigma'][XYZ_columns]
-        
-            refxyz = get_xyz_site(reference_df,station_name) #stadb values. Median also possible. Another option is first 10-30% of data
-            # refxyz = xyz.median() #ordinary median as reference. Good for data with no trend. Just straight line. 
-            # refxyz = xyz.iloc[:int(len(xyz)*0.5)].median() #normalizing on first 10% of data so the trends should be visualized perfectly.
-            rot = _eo.rotEnv2Xyz(refxyz).T #XYZ
-
-            diff_value = xyz_value - refxyz #XYZ
-            diff_nomvalue = xyz_nomvalue - refxyz #XYZ
-            
-            diff_env_value = rot.dot(diff_value.T).T*1000
-            diff_env_nomvalue = rot.dot(diff_nomvalue.T).T*1000
-            env_sigma = rot.dot(xyz_sigma.T).T*1000
-
-            frame = _pd.DataFrame(_np.column_stack([diff_env_value,diff_env_nomvalue,env_sigma]),columns = m_index).set_index(dataset[i].index)
-            envs[i] = _pd.concat([frame],keys=[mode],axis=1)
-            if dump is not None:
-                _dump_write(filename = env_path, data=envs[i], num_cores=24, cname='zstd')
-    return envs
+            envs.append(_dump_read(env_path)); continue
+        envs.append(None); chunk_pos.append(len(envs)-1); chunk.append((station_name,solutions))
+        if len(chunk) == chunk_size:
+            _xyz2env_flush(envs,chunk_pos,chunk,reference_df,mode,dump)
+            chunk = []; chunk_pos = []
+    if len(chunk) > 0: _xyz2env_flush(envs,chunk_pos,chunk,reference_df,mode,dump)
+
+    result = _np.ndarray((len(envs)),dtype=object)
+    for i in range(len(envs)): result[i] = envs[i]
+    return result
+
+def _xyz2env_flush(envs,chunk_pos,chunk,reference_df,mode,dump):
+    '''Transforms the chunk, puts ENV frames to their positions in envs and dumps them if dump dir specified'''
+    for pos,(station_name,_),frame in zip(chunk_pos,chunk,_xyz2env_chunk(chunk,reference_df,mode)):
+        envs[pos] = frame
+        if dump is not None:
+            _dump_write(filename = _os.path.join(dump,'{}{}.zstd'.format(station_name.lower(),mode2label(mode))), data=frame, num_cores=24, cname='zstd')
 
 def get_xyz_site(staDb_ref_xyz,site_name):
     #return reference XYZ coordinates for specified station from staDb
     return staDb_ref_xyz[staDb_ref_xyz['Station'] == site_name][['X','Y','Z']].squeeze().values #Squeeze to series. Not to create array in array
 
 def get_ref_xyz_sites(staDb_path):
-    '''Function reads staDb file provided. Uses pandas, as default staDb object can not return XYZ coordinates???'''
-    read = _pd.read_csv(staDb_path,delimiter=r'\s+',names=list(range(11)))
-    positions = read[read.iloc[:,1]=='STATE']
-    # refxyz = get_xyz_site(positions)
-    xyz_table = positions[[0,4,5,6]]
-    xyz_table.reset_index(inplace=True,drop=True)
-
-    staDb_xyz = _pd.DataFrame()
-    staDb_xyz['Station'] = xyz_table[0]
-    staDb_xyz[['X','Y','Z']] = xyz_table[[4,5,6]].astype('float')
-    return staDb_xyz
+    '''Returns Station, X, Y, Z of staDb STATE records. staDb is parsed once per version (gx_stadb cache)'''
+    return _staDb_ref_xyz(staDb_path)
 
 def remove_30h(tmp_dir):
     #'rnx_dr/SITE/YEAR/DAY/*_30h.dr.gz
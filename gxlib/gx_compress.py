@@ -0,0 +1,125 @@
+'''In-process decompression and compression of products files.
+Unix compress (.Z, LZW) and gzip (.gz) files are read straight from the archive into memory or tmpfs so no uncompress/gzip subprocess
+or cache copy is needed. Outputs are gzipped in worker threads'''
+import gzip as _gzip
+import io as _io
+import os as _os
+import shutil as _shutil
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+
+_LZW_MAGIC = b'\x1f\x9d'
+_GZ_MAGIC = b'\x1f\x8b'
+_CHUNK_SIZE = 1 << 20
+
+def unlzw(data):
+    '''Decodes unix compress (.Z) LZW stream supplied as bytes. Mirrors the ncompress/gzip decoder including
+    the flush of unused bits to the next n_bits*8 boundary on code size increase and on CLEAR code'''
+    if data[:2] != _LZW_MAGIC:
+        raise ValueError('Not a unix compress (.Z) stream')
+    flags = data[2]
+    maxbits = flags & 0x1f
+    block_mode = flags & 0x80
+    if (maxbits < 9) or (maxbits > 16):
+        raise ValueError('Unsupported maxbits {} in .Z stream'.format(maxbits))
+    maxmaxcode = 1 << maxbits
+
+    buf = data[3:] + b'\x00\x00' #padding so 3 bytes can always be read
+    total_bits = (len(buf) - 2)*8
+
+    n_bits = 9; mask = (1 << n_bits) - 1
+    bitpos = 0; mark = 0 #mark is the bit position where current code size group started
+    table = [bytes((i,)) for i in range(256)]
+    if block_mode: table.append(b'') #code 256 is CLEAR in block mode
+    n_init = len(table)
+
+    out = []
+    prev = None
+    while bitpos + n_bits <= total_bits:
+        o = bitpos >> 3
+        code = ((buf[o] | (buf[o+1] << 8) | (buf[o+2] << 16)) >> (bitpos & 7)) & mask
+        bitpos += n_bits
+
+        if prev is None: #first code after start or CLEAR is a literal. No table entry created
+            prev = table[code]
+            out.append(prev)
+            continue
+
+        if block_mode and (code == 256):
+            del table[n_init:]
+            group = n_bits << 3
+            bitpos = mark + -(-(bitpos - mark)//group)*group
+            n_bits = 9; mask = (1 << n_bits) - 1; mark = bitpos
+            prev = None
+            continue
+
+        if code < len(table): entry = table[code]
+        elif code == len(table): entry = prev + prev[:1] #KwKwK case
+        else: raise ValueError('Corrupt .Z stream: code {} out of table range {}'.format(code,len(table)))
+        out.append(entry)
+
+        if len(table) < maxmaxcode: table.append(prev + entry[:1])
+        prev = entry
+
+        if (len(table) > mask) and (n_bits < maxbits): #next code needs one more bit
+            group = n_bits << 3
+            bitpos = mark + -(-(bitpos - mark)//group)*group
+            n_bits += 1; mask = (1 << n_bits) - 1; mark = bitpos
+    return b''.join(out)
+
+def decompress_bytes(data):
+    '''Decompresses bytes based on magic number. Uncompressed data is returned as is'''
+    if data[:2] == _LZW_MAGIC: return unlzw(data)
+    if data[:2] == _GZ_MAGIC: return _gzip.decompress(data)
+    return data
+
+def read_bytes(file_path):
+    '''Reads .Z, .gz or plain file directly from the archive and returns decompressed bytes'''
+    with open(_os.path.abspath(file_path),'rb') as f:
+        data = f.read()
+    return decompress_bytes(data)
+
+def open_product(file_path):
+    '''Returns binary file object with decompressed content. gzip is streamed, .Z is decoded into memory
+    (LZW streams are small products files: IONEX, sp3, clk)'''
+    file_path = _os.path.abspath(file_path)
+    with open(file_path,'rb') as f:
+        magic = f.read(2)
+    if magic == _GZ_MAGIC: return _gzip.open(file_path,'rb')
+    if magic == _LZW_MAGIC: return _io.BytesIO(read_bytes(file_path))
+    return open(file_path,'rb')
+
+def decompress_file(file_path,out_path=None,remove_src=False):
+    '''Decompresses .Z or .gz file into out_path (a file or a directory, e.g. tmpfs) without copying the compressed file first.
+    If out_path is None, the file is decompressed next to the source with the extension dropped as uncompress/gunzip do.
+    Output is written to a tmp name and renamed so partial files never appear. Returns path of the decompressed file'''
+    file_path = _os.path.abspath(file_path)
+    out_name = _os.path.splitext(_os.path.basename(file_path))[0]
+    if out_path is None: out_path = _os.path.join(_os.path.dirname(file_path),out_name)
+    elif _os.path.isdir(out_path): out_path = _os.path.join(out_path,out_name)
+
+    tmp_path = out_path + '.{}.tmp'.format(_os.getpid())
+    with open_product(file_path) as src, open(tmp_path,'wb') as dst:
+        _shutil.copyfileobj(src,dst,_CHUNK_SIZE)
+    _os.replace(tmp_path,out_path)
+    if remove_src: _os.remove(file_path)
+    return out_path
+
+def compress_file(file_path,remove_src=True,compresslevel=6):
+    '''gzip file in-process (as gzip cli does: level 6, original removed). Returns path of .gz file'''
+    file_path = _os.path.abspath(file_path)
+    out_path = file_path + '.gz'
+    tmp_path = out_path + '.{}.tmp'.format(_os.getpid())
+    with open(file_path,'rb') as src, open(tmp_path,'wb') as raw: #GzipFile does not close fileobj passed so raw is closed by with
+        with _gzip.GzipFile(filename=_os.path.basename(file_path),mode='wb',fileobj=raw,compresslevel=compresslevel) as dst:
+            _shutil.copyfileobj(src,dst,_CHUNK_SIZE)
+    _os.replace(tmp_path,out_path)
+    if remove_src: _os.remove(file_path)
+    return out_path
+
+def compress_files(files,num_threads=None,remove_src=True):
+    '''Compresses files in worker threads. zlib releases the GIL so threads scale without extra processes'''
+    files = list(files)
+    if len(files) == 0: return []
+    num_threads = len(files) if num_threads is None else min(int(num_threads),len(files))
+    with _ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(lambda file_path: compress_file(file_path,remove_src=remove_src),files))
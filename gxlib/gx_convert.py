@@ -1,7 +1,7 @@
 import glob as _glob
 import os as _os
+import tempfile as _tempfile
 from multiprocessing import Pool as _Pool
-from shutil import copy as _copy
 from shutil import rmtree as _rmtree
 from subprocess import Popen as _Popen
 
@@ -10,6 +10,8 @@ import pandas as _pd
 import tqdm as _tqdm
 
 from .gx_aux import drInfo_lbl, rnx_dr_lbl, prepare_dir_struct_dr
+from .gx_aux import worker_scratch as _worker_scratch, clean_scratch as _clean_scratch
+from .gx_compress import decompress_file as _decompress_file
 
 
 def select_rnx(stations_list,years_list,rnx_dir,tmp_dir,hatanaka,cddis=False):
@@ -54,32 +56,36 @@ def select_rnx(stations_list,years_list,rnx_dir,tmp_dir,hatanaka,cddis=False):
 
 def _2dr(rnx2dr_path):
     '''Opens process rxEditGde.py to convert specified rnx to dr file for GipsyX. The subprocess is used in order to run multiple instances at once.
-    If converted file is already present, nothing happens
+    RNX file is read directly from the archive (direct mode) or streamed once into the worker scratch dir on tmpfs (decompressed).
+    dr file is written next to its final location under a tmp name and renamed on success so failed runs leave no partial files.
     We might want to dump and kill service tree files and stats'''
     in_file_path = rnx2dr_path[0]
     out_file_path = rnx2dr_path[1]
-    cache_path = rnx2dr_path[2]
+    scratch_base = rnx2dr_path[2] #run-unique dir created by rnx2dr
     staDb_path = rnx2dr_path[3]
+    direct = rnx2dr_path[4] if len(rnx2dr_path) > 4 else True
 
+    scratch_dir = _worker_scratch(scratch_base) #smth like /cache/rnx2dr_abc123/12345/
     out_dir = _os.path.dirname(out_file_path)
+    out_file_tmp_path = _os.path.join(out_dir,'.{}.{}'.format(_os.getpid(),_os.path.basename(out_file_path))) #same extension so rnxEditGde compresses the output
 
-    cache_dir = _os.path.join(cache_path,_os.path.basename(out_file_path)) #smth like /cache/anau2350.10d.dr.gz/
-    if not _os.path.exists(cache_dir):
-        _os.makedirs(cache_dir)
-    _copy(src = in_file_path, dst = cache_dir) #copy 
-    in_file_cache_path = _os.path.join(cache_dir,_os.path.basename(in_file_path))
-    out_file_cache_path = _os.path.join(cache_dir,_os.path.basename(out_file_path))
+    try:
+        if not direct: in_file_path = _decompress_file(in_file_path,out_path=scratch_dir)
+        process = _Popen(['rnxEditGde.py', '-dataFile', in_file_path,'-staDb',staDb_path, '-o', out_file_tmp_path],cwd = scratch_dir)
+        process.wait()
+        if (process.returncode == 0) and _os.path.exists(out_file_tmp_path):
+            _os.replace(out_file_tmp_path,out_file_path)
+        else:
+            print('gx_convert._2dr: rnxEditGde.py failed on {}'.format(rnx2dr_path[0]))
+    finally:
+        if _os.path.exists(out_file_tmp_path): _os.remove(out_file_tmp_path)
+        _clean_scratch(scratch_dir)
 
-    process = _Popen(['rnxEditGde.py', '-dataFile', in_file_cache_path,'-staDb',staDb_path, '-o', out_file_cache_path],cwd = cache_dir)
-    process.wait()
-    _copy(src = out_file_cache_path, dst = out_dir) #copy result to destination
-    #clear folder in ram
-    _rmtree(cache_dir)
 
 
-
-def rnx2dr(selected_df,num_cores,tqdm,cache_path,staDb_path,cddis=False):
-    '''Runs rnxEditGde.py for each file in the class object in multiprocessing'''
+def rnx2dr(selected_df,num_cores,tqdm,cache_path,staDb_path,cddis=False,direct=True):
+    '''Runs rnxEditGde.py for each file in the class object in multiprocessing.
+    direct=True reads RNX files straight from rnx_dir, direct=False decompresses each file once into worker scratch on cache_path'''
     #Checking files that are already in place so not to overwrite
     print('staDb_path:',staDb_path)
     if_exists_array = _np.ndarray((selected_df.shape[0]),dtype=bool)
@@ -89,17 +95,25 @@ def rnx2dr(selected_df,num_cores,tqdm,cache_path,staDb_path,cddis=False):
 
 
     selected_df2convert = selected_df[['rnx_path','dr_path']].copy()
-    selected_df2convert['cache_path'] = cache_path #populating df with cache path value
+    selected_df2convert['scratch_base'] = None #run-unique scratch base, set below
     selected_df2convert['staDb_path'] = staDb_path #populating with staDb_path which is needed as rnx files may lack receiver information
+    selected_df2convert['direct'] = direct
     selected_df2convert = selected_df2convert.values
      
     if selected_df2convert.shape[0] > 0:
         num_cores = num_cores if selected_df2convert.shape[0] > num_cores else selected_df2convert.shape[0]
         print ('Number of files to process:', selected_df2convert.shape[0],'| Adj. num_cores:', num_cores,end=' ')
 
-        with _Pool(processes = num_cores) as p:
-            if tqdm: list(_tqdm.tqdm_notebook(p.imap(_2dr, selected_df2convert), total=selected_df2convert.shape[0]))
-            else: p.map(_2dr, selected_df2convert)
+        #cache_path (e.g. /run/user/1017) is shared by all runs on the node so this run gets its own scratch base and removes only it
+        if not _os.path.exists(cache_path): _os.makedirs(cache_path)
+        scratch_base = _tempfile.mkdtemp(prefix='rnx2dr_',dir=cache_path)
+        selected_df2convert[:,2] = scratch_base
+        try:
+            with _Pool(processes = num_cores) as p:
+                if tqdm: list(_tqdm.tqdm_notebook(p.imap(_2dr, selected_df2convert), total=selected_df2convert.shape[0]))
+                else: p.map(_2dr, selected_df2convert)
+        finally:
+            _rmtree(scratch_base,ignore_errors=True) #workers' scratch dirs of this run only
     else:
         #In case length of unconverted files array is 0 - nothing will be converted
         print('RNX files converted.\nNothing to convert. All available rnx files are already converted')
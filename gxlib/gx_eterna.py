@@ -1,81 +1,71 @@
 import numpy as _np
 import pandas as _pd
 
-from GipsyX_Wrapper.gxlib.gx_aux import J2000origin as _J2000origin, date2yyyydoy
-from GipsyX_Wrapper.gxlib.gx_filter import _stretch, _avg_30
+from GipsyX_Wrapper.gxlib.gx_aux import J2000origin as _J2000origin, date2yyyydoy, _dump_read
+from GipsyX_Wrapper.gxlib.gx_filter import bin_average
 from GipsyX_Wrapper.gxlib.gx_hardisp import gen_synth_otl
+from GipsyX_Wrapper.gxlib.gx_geodesy import staDb_llh as _staDb_llh
+from GipsyX_Wrapper.gxlib.gx_tides import analyse_native as _analyse_native, analyse_native_windows as _analyse_native_windows, potential_catalogue as _potential_catalogue
 
 import sys as _sys,os as _os
 import shutil as _shutil
+import hashlib as _hashlib
+import time as _time
+from io import StringIO as _StringIO
 from subprocess import Popen as _Popen, PIPE as _PIPE
 from multiprocessing import Pool
-#Converting staDb coordinates to llh for eterna ini file
-PYGCOREPATH = "{}/lib/python{}.{}".format(_os.environ['GCOREBUILD'],
-                                          _sys.version_info[0], _sys.version_info[1])
-if PYGCOREPATH not in _sys.path:
-    _sys.path.insert(0, PYGCOREPATH)
-
-import gcore.StationDataBase as StationDataBase
 
+_eterna_cache_lbl = 'eterna_cache'
+_eterna_wait = 3600 #s to wait for prn of a job that another process runs
+
+
+_ETERNA_file_begin = 'C******************************************************************************\n'
+_ETERNA_block_begin = '{}               1.0000    1.0000     0.000         0    BLOCK{}\n77777777            0.000\n'
+_ETERNA_block_end = '\n99999999\n'
+_ETERNA_file_end = '88888888'
+_ETERNA_row = '%8d %6d %9.3f'
+
+def _ETERNA_date_time(time_int):
+    '''J2000 seconds to ETERNA YYYYMMDD and HHMMSS integers'''
+    time = time_int + _J2000origin
+    days = time.astype('datetime64[D]')
+    months = time.astype('datetime64[M]')
+    date_et = (time.astype('datetime64[Y]').astype(int) + 1970)*10000 + (months.astype(int) % 12 + 1)*100 + (days - months).astype(int) + 1
+    seconds = (time - days).astype(int)
+    time_et = (seconds//3600)*10000 + (seconds % 3600//60)*100 + seconds % 60
+    return date_et, time_et
+
+def _ETERNA_blocks(time_int,sampling,min_samples=24):
+    '''Begin and end row indices of blocks split on gaps > sampling. Blocks shorter than min_samples are skipped.
+    Last row closes the last block and is not written, as with the former iloc based writer'''
+    bounds = _np.concatenate([[0],_np.flatnonzero(time_int - _np.roll(time_int,1) > sampling),[time_int.shape[0] - 1]])
+    begins, ends = bounds[:-1], bounds[1:]
+    long_blocks = (ends - begins) >= min_samples
+    return begins[long_blocks], ends[long_blocks]
+
+def _write_ETERNA_stream(dataset,file,sampling,station_name):
+    '''Writes ETERNA .dat content of the first column of dataset to a text stream.
+    Rows are formatted with one %-format per block'''
+    data = dataset.iloc[:,0].values.astype(_np.float64)
+    present = ~_np.isnan(data)
+    time_int = dataset.index.values[present].astype(int)
+    data = data[present]
+    date_et, time_et = _ETERNA_date_time(time_int)
+    rows = _np.column_stack([date_et,time_et,data])
+
+    file.write(_ETERNA_file_begin)
+    for block_number,(begin,end) in enumerate(zip(*_ETERNA_blocks(time_int,sampling)),start=1):
+        file.write(_ETERNA_block_begin.format(station_name,block_number))
+        file.write('\n'.join([_ETERNA_row]*(end - begin)) % tuple(rows[begin:end].ravel().tolist()))
+        file.write(_ETERNA_block_end)
+    file.write(_ETERNA_file_end)
 
 def _write_ETERNA(dataset, filename,sampling,station_name):
-    '''sampling is 1800 for 30 min averaged files. Sampling detection may be done automatically if needed (histogram analysis of the dataset)'''
-    def a(inp):
-        return '{:8d}'.format(inp)
-    def b(inp):
-        return '{:6d}'.format(inp)
-    def c(inp):
-        if _np.isnan(inp):
-
-            return '{:9.3s}'.format('')
-        else:
-            return '{:9.3f}'.format(inp)
-        
-    #test harmonic dataset
-#     data = pandas.DataFrame(data=dataset,columns=['J2000_time','Data'])
-    dataset = dataset[~_pd.isna(dataset.iloc[:,0])]
-    data = _pd.DataFrame(index = dataset.index)
-    time_int = dataset.index.values.astype(int)
-    data['Time'] = time_int+ _J2000origin
-
-    data['Date_et'] = data['Time'].dt.strftime('%Y%m%d').astype(int)
-    data['Time_et'] = data['Time'].dt.strftime('%H%M%S').astype(int)
-    data['Data'] = dataset.iloc[:,0]
-
-    file_begin = 'C******************************************************************************\n'
-    block_end = '\n99999999\n'
-    file_end = '88888888'
-    
-    #Get blocks if there are gaps:
-    block_ends = _np.where(time_int -_np.roll(time_int,1) > sampling)[0]
-    block_ends = _np.append(block_ends,-1) #Adding -1 to extract the last block
-    block_begin_ind = 0 #Init begin block index which is zero
-    
+    '''sampling is 1800 for 30 min averaged files. Sampling detection may be done automatically if needed (histogram analysis of the dataset)
+    Written through a buffered file'''
+    with open(filename, 'w', buffering=1<<20) as file:
+        _write_ETERNA_stream(dataset,file,sampling,station_name)
 
-
-    
-    out_buf = file_begin
-    block_number = 1
-    for i in range(len(block_ends)):
-        block_end_ind = block_ends[i]
-        block = data.iloc[block_begin_ind:block_end_ind]
-        # Additional check: if block len < 24 => skip block
-        if block.shape[0] >= 24:
-            
-            block_begin = '{}               1.0000    1.0000     0.000         0    BLOCK{}\n77777777            0.000\n'.format(station_name,block_number)
-
-            out_buf+=(block_begin +
-                    data.iloc[block_begin_ind:block_end_ind].to_string(columns=['Date_et', 'Time_et', 'Data'], formatters={'Date_et': a, 'Time_et': b, 'Data': c},
-                                    index=False, header=False) + block_end)
-            block_begin_ind = block_end_ind
-            block_number += 1 
-        else: block_begin_ind = block_end_ind
-            
-    out_buf+=(file_end)
-    
-    with open(filename, 'w') as file:
-        file.write(out_buf)
-        
 def _get_trend(dataset,deg=1):
     '''returns''' 
     dataset = dataset[(~_np.isnan(dataset)).min(axis=1)].copy()
@@ -91,37 +81,34 @@ def _remove_outliers(dataset_env,v_type,coef=3):
     detrend = dataset_env[v_type] - _get_trend(dataset_env[v_type])   
     return detrend[(detrend.abs() <= detrend.std()*coef).min(axis=1)]
 
-def _fill_block(block_):
-    delta_var = block_.iloc[-1] - block_.iloc[0]
-    delta_t = block_.index[-1] - block_.index[0]
-    lin_coeff = (delta_var/ delta_t).values
-    dT = (block_.index[1:-1]- block_.index[0]).values
-    t0_var = block_.iloc[0].values
-    block_.iloc[1:-1] = dT[:,_np.newaxis] * lin_coeff + t0_var
-    return block_.iloc[1:-1]
-
-def _interp_short_gaps(dataset_avg):
-    #expects averaged 30 min sampling ENV dataset as input
+def _short_gap_fill(time,values,max_gap,sampling):
+    '''Positions and linearly interpolated values of rows inside short gaps. A gap is between consecutive rows with all values present
+    and is short if 0 < gap - sampling <= max_gap (seconds). Rows inside the gap are filled from the two bounding rows'''
+    valid_pos = _np.flatnonzero(~_np.isnan(values).any(axis=1))
+    if valid_pos.shape[0] < 2: return _np.empty(0,dtype=_np.int64), _np.empty((0,values.shape[1]))
+    gap = time[valid_pos[1:]] - time[valid_pos[:-1]] - sampling
+    short = (gap > 0) & (gap <= max_gap)
+
+    inside = _np.setdiff1d(_np.arange(valid_pos[0],valid_pos[-1]),valid_pos) #rows with NaNs between first and last complete rows
+    right_id = _np.searchsorted(valid_pos,inside)
+    inside, right_id = inside[short[right_id - 1]], right_id[short[right_id - 1]]
+    left, right = valid_pos[right_id - 1], valid_pos[right_id]
+    lin_coeff = (values[right] - values[left])/(time[right] - time[left])[:,_np.newaxis]
+    return inside, (time[inside] - time[left])[:,_np.newaxis]*lin_coeff + values[left]
+
+def _interp_short_gaps(dataset_avg,max_gap=12*3600,sampling=1800,level=None):
+    '''Linear fill of gaps not longer than max_gap seconds in one vectorized pass. Expects averaged dataset with rows at every sampling step
+    (e.g. dense bin_average output), gaps are rows with NaNs. Columns are filled together; with level (e.g. 0 for frames of several
+    constellations) gaps are detected separately for each group of columns sharing that level value'''
     dataset_avg = dataset_avg.copy()
-    dataset_breaks = dataset_avg[(~_np.isnan(dataset_avg)).min(axis=1)].copy()
-    
-    
-    dataset_breaks['break_begin'] = _np.roll(dataset_breaks.index,1)
-    dataset_breaks['break_end'] = dataset_breaks.index
-    dataset_breaks['break_length'] = (((dataset_breaks['break_end'] - dataset_breaks['break_begin']))-1800)/3600 #how many hours is in the break
-    short_breaks = dataset_breaks[(dataset_breaks['break_length'] <=12) & (dataset_breaks['break_length'] > 0)] #these are short breaks
-    
-    tmp=[]
-    for i in range(short_breaks.shape[0]):
-        begin = short_breaks.iloc[i].break_begin
-        end = short_breaks.iloc[i].break_end
-        
-        block_ = dataset_avg.loc[begin : end]
-        tmp.append(_fill_block(block_.copy()))
-        
-    update = _pd.concat(tmp)
-    dataset_avg.loc[update.index] = update
-    return dataset_avg
+    time = dataset_avg.index.values.astype(_np.float64)
+    groups = [slice(None)] if level is None else [dataset_avg.columns.get_level_values(level) == group for group in dataset_avg.columns.unique(level)]
+    values = dataset_avg.values.astype(_np.float64)
+    for group in groups:
+        columns = _np.arange(values.shape[1])[group]
+        inside, filled = _short_gap_fill(time,values[:,columns],max_gap=max_gap,sampling=sampling)
+        values[inside[:,_np.newaxis],columns] = filled
+    return _pd.DataFrame(values,index=dataset_avg.index,columns=dataset_avg.columns)
 
 def env2eterna(dataset,remove_outliers,v_type = 'value'):
     '''Expects env dataset. Removes outliers via detrend
@@ -129,8 +116,7 @@ def env2eterna(dataset,remove_outliers,v_type = 'value'):
     if remove_outliers: filt1 = _remove_outliers(dataset,v_type=v_type) #Turning off and on the detrending
     else: filt1 = dataset[v_type]
 
-    filt1_st = _stretch(filt1)
-    filt1_avg = _avg_30(filt1_st)
+    filt1_avg = bin_average(filt1,sampling=300,window=1800,dense=True) #dense as gen_synth_otl expects stretched dataset
     return _interp_short_gaps(filt1_avg)
 
 ini_extra = '''
@@ -179,95 +165,115 @@ WAVEGROUPI=  3.791963  3.937898  1.000000   .000000 M4    #ETERNA wavegroup
 # End of file template.ini'''
 
 def get_staDb_llh(staDb_path):
-    '''Returns dataframe with staDb stations and llh that can be used for eterna ini file or nloadf'''
+    '''Returns dataframe with staDb stations and llh that can be used for eterna ini file or nloadf. Cached per staDb version'''
     max_t = 3.0e8
-    staDb = StationDataBase.StationDataBase(dataBase = staDb_path)  # creating staDb object
-
-    
-    # staDb.read(staDb_path)# reading staDb into staDb object
-    stns = staDb.getStationList()  # creating array with available station names
-    llh_stdb = _np.asarray(staDb.dumpLatLonHeights(epoch=max_t,
-                                                 stationList=stns))
-    return _pd.DataFrame(llh_stdb.T,index=stns,columns=['LAT','LON','ELEV'])
-
+    return _staDb_llh(staDb_path,epoch=max_t)
+
+
+def _ETERNA_ini(station_name,llh):
+    '''ini file content for a station. Ignores options needed for PREDICT for now (INITIALEPO and PREDICSPAN)'''
+    return ('SENSORNAME= {}\nSAMPLERATE= {}\nSTATLATITU= {}\nSTATLONITU= {}\nSTATELEVAT= {}\nTEXTHEADER= {} {} {} {} '
+                .format(station_name,'1800',llh['LAT'],llh['LON'],llh['ELEV'],station_name,'GNSS station',llh['LAT'],llh['LON'] )) + ini_extra
+
+def _pending_path(entry_path):
+    return entry_path + '.pending'
+
+def _eterna_job(dataset,component,station_name,llh,eterna_path,cache_dir,force):
+    '''Input of a single component ETERNA run. Cache entry is named by sha1 of .dat content plus ini settings (and component, ETERNA path)
+    so identical inputs share the entry and any change in window, filtering or settings gives a new one.
+    .dat and .ini are written by the preparing worker to pending entry ({entry}.pending) so only digest paths go through the pool.
+    Returns [eterna_path, component, entry_path, force]'''
+    dat = _StringIO()
+    _write_ETERNA_stream(dataset=dataset,file=dat,sampling=1800,station_name=station_name)
+    dat = dat.getvalue()
+    ini = _ETERNA_ini(station_name,llh)
+    entry_path = _os.path.join(cache_dir,_hashlib.sha1('\n'.join([eterna_path,component,ini,dat]).encode()).hexdigest())
+    pending_path = _pending_path(entry_path)
+    if (force or not _os.path.exists(_prn_path(entry_path,component))) and not _os.path.exists(pending_path):
+        tmp_path = '{}.{}.tmp'.format(pending_path,_os.getpid())
+        if _os.path.exists(tmp_path): _shutil.rmtree(tmp_path)
+        _os.makedirs(tmp_path)
+        with open(_os.path.join(tmp_path,component+'.dat'),'w') as dat_file: dat_file.write(dat)
+        with open(_os.path.join(tmp_path,component+'.ini'),'w') as ini_file: ini_file.write(ini)
+        try: _os.rename(tmp_path,pending_path)
+        except OSError: _shutil.rmtree(tmp_path) #same input written concurrently by another worker
+    return [eterna_path,component,entry_path,force]
+
+def _prn_path(entry_path,component):
+    return _os.path.join(entry_path,component+'.prn')
+
+def _wait_prn(entry_path,component):
+    '''Waits for prn of the entry which pending input was claimed by another process (e.g. concurrent analyze on the same tmp_dir)'''
+    prn_path = _prn_path(entry_path,component)
+    begin = _time.time()
+    while not _os.path.exists(prn_path):
+        if _time.time() - begin > _eterna_wait:
+            raise RuntimeError('No {} after {} s. Its input was taken by another process that did not publish it'.format(prn_path,_eterna_wait))
+        _time.sleep(1)
+    return prn_path
+
+def _publish_entry(comp_path,entry_path):
+    '''Publishes finished run dir as cache entry. Entry is a symlink to a versioned dir that is replaced atomically, so readers
+    always see a complete entry, also on forced reruns. Previous version is removed after the replace'''
+    version_path = '{}.{}.{}'.format(entry_path,_os.getpid(),_time.time_ns())
+    _os.rename(comp_path,version_path)
+    link_path = '{}.{}.lnk'.format(entry_path,_os.getpid())
+    if _os.path.lexists(link_path): _os.remove(link_path)
+    _os.symlink(_os.path.basename(version_path),link_path)
+    previous = _os.path.realpath(entry_path) if _os.path.lexists(entry_path) else None
+    if (previous is not None) and not _os.path.islink(entry_path): #entry of older cache layout is a plain dir
+        _os.rename(entry_path,version_path + '.old')
+        previous = version_path + '.old'
+    _os.replace(link_path,entry_path)
+    if previous is not None: _shutil.rmtree(previous,ignore_errors=True)
 
 def run_eterna(input_vars):
-    eterna_exec,comp_path = input_vars
-    process = _Popen([eterna_exec],cwd=comp_path,stdout=_PIPE)
+    '''Runs ETERNA analyse for a single component job. Pending entry with .dat and .ini is renamed to a pid-private dir which is published
+    as the cache entry after the run (see _publish_entry), so an entry only appears complete. Existing entry is reused unless force.
+    If another process already took the pending entry, waits for its prn. Returns prn path'''
+    eterna_path,component,entry_path,force = input_vars
+    if _os.path.exists(_prn_path(entry_path,component)) and not force: return _prn_path(entry_path,component)
+
+    comp_path = '{}.{}.tmp'.format(entry_path,_os.getpid())
+    if _os.path.exists(comp_path): _shutil.rmtree(comp_path)
+    try: _os.rename(_pending_path(entry_path),comp_path)
+    except FileNotFoundError: return _wait_prn(entry_path,component) #claimed by another process with the same input
+    #create a symlink to commdat folder as needed for eterna
+    _os.symlink(_os.path.join(eterna_path,'commdat'),_os.path.join(comp_path,'commdat'))
+    with open(_os.path.join(comp_path,'default.ini'),'w'): pass #Touch empty default.ini file
+    with open(_os.path.join(comp_path,'project'),'w') as project_file: project_file.write(component)
+
+    process = _Popen([_os.path.join(eterna_path,'bin/analyse')],cwd=comp_path,stdout=_PIPE)
     process.communicate()
-    # out, err = process.communicate()
-    # print(err.decode())
-    # print(out.decode())
-    
-def analyse_et(env_et,begin_date, end_date,eterna_path,station_name,project_name,tmp_dir,staDb_path,remove_outliers,force,mode,otl_env=False,parameter_name=None):
-    '''Ignores options needed for PREDICT for now (INITIALEPO and PREDICSPAN)
-    otl_env switch means creating tmp_otl_et directory and not standard tmp_et'''
-    eterna_exec = _os.path.join(eterna_path,'bin/analyse')
-    commdat_path = _os.path.join(eterna_path,'commdat')
-
-    dir_name = '{}_{}_{}'.format('tmp_otl_et' if otl_env else 'tmp_et',date2yyyydoy(begin_date),date2yyyydoy(end_date))
-    tmp_station_path = _os.path.join(tmp_dir,'gd2e',project_name,station_name,dir_name) #add begin_end names here
-    
+    if not _os.path.exists(_prn_path(comp_path,component)):
+        raise RuntimeError('ETERNA produced no {}.prn. Check {}'.format(component,comp_path))
+
+    _publish_entry(comp_path,entry_path)
+    return _prn_path(entry_path,component)
+
+def _eterna_station_jobs(env_et,eterna_path,station_name,tmp_dir,staDb_path,force,parameter_name=None):
+    '''Per component ETERNA jobs of a station. Returns [station_name, llh, parameter_name, jobs]'''
     if env_et.shape[-1] == 3:
         components = ['e_eterna','n_eterna','v_eterna']
         parameter_name = ['east','north','up']
     elif env_et.shape[-1] == 1:#need to add wetz_eterna component if component is 1
         components = ['aux_eter'] #used to be wetz_ete. renamed to aux_eter. All single column dataseries are treated as aux analysis timeseries
-        
-    
-    components_exist = []
-    for component in components:
-
-        if force: #force removes eterna tmp folders
-            print('Using "force" option', end=' | ')
-            if _os.path.exists(_os.path.join(tmp_station_path,component)):_shutil.rmtree(_os.path.join(tmp_station_path,component))
-
-        prn_exists = _os.path.exists(_os.path.join(tmp_station_path,component,component+'.prn'))
-        components_exist.append(prn_exists)
-    eterna_exists = _np.min(components_exist) #if at least one is missing -> False
 
     llh = (get_staDb_llh(staDb_path).loc[station_name]).round(4)
+    cache_dir = _os.path.join(tmp_dir,'gd2e',_eterna_cache_lbl)
+    jobs = [_eterna_job(env_et.iloc[:,[i,]],components[i],station_name,llh,eterna_path,cache_dir,force) for i in range(env_et.shape[-1])]
+    return [station_name,llh,parameter_name,jobs]
 
+def _extract_station(station_jobs):
+    station_name,llh,parameter_name,jobs = station_jobs
+    prn_files = [_prn_path(job[2],job[1]) for job in jobs]
+    return _pd.concat([extract_et(prn_files,llh['LON'],llh['LAT'],components=parameter_name)],keys=[station_name])
 
-
-    if not eterna_exists:
-        print(('Processing {} {} with Eterna {}-{} | {}').format(station_name,mode,begin_date,end_date,dir_name),end=' | ')
-
-        if not _os.path.exists(tmp_station_path): _os.makedirs(tmp_station_path) 
-        for i in range(env_et.shape[-1]):
-            comp_path = _os.path.join(tmp_station_path,components[i])
-            if not _os.path.exists(comp_path): _os.makedirs(comp_path)
-            #create a symlink to commdat folder as needed for eterna
-            _os.symlink(commdat_path,_os.path.join(comp_path,'commdat'))   
-            #Writing Eterna dat file for specific component and station
-            # return env_et.iloc[:,[i,]]
-            _write_ETERNA(dataset=env_et.iloc[:,[i,]],filename=_os.path.join(comp_path,components[i]+'.dat'),sampling=1800, station_name=station_name)
-
-            #Writing ini file for specific component and station
-            ini_path = _os.path.join(comp_path,components[i]+'.ini')
-            
-            with open(ini_path,'w') as ini_file:
-                ini_file.write('''SENSORNAME= {}\nSAMPLERATE= {}\nSTATLATITU= {}\nSTATLONITU= {}\nSTATELEVAT= {}\nTEXTHEADER= {} {} {} {} '''
-                            .format(station_name,'1800',llh['LAT'],llh['LON'],llh['ELEV'],station_name,'GNSS station',llh['LAT'],llh['LON'] ))
-                ini_file.write(ini_extra)
-
-            #Touch empty default.ini file
-            def_ini_path = _os.path.join(comp_path,'default.ini')
-            with open(def_ini_path,'w'):
-                _os.utime(def_ini_path, None)
-
-            #Writing project file
-            project_path = _os.path.join(comp_path,'project')
-            with open(project_path,'w') as project_file:
-                project_file.write(components[i])
-
-            # Executing ETERNA. For each component in sequence (expects list of arguments)
-            run_eterna([eterna_exec,comp_path])
-
-    if eterna_exists:
-        print('Found previous Eterna session for', station_name + '. Extracting processed as not forced.', end=' | ')
-        
-    return extract_et(tmp_station_path,llh['LON'],llh['LAT'],et_components = components,components=parameter_name)
+def analyse_et(env_et,eterna_path,station_name,tmp_dir,staDb_path,force,parameter_name=None):
+    '''Runs ETERNA for all components of env_et in sequence (cached by input content) and returns blq-like table'''
+    station_jobs = _eterna_station_jobs(env_et,eterna_path,station_name,tmp_dir,staDb_path,force,parameter_name)
+    for job in station_jobs[3]: run_eterna(job)
+    return _extract_station(station_jobs).loc[station_name]
 
 def read_prn(prn_file):
     with open(prn_file,'r') as file:
@@ -285,7 +291,7 @@ def read_prn(prn_file):
     df.set_index(waves_extracted,inplace=True)
     return df
 
-def extract_et(tmp_station_path,lon,lat,et_components = ['e_eterna','n_eterna','v_eterna'],components=['east','north','up'],print_lon_lat = False):
+def extract_et(prn_files,lon,lat,components=['east','north','up'],print_lon_lat = False):
     lon-=360 if lon>180 else 0 #as the operator is -= then else will be -=parameter !!!
     lon+=360 if lon<-180 else 0
     if print_lon_lat: print(lon,lat)
@@ -297,9 +303,8 @@ def extract_et(tmp_station_path,lon,lat,et_components = ['e_eterna','n_eterna','
     columns_mlevel = _pd.MultiIndex.from_product([components,['amplitude','phase'],['value','std']])
     df_blq = _pd.DataFrame(columns = columns_mlevel,index = ['M2','S2','N2','K2','K1','O1','P1','Q1','MF','MM','SSA','14h'])
     
-    for i in range(len(et_components)):
-        prn_file = _os.path.join(tmp_station_path,et_components[i],et_components[i]+'.prn')
-        df = read_prn(prn_file) 
+    for i in range(len(prn_files)):
+        df = read_prn(prn_files[i]) 
 
         df_blq[components[i]]['amplitude']['value'].update(((df.theor_a * df.a_factor)/1000).round(5))
         df_blq[components[i]]['amplitude']['std'].update(((df.theor_a * df.a_stdv)/1000).round(5))
@@ -329,11 +334,12 @@ def extract_et(tmp_station_path,lon,lat,et_components = ['e_eterna','n_eterna','
     
     return df_blq[components]
     
-def analyze_env_single_thread(values_set):
+def _env_et_single_thread(values_set):
     # function that executes with single thread. Expects list of parameters to run with mp.
-    # Expects env - an element of envs. Analyzes all 3 components one after the other
-    env_mode,eterna_path,tmp_dir,staDb_path,project_name,remove_outliers,restore_otl,blq_file,sampling,hardisp_path,force,mode,otl_env,begin_date,end_date,v_type,parameter = values_set
-    env = env_mode[mode]
+    # Expects env - an element of envs. Returns [station_name, env_et, parameter] ready for analysis of all components of the station
+    # env_mode may be a path to env gather so the worker loads its own station and only the result is sent back
+    env_mode,eterna_path,tmp_dir,staDb_path,project_name,remove_outliers,restore_otl,blq_file,sampling,hardisp_path,force,mode,otl_env,begin_date,end_date,v_type,parameter,otl_backend = values_set
+    env = (_dump_read(env_mode) if isinstance(env_mode,str) else env_mode)[mode]
     station_name = env.columns.levels[0][0]
     if parameter is not None:
         Trop = ['GradEast','GradNorth','WetZ'] 
@@ -353,39 +359,79 @@ def analyze_env_single_thread(values_set):
                         remove_outliers, v_type = v_type)
 
     if otl_env:
-        synth_otl = gen_synth_otl(dataset = env_et,station_name = station_name,hardisp_path=hardisp_path,blq_file=blq_file,sampling=sampling)
-        blq_array = _pd.concat([analyse_et( env_et = synth_otl,
-                                            begin_date = begin_date,end_date = end_date,
-                                            eterna_path = eterna_path,station_name=station_name,project_name=project_name,
-                                            tmp_dir=tmp_dir,staDb_path=staDb_path,
-                                            remove_outliers=remove_outliers,force=force,otl_env=otl_env,mode=mode,parameter_name=parameter)],keys=[station_name])
+        env_et = gen_synth_otl(dataset = env_et,station_name = station_name,hardisp_path=hardisp_path,blq_file=blq_file,sampling=sampling,
+                               backend=otl_backend,eterna_path=eterna_path)
     elif restore_otl:
-        synth_otl = gen_synth_otl(dataset = env_et,station_name = station_name,hardisp_path=hardisp_path,blq_file=blq_file,sampling=sampling)
-        restored_et = env_et + synth_otl
-        blq_array = _pd.concat([analyse_et( env_et = restored_et,
-                                            begin_date = begin_date,end_date = end_date,
-                                            eterna_path = eterna_path,station_name=station_name,project_name=project_name,
-                                            tmp_dir=tmp_dir,staDb_path=staDb_path,
-                                            remove_outliers=remove_outliers,force=force,otl_env=otl_env,mode=mode,parameter_name=parameter)],keys=[station_name])
-    else:
-        blq_array = _pd.concat([analyse_et( env_et = env_et,
-                                            begin_date = begin_date,end_date = end_date,
-                                            eterna_path = eterna_path,station_name=station_name,project_name=project_name,
-                                            tmp_dir=tmp_dir,staDb_path=staDb_path,
-                                            remove_outliers=remove_outliers,force=force,otl_env=otl_env,mode=mode,parameter_name=parameter)],keys=[station_name])
-    return blq_array
+        synth_otl = gen_synth_otl(dataset = env_et,station_name = station_name,hardisp_path=hardisp_path,blq_file=blq_file,sampling=sampling,
+                                  backend=otl_backend,eterna_path=eterna_path)
+        env_et = env_et + synth_otl
+    return [station_name,env_et,parameter]
+
+def _station_jobs_single_thread(values_set):
+    '''Prepares ETERNA jobs of all components of the station'''
+    eterna_path,tmp_dir,staDb_path,force = values_set[1],values_set[2],values_set[3],values_set[10]
+    station_name,env_et,parameter = _env_et_single_thread(values_set)
+    return _eterna_station_jobs(env_et = env_et,eterna_path = eterna_path,station_name=station_name,tmp_dir=tmp_dir,staDb_path=staDb_path,
+                                force=force,parameter_name=parameter)
+
+def analyze_env_single_thread(values_set):
+    '''Analyzes all components of a single station one after the other'''
+    station_jobs = _station_jobs_single_thread(values_set)
+    for job in station_jobs[3]: run_eterna(job)
+    return _extract_station(station_jobs)
+
+def _native_station_single_thread(values_set):
+    '''Prepares and analyses natively a single station. Group regressors use the tidal potential catalogue of ETERNA (eterna_path/commdat).
+    Returns its blq-like table'''
+    return _analyse_native([_env_et_single_thread(values_set)],catalogue=_potential_catalogue(values_set[1]))
+
+def _native_windows_station_single_thread(values_set_window):
+    '''Prepares a single station and analyses it natively in sliding windows. Returns its station x window x constituent table'''
+    values_set, window, step = values_set_window
+    return _analyse_native_windows([_env_et_single_thread(values_set)],window_days=window,step_days=step,
+                                   catalogue=_potential_catalogue(values_set[1]))
+
+def analyze_env_sets(sets,num_cores,engine='eterna',window=None,step=None):
+    '''Analyzes sets of analyze_env. engine is 'native' (in-process least-squares of gx_tides, every station solved in its worker)
+    or 'eterna' (every component is an independent ETERNA job in the pool, cached in tmp_dir/gd2e/eterna_cache by input content
+    so only new inputs are analysed, all if force).
+    Stations are streamed through the pool one by one so a station starts as soon as a core frees up. Sets may carry env gather
+    paths instead of envs, then workers load their own stations and memory is bounded by num_cores, not by the number of stations.
+    If window (days) is given, every station is prepared once and analysed natively in sliding windows moved by step days (window if
+    None) in its worker. Windows are on a common step grid so they align between stations.
+    Returns station x window x constituent blq-like table then'''
+    if engine not in ['native','eterna']: raise ValueError('Unknown engine {}. Use native or eterna'.format(engine))
+    if (window is not None) and (engine != 'native'): raise ValueError('Sliding window analysis is only available with native engine')
+    with Pool(num_cores) as p:
+        if window is not None:
+            step = window if step is None else step
+            return _pd.concat(list(p.imap(_native_windows_station_single_thread, [[values_set,window,step] for values_set in sets],
+                                          chunksize=1)),axis=0)
+        elif engine == 'native':
+            return _pd.concat(list(p.imap(_native_station_single_thread, sets, chunksize=1)),axis=0)
+        else:
+            stations_jobs = list(p.imap(_station_jobs_single_thread, sets, chunksize=1))
+            jobs = {}
+            for station_jobs in stations_jobs:
+                for job in station_jobs[3]:
+                    if job[3] or not _os.path.exists(_prn_path(job[2],job[1])): jobs[(job[2],job[1])] = job #identical inputs are run once
+            print('Running {} ETERNA jobs ({} cached)'.format(len(jobs),sum(len(station_jobs[3]) for station_jobs in stations_jobs) - len(jobs)))
+            p.map(run_eterna, list(jobs.values()),chunksize=1)
+    return _pd.concat([_extract_station(station_jobs) for station_jobs in stations_jobs],axis=0)
 
 def analyze_env(envs,stations_list,eterna_path,tmp_dir,staDb_path,project_name,remove_outliers,
                 restore_otl,blq_file,sampling,hardisp_path,force,num_cores,mode,otl_env,begin,end,
-                v_type='value',parameter=None,return_sets=False):
+                v_type='value',parameter=None,return_sets=False,engine='eterna',window=None,step=None,otl_backend='hardisp'):
+    '''Stations are prepared in the pool and analysed with the engine selected (see analyze_env_sets).
+    envs elements are env gathers or paths to their dumps (loaded by the workers).
+    window and step (days) switch to sliding window analysis within begin-end.
+    otl_backend is the backend of synthetic OTL (otl_env, restore_otl): hardisp or native (see gen_synth_otl)'''
     sets = []
     for i in range(len(envs)):
         sets.append([envs[i],eterna_path,tmp_dir,staDb_path,project_name,remove_outliers,
-                    restore_otl,blq_file,sampling,hardisp_path,force,mode,otl_env,begin,end,v_type,parameter])
-    num_cores = len(stations_list) if len(stations_list) < num_cores else num_cores
+                    restore_otl,blq_file,sampling,hardisp_path,force,mode,otl_env,begin,end,v_type,parameter,otl_backend])
+    num_cores = min(num_cores,len(sets)*3) #up to 3 component jobs per station
     if return_sets:
         return sets
     else:
-        with Pool(num_cores) as p:
-            blq_array = p.map(analyze_env_single_thread, sets)
-        return _pd.concat(blq_array,axis=0)
\ No newline at end of file
+        return analyze_env_sets(sets,num_cores=num_cores,engine=engine,window=window,step=step)
@@ -33,24 +33,44 @@ def _filter_clk(dataset):
     # mask =(dataset['value'].iloc[:,0].abs() > 0.01) & (dataset['value'].iloc[:,0].abs() <100)
     return dataset[mask]
     
-def filter_tdps(tdps,sigma_cut=0.1):
+def _fused_masks(dataset,sigma_cut=0.1,clk_cut=3000,margin=None,std_coeff=None):
+    '''Evaluates all filter criteria over the underlying sigma and value arrays. Returns clk mask and combined mask'''
+    sigma = dataset['sigma'].values
+    clk_mask = sigma[:,0] < clk_cut
+    mask = clk_mask & (sigma[:,[1,2,3]] <= sigma_cut).all(axis=1) #same as _filter_clk + _filter_sigma
+    if (margin is not None) or (std_coeff is not None):
+        value = dataset['value'].values
+        if margin is not None: #same as _filter_derivative
+            mask &= (_np.abs(value[:,[0,1,2]] - _np.roll(value[:,[0,1,2]],1,axis=0)) <= margin).all(axis=1)
+        if std_coeff is not None: #same as _filter_value
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                value_cut = _np.nanmedian(value,axis=0) + _np.nanstd(value,axis=0,ddof=1)*std_coeff
+            mask &= (value <= value_cut).all(axis=1)
+    return clk_mask, mask
+
+def filter_mask(dataset,sigma_cut=0.1,clk_cut=3000,margin=None,std_coeff=None):
+    '''Fused filter: clk sigma (< clk_cut), XYZ sigma (<= sigma_cut) and optional derivative (margin) and value (std_coeff) cuts in one pass.
+    Returns boolean mask of rows to keep. Derivative and value cuts are evaluated on the input rows, not on the rows left by previous cuts'''
+    return _fused_masks(dataset,sigma_cut=sigma_cut,clk_cut=clk_cut,margin=margin,std_coeff=std_coeff)[1]
+
+def _filter_single(dataset,sigma_cut,return_mask,**kwargs):
+    clk_mask, mask = _fused_masks(dataset,sigma_cut=sigma_cut,**kwargs)
+    print('Clk.Bias Filter: {:.2f} left. Sigmas Filter: {:.2f} left.'.format(clk_mask.sum()/dataset.shape[0]*100,mask.sum()/dataset.shape[0]*100))
+    return mask if return_mask else dataset[mask]
+
+def filter_tdps(tdps,sigma_cut=0.1,return_mask=False,**kwargs):
+    '''Filters a solutions DataFrame, an array of them or any iterable (generator) of chunks with the fused filter.
+    kwargs (clk_cut, margin, std_coeff) go to filter_mask. Returns filtered data or masks if return_mask. Iterables give a generator'''
     #std_coeff=3 is not used as not efficient. Used at eterna stage
-    if type(tdps) == _pd.core.frame.DataFrame:
-        clk_filter = _filter_clk(dataset = tdps,)
-        filtered_tdps = _filter_sigma(dataset = clk_filter,sigma_cut = sigma_cut)
-        print('Clk.Bias Filter: {:.2f} left. Sigmas Filter: {:.2f} left.'.format(clk_filter.shape[0]/tdps.shape[0]*100,filtered_tdps.shape[0]/tdps.shape[0]*100))
-    else:
+    if isinstance(tdps,_pd.DataFrame):
+        return _filter_single(tdps,sigma_cut,return_mask,**kwargs)
+    if isinstance(tdps,_np.ndarray):
         filtered_tdps = _np.ndarray((tdps.shape),dtype = object)
         for i in range(tdps.shape[0]):
-
-            clk_filter = _filter_clk(dataset = tdps[i])
-            sigma_filter = _filter_sigma(dataset = clk_filter,sigma_cut=sigma_cut)
-            filtered_tdps[i] = sigma_filter
-        
-            # sigma_filter = _filter_sigma(dataset = clk_filter, std_coeff=std_coeff)
-            print('Clk.Bias Filter: {:.2f} left. Sigmas Filter: {:.2f} left.'.format(clk_filter.shape[0]/tdps[i].shape[0]*100,sigma_filter.shape[0]/tdps[i].shape[0]*100))
-            # print('Clk.Bias sigma Filter (<1e8): {:.2f} left. XYZ sigma Filter (<0.1 m): {:.2f} left.'.format(filtered_tdps[i].shape[0]/tdps[i].shape[0]*100))
-    return filtered_tdps
+            filtered_tdps[i] = _filter_single(tdps[i],sigma_cut,return_mask,**kwargs)
+        return filtered_tdps
+    return (_filter_single(chunk,sigma_cut,return_mask,**kwargs) for chunk in tdps)
 
 '''30-minute averaging here'''
 def _gen_windows(dataset):
@@ -68,40 +88,41 @@ def _gen_windows(dataset):
 
     return (time_frame_out - J2000origin).astype(_np.float64)
 
-def _stretch(dataset,sampling=300):
-    '''
-    Stretches the dataset on timeline putting None values where gaps are.
-    To be consistent, takes begin of the start year as timeseries start time
-    '''
-    stretched_dataset = _np.ndarray((dataset.shape),dtype=object)
-
-    MultiIndex_columns = dataset.columns
-    timewindow  = _gen_windows(dataset)
-    df_theoretical = _pd.DataFrame(index = _np.arange(timewindow[0],timewindow[1],sampling))#input sampling of the dataset(5 mins)
-
-    dataset_tmp = dataset.copy()
-    dataset_tmp.columns = dataset.columns.to_series().values # flatten dataset columns so join won't produce warnings
-    stretched_dataset = _pd.DataFrame.join(df_theoretical,dataset_tmp)
-    stretched_dataset.columns = MultiIndex_columns #restoring columns
-    return stretched_dataset
-
-def _avg_30(dataset):
-
-    '''Expects stretched dataset'''
-    dataset_reshaped = dataset.values.reshape((int(dataset.shape[0]/6), 6 ,dataset.shape[1]))
-    first_elements_rolled = _np.roll(dataset_reshaped[:,0,:],shift=-1,axis=0) #rolling up. So first element becomes last element of previous timeframe
-    first_elements_rolled_reshaped = first_elements_rolled.reshape((first_elements_rolled.shape[0],1,first_elements_rolled.shape[1]))
-    dataset_reshaped_centered = _np.hstack((dataset_reshaped,first_elements_rolled_reshaped))
-    
-    time_margins = dataset.index[[0,-1]]
-    corrected_time_series = _np.arange(time_margins[0],time_margins[1],1800)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        avg_30 = _pd.DataFrame(_np.nanmean(dataset_reshaped_centered,axis=1), index=corrected_time_series, columns=dataset.columns)
-    return avg_30
-
-def average(solutions):
+def bin_average(dataset,sampling=300,window=1800,dense=False):
+    '''Window means computed straight from the timestamps with bincount over integer bin ids, no year-padded stretching.
+    Epochs are placed on the sampling grid starting at the begin of the first dataset's year (epochs off the grid are ignored, as _stretch did).
+    Each window mean is over [t, t+window] inclusive (window+1 samples as the former _avg_30) and labelled with t. NaNs are skipped per column.
+    Returns only windows that contain data or, if dense, all windows from the begin of the first year to the end of the last year'''
+    timewindow = _gen_windows(dataset)
+    per_window = int(window//sampling)
+    n_windows = int((timewindow[1] - timewindow[0])//window)
+
+    rel_time = dataset.index.values.astype(_np.float64) - timewindow[0]
+    on_grid = (rel_time % sampling == 0) & (rel_time < timewindow[1] - timewindow[0])
+    samples = (rel_time[on_grid]//sampling).astype(_np.int64)
+    values = dataset.values[on_grid].astype(_np.float64)
+
+    window_id = samples//per_window
+    edge = (samples % per_window == 0) & (window_id > 0) #first sample of the window also closes the previous one
+    window_id = _np.concatenate([window_id,window_id[edge] - 1])
+    values = _np.concatenate([values,values[edge]])
+
+    if dense: windows, inverse = _np.arange(n_windows), window_id
+    else: windows, inverse = _np.unique(window_id,return_inverse=True)
+    n_columns = values.shape[1]
+    valid = ~_np.isnan(values)
+    flat_id = (inverse[:,_np.newaxis]*n_columns + _np.arange(n_columns)).ravel()
+    sums = _np.bincount(flat_id,weights=_np.where(valid,values,0).ravel(),minlength=windows.shape[0]*n_columns).reshape(-1,n_columns)
+    counts = _np.bincount(flat_id,weights=valid.ravel(),minlength=windows.shape[0]*n_columns).reshape(-1,n_columns)
+    with _np.errstate(invalid='ignore',divide='ignore'):
+        means = sums/counts
+    if not dense:
+        has_data = counts.max(axis=1) > 0
+        windows, means = windows[has_data], means[has_data]
+    return _pd.DataFrame(means,index=timewindow[0] + windows*float(window),columns=dataset.columns)
+
+def average(solutions,sampling=300,window=1800,dense=True):
     averaged_solutions = _np.ndarray((solutions.shape),dtype=object)
     for i in range(averaged_solutions.shape[0]):
-        averaged_solutions[i] = _avg_30(_stretch(solutions[i]))
+        averaged_solutions[i] = bin_average(solutions[i],sampling=sampling,window=window,dense=dense)
     return averaged_solutions
@@ -0,0 +1,74 @@
+'''Vectorized geodetic utilities: XYZ <-> LLH on WGS84 and ENV rotation matrices stacked per station.
+Replaces per-station gcore EarthCoordTrans/StationDataBase calls on the analysis side. No gcore import so can be used without GipsyX install.
+staDb is read through gx_stadb so it is parsed once per staDb version (crc32 of the file)'''
+import numpy as _np
+import pandas as _pd
+
+from .gx_stadb import read_staDb as _read_staDb
+
+_A = 6378137.0 #WGS84 semi-major axis, m
+_F = 1/298.257223563 #WGS84 flattening
+_E2 = _F*(2 - _F) #first eccentricity squared
+_SECONDS_YEAR = 365.25*86400 #staDb velocities are in m/yr
+
+def llh2xyz(llh):
+    '''llh (n,3) of geodetic latitude, longitude (deg) and ellipsoidal height (m) to XYZ (n,3) in m'''
+    llh = _np.atleast_2d(_np.asarray(llh,dtype=_np.float64))
+    lat, lon = _np.deg2rad(llh[:,0]), _np.deg2rad(llh[:,1])
+    sin_lat = _np.sin(lat)
+    N = _A/_np.sqrt(1 - _E2*sin_lat**2)
+    return _np.column_stack([(N + llh[:,2])*_np.cos(lat)*_np.cos(lon),
+                             (N + llh[:,2])*_np.cos(lat)*_np.sin(lon),
+                             (N*(1 - _E2) + llh[:,2])*sin_lat])
+
+def xyz2llh(xyz,n_iter=5):
+    '''XYZ (n,3) in m to (n,3) geodetic latitude, longitude (deg) and ellipsoidal height (m).
+    Bowring initial latitude refined iteratively, 5 iterations give sub-mm heights for near-surface points'''
+    xyz = _np.atleast_2d(_np.asarray(xyz,dtype=_np.float64))
+    x, y, z = xyz[:,0], xyz[:,1], xyz[:,2]
+    p = _np.hypot(x,y)
+    lon = _np.arctan2(y,x)
+    lat = _np.arctan2(z,p*(1 - _E2))
+    for _ in range(n_iter):
+        sin_lat = _np.sin(lat)
+        N = _A/_np.sqrt(1 - _E2*sin_lat**2)
+        hgt = p/_np.cos(lat) - N
+        lat = _np.arctan2(z,p*(1 - _E2*N/(N + hgt)))
+    sin_lat = _np.sin(lat)
+    N = _A/_np.sqrt(1 - _E2*sin_lat**2)
+    hgt = p/_np.cos(lat) - N
+    return _np.column_stack([_np.rad2deg(lat),_np.rad2deg(lon),hgt])
+
+def rot_env2xyz(xyz):
+    '''Stacked (n,3,3) rotation matrices ENV -> XYZ at reference positions xyz (n,3), same as gcore rotEnv2Xyz for each station.
+    Columns are east, north and vertical unit vectors. Transpose ((0,2,1)) gives XYZ -> ENV'''
+    llh = xyz2llh(xyz)
+    lat, lon = _np.deg2rad(llh[:,0]), _np.deg2rad(llh[:,1])
+    sin_lat, cos_lat, sin_lon, cos_lon = _np.sin(lat), _np.cos(lat), _np.sin(lon), _np.cos(lon)
+    rot = _np.empty((xyz.shape[0] if _np.ndim(xyz) == 2 else 1,3,3))
+    rot[:,:,0] = _np.column_stack([-sin_lon, cos_lon, _np.zeros_like(lon)]) #east
+    rot[:,:,1] = _np.column_stack([-sin_lat*cos_lon, -sin_lat*sin_lon, cos_lat]) #north
+    rot[:,:,2] = _np.column_stack([cos_lat*cos_lon, cos_lat*sin_lon, sin_lat]) #vertical
+    return rot
+
+def rot_xyz2env(xyz):
+    '''Stacked (n,3,3) rotation matrices XYZ -> ENV'''
+    return rot_env2xyz(xyz).transpose(0,2,1)
+
+def staDb_xyz(staDb_path,epoch=3.0e8):
+    '''Station positions (Station, X, Y, Z) at epoch (J2000 seconds) from the last STATE record not later than epoch
+    (first record if all are later), velocities applied. Station order as in staDb'''
+    states = _read_staDb(staDb_path)['STATE']
+    stations = _pd.unique(states['Station'])
+    applicable = states[states['epoch'] <= epoch]
+    selected = _pd.concat([applicable.drop_duplicates('Station',keep='last'),states.drop_duplicates('Station',keep='first')]).drop_duplicates('Station',keep='first')
+    selected = selected.set_index('Station').loc[stations]
+    dt = (epoch - selected['epoch'].values)/_SECONDS_YEAR
+    xyz = selected[['X','Y','Z']].values + selected[['VX','VY','VZ']].values*dt[:,None]
+    return _pd.DataFrame({'Station':stations,'X':xyz[:,0],'Y':xyz[:,1],'Z':xyz[:,2]})
+
+def staDb_llh(staDb_path,epoch=3.0e8):
+    '''Dataframe of LAT, LON (deg), ELEV (m) indexed by station at epoch. Pure numpy version of StationDataBase.dumpLatLonHeights'''
+    xyz = staDb_xyz(staDb_path,epoch)
+    llh = xyz2llh(xyz[['X','Y','Z']].values)
+    return _pd.DataFrame(llh,index=xyz['Station'].values,columns=['LAT','LON','ELEV'])
@@ -1,3 +1,8 @@
+'''BLQ ocean tide loading coefficients and synthetic OTL displacements. BLQ files are parsed once per version (crc32 of the file)
+into indexed arrays kept in the process. Synthetic OTL is computed in-process by harmonic synthesis of the 11 BLQ waves for
+many stations and epochs at once: like hardisp, BLQ admittances are interpolated over frequency within each band to the waves of the
+tidal potential catalogue (gx_tides.potential_catalogue). hardisp binary stays the default backend, native is used on request'''
+import binascii as _binascii
 from datetime import datetime as _datetime
 from subprocess import PIPE as _PIPE
 from subprocess import Popen as _Popen
@@ -7,28 +12,55 @@ import pandas as _pd
 from pandas.compat import StringIO as _StringIO
 
 from .gx_const import J2000origin as _J2000origin
-
+from scipy.interpolate import CubicSpline as _CubicSpline
+
+from .gx_tides import _doodson_args, _groups
+from .gx_tides import design_matrix as _design_matrix
+from .gx_tides import potential_catalogue as _potential_catalogue
+
+_blq_cache = {} #crc: parsed blq
+_blq_waves = ['M2','S2','N2','K2','K1','O1','P1','Q1','MF','MM','SSA'] #column order of blq records
+_synth_cutoff = 8e-5 #smallest synthesized potential amplitude relative to M2. hardisp table stops at about 5e-5 of M2 0.632
+
+def _blq_records(blq_file):
+    '''Non-comment lines of blq file. Service rows in the end (Warnings and Errors) are dropped as some blq files have them'''
+    records = []
+    with open(blq_file,'r') as f:
+        for line in f:
+            record = line.partition('$')[0].rstrip()
+            if record.strip() and (record.strip() not in ['Warnings:','Errors:']): records.append(record)
+    if len(records)%7 != 0: raise ValueError('Unexpected number of records in {}. Expected 7 lines per station'.format(blq_file))
+    return _np.asarray(records,dtype=object).reshape(-1,7)
+
+def read_blq(blq_file):
+    '''Returns parsed blq as dict of names (stations in file order), index (station: row), blocks (6 lines of coefficients per station as text),
+    amplitude (n,3,11) in m and phase (n,3,11) in deg for up, west and south components and waves of _blq_waves.
+    Parsed once per blq crc in the process'''
+    with open(blq_file,'rb') as f:
+        crc = _binascii.crc32(f.read()) & 0xffffffff
+    if crc in _blq_cache: return _blq_cache[crc]
+
+    records = _blq_records(blq_file)
+    names = _np.asarray([name.strip() for name in records[:,0]],dtype=object)
+    values = _np.asarray(' '.join(records[:,1:].ravel()).split(),dtype=_np.float64).reshape(-1,6,len(_blq_waves))
+    parsed = {'crc':crc,'names':names,'index':{name:i for i,name in enumerate(names)},
+              'blocks':_np.asarray(['\n'.join(block) for block in records[:,1:]],dtype=object),
+              'amplitude':values[:,:3],'phase':values[:,3:]}
+    _blq_cache[crc] = parsed
+    return parsed
+
+def _blq_rows(blq,stations):
+    '''Rows of stations in parsed blq'''
+    missing = [station for station in stations if station not in blq['index']]
+    if missing: raise ValueError('No blq records for {}'.format(', '.join(missing)))
+    return _np.asarray([blq['index'][station] for station in stations],dtype=int)
 
 def blq2hardisp(blq_file):
-    blq_file = _pd.read_csv(blq_file, comment='$', header=None)#[:-2].values
-    #we should be ready for different formats: with and without service rows in the end. Namely: Warnings and Errors
-    blq_raw = blq_file.squeeze()
-    blq_file_read = (blq_raw[(blq_raw!='Warnings:') & (blq_raw!='Errors:')]).values
-    
-    n_stations = int(blq_file_read.shape[0] / 7)
-
-    sites = (_pd.Series(blq_file_read.reshape(
-        (n_stations, 7))[:, 0])).str.strip()
-
-    blq_raw = _pd.Series(blq_file_read.reshape((n_stations, 7))[
-                            :, 1:].reshape((n_stations * 6)))
-    blq_data = blq_raw.values.reshape((n_stations, 6))
-
-    out = _np.ndarray((n_stations, 2), dtype='object')
-    for i in range(n_stations):
-        out[i, 0] = sites[i]
-        out[i, 1] = _pd.Series(blq_data[i]).to_string(index=False, header=False)
-
+    '''(n,2) object array of station name and its 6 lines of blq coefficients as text (hardisp input)'''
+    blq = read_blq(blq_file)
+    out = _np.ndarray((blq['names'].shape[0], 2), dtype='object')
+    out[:,0] = blq['names']
+    out[:,1] = blq['blocks']
     return out
 
 def reformat_blq(blq_string):
@@ -47,15 +79,93 @@ def reformat_blq(blq_string):
 
     return amplitude.to_string(header=None,index=None).replace("  "," ") + '\n' + phase
 
-def gen_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling):
-    '''Expects stretched dataset. Otherwise can get wrong sampling. Outputs (T, E, N, V) array'''
-    _pd.options.display.max_colwidth = 200 #By default truncates text
-    begin_J2000 = dataset.index[0];end_J2000 = dataset.index[-1]
-    begin = (begin_J2000.astype(int) + _J2000origin).astype(_datetime)
-    # end = (end_J2000.astype(int) + _J2000origin).astype(_datetime)
-    n_observations = int((end_J2000-begin_J2000)/sampling)+1
-    input_blq = blq2hardisp(blq_file)
-    input_blq = input_blq[input_blq[:,0] == station_name][0][1]
+def _blq_coeff(blq_file,stations):
+    '''Complex BLQ coefficients amplitude*exp(-i*phase) (n_stations, 3, 11) of east, north, up in mm'''
+    blq = read_blq(blq_file)
+    rows = _blq_rows(blq,list(stations))
+    amplitude = blq['amplitude'][rows][:,[1,2,0]]*1000 #west, south, up in mm
+    amplitude *= _np.asarray([-1,-1,1])[:,_np.newaxis] #west, south to east, north. Same as GipsyX does correction (no otl - otl_corrected)
+    return amplitude*_np.exp(-1j*_np.deg2rad(blq['phase'][rows][:,[1,2,0]]))
+
+def _synth_waves(catalogue):
+    '''Long-period, diurnal and semidiurnal catalogue waves to synthesize (permanent tide and waves below _synth_cutoff of the largest
+    amplitude dropped, as in hardisp table) and catalogue rows of the main waves of _blq_waves'''
+    multipliers = catalogue[['k1','k2','k3','k4','k5','k6']].values
+    amplitude = catalogue['amplitude'].values
+    keep = (catalogue['k1'].values <= 2) & (_np.abs(multipliers).sum(axis=1) > 0) & (_np.abs(amplitude) >= _synth_cutoff*_np.abs(amplitude).max())
+    waves = catalogue[keep].reset_index(drop=True)
+    main_multipliers = _np.asarray([[group.t_s,group.s + group.t_s,group.h - group.t_s,group.p,0,0]
+                                     for group in _groups.loc[_blq_waves].itertuples()]) #t_s = tau + s - h
+    main = [_np.flatnonzero((waves[['k1','k2','k3','k4','k5','k6']].values == m).all(axis=1)) for m in main_multipliers]
+    missing = [wave for wave,rows in zip(_blq_waves,main) if rows.shape[0] == 0]
+    if missing: raise ValueError('No {} in tidal potential catalogue'.format(', '.join(missing)))
+    return waves, _np.asarray([rows[0] for rows in main])
+
+def _wave_offset(waves):
+    '''Phase (deg) added to Doodson argument of catalogue waves: -90 for diurnal (sine) waves and 180 for negative amplitudes'''
+    return _np.where(waves['k1'].values == 1,-90.0,0.0) + _np.where(waves['amplitude'].values < 0,180.0,0.0)
+
+def admittance(blq_file,stations,catalogue):
+    '''Catalogue waves (see _synth_waves) and complex displacement coefficients (n_waves, n_stations, 3) in mm of each wave for
+    exp(i*(Doodson argument + _wave_offset)). Admittance (blq coefficient over potential amplitude, in the phase convention of the
+    catalogue wave) of the 11 blq waves is interpolated over frequency within each band to all waves of the band: linearly for
+    long-period and by cubic spline for diurnal and semidiurnal waves, as hardisp does'''
+    waves, main = _synth_waves(catalogue)
+    coeff = _blq_coeff(blq_file,stations)
+    main_waves = waves.iloc[main]
+    #ARG2 argument of blq wave is Doodson argument + group offset, so blq phase is moved by offset - _wave_offset
+    shift = _np.exp(1j*_np.deg2rad(_groups.loc[_blq_waves,'offset'].values - _wave_offset(main_waves)))
+    main_admittance = _np.moveaxis(coeff*shift/_np.abs(main_waves['amplitude'].values),2,0) #(11, n_stations, 3)
+
+    wave_admittance = _np.empty((waves.shape[0],) + main_admittance.shape[1:],dtype=_np.complex128)
+    for band in [0,1,2]:
+        in_band = _np.flatnonzero(main_waves['k1'].values == band)
+        order = in_band[_np.argsort(main_waves['freq'].values[in_band])]
+        freq, values = main_waves['freq'].values[order], main_admittance[order]
+        targets = _np.flatnonzero(waves['k1'].values == band)
+        target_freq = waves['freq'].values[targets]
+        if band == 0: #linear, extrapolated by the end segments
+            segment = _np.clip(_np.searchsorted(freq,target_freq) - 1,0,freq.shape[0] - 2)
+            weight = ((target_freq - freq[segment])/(freq[segment + 1] - freq[segment]))[:,_np.newaxis,_np.newaxis]
+            wave_admittance[targets] = values[segment]*(1 - weight) + values[segment + 1]*weight
+        else:
+            wave_admittance[targets] = (_CubicSpline(freq,values.real,bc_type='natural')(target_freq)
+                                        + 1j*_CubicSpline(freq,values.imag,bc_type='natural')(target_freq))
+    return waves, wave_admittance*_np.abs(waves['amplitude'].values)[:,_np.newaxis,_np.newaxis]
+
+def synth_otl(time,stations,blq_file,catalogue=None,chunk=8192):
+    '''Synthetic OTL displacements (n_time, n_stations, 3) of east, north and up in mm for time (J2000 seconds) from blq coefficients.
+    With catalogue (gx_tides.potential_catalogue) all catalogue waves are synthesized with admittances interpolated from the 11 blq
+    waves (see admittance), as hardisp does. Without it only the 11 blq waves are summed as amplitude*f*cos(V + u - phase) with nodal
+    corrections, which misses the minor waves. Epochs are processed in chunks to bound memory'''
+    time = _np.asarray(time,dtype=_np.float64)
+    if catalogue is None:
+        coeff = _blq_coeff(blq_file,stations)
+        coeff = _np.stack([coeff.real,-coeff.imag],axis=3).reshape(coeff.shape[0]*3,-1) #a = amplitude*cos(phase), b = amplitude*sin(phase)
+        A = _design_matrix(time,_groups.loc[_blq_waves])[:,2:] #no offset and trend
+        return A.dot(coeff.T).reshape(time.shape[0],-1,3)
+
+    waves, coeff = admittance(blq_file,stations,catalogue)
+    multipliers = waves[['k1','k2','k3','k4','k5','k6']].values.T
+    offset = _wave_offset(waves)
+    coeff = coeff.reshape(coeff.shape[0],-1)
+    otl = _np.empty((time.shape[0],coeff.shape[1]))
+    for begin in range(0,time.shape[0],chunk):
+        arg = _np.deg2rad(_doodson_args(time[begin:begin + chunk]).dot(multipliers) + offset)
+        otl[begin:begin + chunk] = _np.cos(arg).dot(coeff.real) - _np.sin(arg).dot(coeff.imag)
+    return otl.reshape(time.shape[0],-1,3)
+
+def synth_otl_df(time,stations,blq_file,catalogue=None):
+    '''Synthetic OTL of many stations as dataframe indexed by time with (station, east/north/up) columns'''
+    otl = synth_otl(time,stations,blq_file,catalogue)
+    return _pd.DataFrame(otl.reshape(otl.shape[0],-1),index=time,
+                         columns=_pd.MultiIndex.from_product([list(stations),['east','north','up']]))
+
+def _hardisp_synth_otl(begin_J2000,n_observations,station_name,hardisp_path,blq_file,sampling):
+    '''Runs hardisp for the station. Returns dU, dS, dW dataframe in mm'''
+    begin = (_np.asarray(begin_J2000).astype(int) + _J2000origin).astype(_datetime)
+    blq = read_blq(blq_file)
+    input_blq = blq['blocks'][_blq_rows(blq,[station_name])[0]]
 
     '''Takes datetime.datetime format'''
     process = _Popen([hardisp_path, 
@@ -68,16 +178,32 @@ def gen_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling):
                                 stdin=_PIPE, stdout=_PIPE, stderr=_PIPE)
     out = _StringIO((process.communicate(input=reformat_blq(input_blq).encode())[0]).decode())
     
-    synth_otl = _pd.read_csv(out, error_bad_lines=False, header=None,
+    return _pd.read_csv(out, error_bad_lines=False, header=None,
                            delim_whitespace=True, names=['dU', 'dS', 'dW']) *1000 #convert to mm as returns in m
 
-    tmp = _pd.DataFrame()
+def gen_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling,backend='hardisp',eterna_path=None):
+    '''Expects stretched dataset. Otherwise can get wrong sampling. Outputs east, north, up dataframe in mm indexed by J2000 time.
+    backend is hardisp (runs hardisp_path binary) or native (in-process synthesis with the potential catalogue of eterna_path)'''
+    begin_J2000 = dataset.index[0];end_J2000 = dataset.index[-1]
     index=_np.arange(begin_J2000,end_J2000+1,sampling)
+    if backend == 'native':
+        catalogue = _potential_catalogue(eterna_path)
+        if catalogue is None: raise ValueError('native backend needs tidal potential catalogue. Set eterna_path')
+        return _pd.DataFrame(synth_otl(index,[station_name],blq_file,catalogue)[:,0],index=index,columns=['east','north','up'])
+    if backend != 'hardisp': raise ValueError('Unknown backend {}. Use hardisp or native'.format(backend))
 
-
-    tmp['east'] = synth_otl['dW']*-1 #Conversion to dE. Already checked that it is a correct way (phases) as same as GipsyX does correction (no otl - otl_corrected)
-    tmp['north'] = synth_otl['dS']*-1 #Convertion to dN
-    tmp['up'] = synth_otl['dU']
-    synth_otl['Time']=_pd.Series(_np.arange(begin_J2000,end_J2000+1,sampling))
+    n_observations = int((end_J2000-begin_J2000)/sampling)+1
+    synth_otl_hardisp = _hardisp_synth_otl(begin_J2000,n_observations,station_name,hardisp_path,blq_file,sampling)
+    tmp = _pd.DataFrame()
+    tmp['east'] = synth_otl_hardisp['dW']*-1 #Conversion to dE. Already checked that it is a correct way (phases) as same as GipsyX does correction (no otl - otl_corrected)
+    tmp['north'] = synth_otl_hardisp['dS']*-1 #Convertion to dN
+    tmp['up'] = synth_otl_hardisp['dU']
     hardisp = tmp.set_index(index)
     return hardisp
+
+def verify_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling,eterna_path):
+    '''Compares native synthetic OTL with hardisp for the station. Returns rms of hardisp, rms and max abs of differences (mm) per component'''
+    native = gen_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling,backend='native',eterna_path=eterna_path)
+    hardisp = gen_synth_otl(dataset,station_name,hardisp_path,blq_file,sampling,backend='hardisp')
+    diff = native - hardisp
+    return _pd.DataFrame({'hardisp_rms':(hardisp**2).mean()**0.5,'diff_rms':(diff**2).mean()**0.5,'diff_max':diff.abs().max()})
@@ -3,84 +3,261 @@ import glob as _glob, os as _os, sys as _sys
 import pandas as _pd
 import numpy as _np
 from multiprocessing import Pool as _Pool
-from .gx_aux import uncompress
-from shutil import rmtree as _rmtree, copy as _copy
+from .gx_aux import _dump_read, _dump_write
+from .gx_compress import read_bytes as _read_bytes, decompress_file as _decompress_file
 import tqdm as _tqdm
 
-re_begin = _re.compile(rb"START\sOF\s(TEC.+\n|RMS.+\n)")
-re_end =   _re.compile(rb"END\sOF\s(TEC.+\n|RMS.+\n)")
-
 def prep_ionex_file(file_path, cache_path):
-    file_name = _os.path.basename(file_path)
-    tmp_cache_path = _os.path.abspath(_os.path.join(cache_path,file_name)) #create tmp folder in cache
-    if not _os.path.exists(tmp_cache_path):
-        _os.makedirs(tmp_cache_path)
-
-    _copy(src = file_path, dst = tmp_cache_path) #copy .Z file to cache
-    cached_file_path = _os.path.abspath(_os.path.join(tmp_cache_path,_os.path.basename(file_path)))
-    uncompress(cached_file_path)
-    
-
-    file_path = _os.path.join(_os.path.dirname(cached_file_path),_os.path.splitext(file_name)[0])
-    return file_path
-
-def GIM_data_extraction(in_set):
-    # Extracting ionex data from file
+    '''Decompresses IONEX file straight from the archive into cache_path (tmpfs) without copying the compressed file first'''
+    if not _os.path.exists(cache_path):
+        _os.makedirs(cache_path)
+    return _decompress_file(file_path,out_path=_os.path.abspath(cache_path))
+
+'''Numeric IONEX reader. Maps are kept as int16 arrays (epoch x lat x lon) in units of 10**exponent TECU'''
+_MAP_KINDS = {b'TEC':1, b'RMS':2, b'HEIGHT':3}
+_MAP_LABELS = [b'EPOCH OF CURRENT MAP', b'LAT/LON1/LON2/DLON/H', b'EXPONENT'] \
+            + [b'START OF ' + kind + b' MAP' for kind in _MAP_KINDS] + [b'END OF ' + kind + b' MAP' for kind in _MAP_KINDS]
+
+def _ionex_lines(ionex_data):
+    '''Splits IONEX bytes into fixed-width S80 array and returns it together with stripped labels (columns 61-80)'''
+    lines = _np.asarray(ionex_data.splitlines(),dtype='S80')
+    labels = lines.view(_np.uint8).reshape((lines.shape[0],80))[:,60:].copy().view('S20').ravel()
+    return lines, _np.char.strip(labels)
+
+def _ionex_header_values(lines,labels,label,n_values,default=None):
+    '''Returns floats from the first 60 columns of the header line with label specified'''
+    idx = _np.where(labels == label)[0]
+    if idx.shape[0] == 0:
+        if default is None: raise ValueError('{} record not found in IONEX header'.format(label.decode()))
+        return default
+    values = lines[idx[0]].split()[:n_values]
+    return _np.asarray(values).astype(float)
+
+def _ionex_grid(start,stop,step):
+    return start + _np.arange(int(round((stop-start)/step))+1)*step
+
+def _ionex_epochs(epoch_lines):
+    '''Vectorized conversion of EPOCH OF CURRENT MAP records to datetime64[s]'''
+    ymdhms = _np.asarray(b' '.join(epoch_lines.view(_np.uint8).reshape((epoch_lines.shape[0],80))[:,:36].copy().view('S36').ravel()).split(),dtype=_np.int64).reshape((-1,6))
+    months = (ymdhms[:,0]-1970).astype('datetime64[Y]').astype('datetime64[M]') + (ymdhms[:,1]-1).astype('timedelta64[M]')
+    return months.astype('datetime64[s]') + (ymdhms[:,2]-1).astype('timedelta64[D]') + ymdhms[:,3].astype('timedelta64[h]')\
+                                        + ymdhms[:,4].astype('timedelta64[m]') + ymdhms[:,5].astype('timedelta64[s]')
+
+def read_ionex(file_path):
+    '''Reads .Z, .gz or decompressed IONEX file in-process and returns a dict with TEC and RMS maps as int16 arrays (epoch x lat x lon)
+    Keys: epoch, lat, lon, hgt, exponent, tec, rms (None if not present), header (bytes up to END OF HEADER)'''
+    ionex_data = _read_bytes(file_path)
+    lines, labels = _ionex_lines(ionex_data)
+
+    end_of_header = _np.where(labels == b'END OF HEADER')[0]
+    if end_of_header.shape[0] == 0: raise ValueError('{} has no END OF HEADER record'.format(file_path))
+    end_of_header = end_of_header[0]
+    header = b'\n'.join(ionex_data.splitlines()[:end_of_header+1]) + b'\n'
+    h_lines, h_labels = lines[:end_of_header+1], labels[:end_of_header+1]
+
+    lat = _ionex_grid(*_ionex_header_values(h_lines,h_labels,b'LAT1 / LAT2 / DLAT',3))
+    lon = _ionex_grid(*_ionex_header_values(h_lines,h_labels,b'LON1 / LON2 / DLON',3))
+    hgt = _ionex_header_values(h_lines,h_labels,b'HGT1 / HGT2 / DHGT',3)[0]
+    exponent = int(_ionex_header_values(h_lines,h_labels,b'EXPONENT',1,default=_np.asarray([-1]))[0])
+
+    # map kind (TEC/RMS/HEIGHT) of every line is forward-filled from the START OF ... MAP records
+    starts = _np.zeros(labels.shape[0],dtype=_np.int8)
+    ends = _np.zeros(labels.shape[0],dtype=_np.int8)
+    for kind in _MAP_KINDS:
+        starts[labels == b'START OF ' + kind + b' MAP'] = _MAP_KINDS[kind]
+        ends[labels == b'END OF ' + kind + b' MAP'] = 1
+    inside = (_np.cumsum((starts>0).astype(_np.int64) - ends) + ends) == 1
+    kind = starts[_np.maximum.accumulate(_np.where(starts>0,_np.arange(starts.shape[0]),0))]
+    data_lines = inside & ~_np.isin(labels,_MAP_LABELS)
+
+    maps = {}
+    for kind_name in [b'TEC',b'RMS']:
+        kind_mask = kind == _MAP_KINDS[kind_name]
+        n_maps = (starts == _MAP_KINDS[kind_name]).sum()
+        if n_maps == 0:
+            maps[kind_name] = None
+            continue
+        values = _np.asarray(b' '.join(lines[kind_mask & data_lines]).split(),dtype=_np.int16)
+        if values.shape[0] != n_maps*lat.shape[0]*lon.shape[0]:
+            raise ValueError('{}: {} {} values found, {} expected from header grid'.format(file_path,values.shape[0],kind_name.decode(),n_maps*lat.shape[0]*lon.shape[0]))
+        maps[kind_name] = values.reshape((n_maps,lat.shape[0],lon.shape[0]))
+
+    epoch = _ionex_epochs(lines[(labels == b'EPOCH OF CURRENT MAP') & (kind == _MAP_KINDS[b'TEC'])])
+    return {'epoch':epoch,'lat':lat,'lon':lon,'hgt':hgt,'exponent':exponent,'tec':maps[b'TEC'],'rms':maps[b'RMS'],'header':header}
+
+def get_gim(in_set):
+    '''Returns read_ionex output for the IONEX file specified. Parsed maps are cached per day in gim_cache_dir as a compact zstd dump
+    that is reused while newer than the source file. in_set is [file_path, gim_cache_dir]'''
     file_path = in_set[0]
-    cache_path = in_set[1]
-    
-    
-    
-    file = prep_ionex_file(file_path, cache_path)
-
-    with open (file, 'rb') as ionex:
-        ionex_data = ionex.read()
-        GIM_match_begin = [];GIM_match_end = []
-        
-        matches_begin = _re.finditer(re_begin, ionex_data)
-        matches_end   = _re.finditer(re_end, ionex_data)
-
-        for matchNum, match in enumerate(matches_begin):
-            GIM_match_begin.append(match.end())
-
-        for matchNum, match in enumerate(matches_end):
-            GIM_match_end.append(match.start()-60) #60 is the number of symbols from the end of the map to marker
-            
-        frame_n = len(GIM_match_begin)//2
-        GIM_boundaries_b = _np.asarray(GIM_match_begin).reshape((2,frame_n))
-        GIM_boundaries_e = _np.asarray(GIM_match_end).reshape((2,frame_n))
-        
-        TEC = RMS = _np.ndarray((frame_n),dtype=object)
-
-        for i in range(frame_n):
-            TEC[i] = ionex_data[GIM_boundaries_b[0,i]:GIM_boundaries_e[0,i]].decode('ascii')
-            RMS[i] = ionex_data[GIM_boundaries_b[1,i]:GIM_boundaries_e[1,i]].decode('ascii')
-            
-        Datetime = _pd.to_datetime(_pd.Series(TEC).str.slice(2,36),format= '%Y %m %d %H %M %S')
-#         print (_pd.concat((Datetime,_pd.Series(TEC),_pd.Series(RMS)),axis=1).head())
-    _rmtree(_os.path.dirname(file)) #clean tmp
-    return _pd.concat((Datetime,_pd.Series(TEC),_pd.Series(RMS)),axis=1)
+    gim_cache_dir = in_set[1]
+
+    cache_file = _os.path.join(gim_cache_dir,_os.path.splitext(_os.path.basename(file_path))[0]+'.zstd') #igsg0010.15i.Z -> igsg0010.15i.zstd
+    if _os.path.exists(cache_file) and (_os.path.getmtime(cache_file) >= _os.path.getmtime(file_path)):
+        return _dump_read(cache_file)
+    gim = read_ionex(file_path)
+    if not _os.path.exists(gim_cache_dir): _os.makedirs(gim_cache_dir)
+    tmp_file = cache_file + '.{}.tmp'.format(_os.getpid()) #renaming is atomic so parallel readers never see partial cache
+    _dump_write(filename=tmp_file,data=gim,num_cores=1,cname='zstd')
+    _os.replace(tmp_file,cache_file)
+    return gim
+
+def merge_gims(gims):
+    '''Concatenates GIM dicts along epoch. Duplicate epochs (00:00 map of the day present in both neighbouring files) are removed
+    keeping the map from the later file as the original text merge did'''
+    for gim in gims[1:]:
+        if (not _np.array_equal(gim['lat'],gims[0]['lat'])) or (not _np.array_equal(gim['lon'],gims[0]['lon'])) or (gim['exponent'] != gims[0]['exponent']):
+            raise ValueError('IONEX grids or exponents differ. Can not merge')
+    epoch = _np.concatenate([gim['epoch'] for gim in gims])
+    order = _np.argsort(epoch,kind='mergesort') #stable so file order is preserved for equal epochs
+    keep = order[_np.append(epoch[order][1:] != epoch[order][:-1],True)]
+
+    merged = dict(gims[0])
+    merged['epoch'] = epoch[keep]
+    merged['tec'] = _np.concatenate([gim['tec'] for gim in gims])[keep]
+    merged['rms'] = _np.concatenate([gim['rms'] for gim in gims])[keep] if all(gim['rms'] is not None for gim in gims) else None
+    merged['header_last'] = gims[-1]['header']
+    return merged
+
+def subset_gim(gim,begin=None,end=None):
+    '''Returns GIM with maps in [begin, end] window. begin and end are anything numpy.datetime64 accepts'''
+    mask = _np.ones(gim['epoch'].shape,dtype=bool)
+    if begin is not None: mask &= gim['epoch'] >= _np.datetime64(begin)
+    if end is not None: mask &= gim['epoch'] <= _np.datetime64(end)
+    subset = dict(gim)
+    subset['epoch'] = gim['epoch'][mask]
+    subset['tec'] = gim['tec'][mask]
+    subset['rms'] = gim['rms'][mask] if gim['rms'] is not None else None
+    return subset
+
+def gim_gaps(gim,interval=None):
+    '''QA of the GIM timeline. Returns DataFrame with gap begin, end and number of missing maps.
+    interval (seconds) is taken as the most common epoch difference if not specified'''
+    epoch = gim['epoch']
+    delta = _np.diff(epoch).astype('timedelta64[s]').astype(_np.int64)
+    if interval is None:
+        values,counts = _np.unique(delta,return_counts=True)
+        interval = values[counts.argmax()] if values.shape[0]>0 else 0
+    gaps = _np.where(delta > interval)[0]
+    return _pd.DataFrame({'begin':epoch[gaps],'end':epoch[gaps+1],'missing':delta[gaps]//interval - 1 if interval>0 else 0})
+
+def gim_duplicates(gim):
+    '''Returns epochs that are present more than once (e.g. midnight maps in unmerged concatenations)'''
+    values,counts = _np.unique(gim['epoch'],return_counts=True)
+    return values[counts>1]
+
+
+
+'''Merged IONEX writer. Maps are formatted from GIM arrays and streamed to disk'''
+_regex_first_epoch = _re.compile(rb"EPOCH\sOF\sFIRST\sMAP\s*\n")
+_regex_num_maps_b = _re.compile(rb"INTERVAL\s{12}\n")
+_regex_num_maps_e = _re.compile(rb"#\sOF\sMAPS\sIN\sFILE\s{3}\n")
+_regex_aux_start = _re.compile(rb"DIFFERENTIAL\sCODE\sBIASES\s+START\sOF\sAUX\sDATA")
+_regex_aux_end = _re.compile(rb"DIFFERENTIAL CODE BIASES\s+END OF AUX DATA\s+\n")
+_regex_end_header = _re.compile(rb"END\sOF\sHEADER\s+\n")
+
+def _gim_header(header_first,header_last,n_maps):
+    '''Merged header: EPOCH OF FIRST MAP from the first file, the rest from the last file.
+    No AUX section in the header needed! IGNORING IT. LINE with # of MAPS is modified'''
+    num_maps = '{:6d}{:<54s}{}{:<3s}\n'.format(n_maps,' ','# OF MAPS IN FILE',' ').encode('ascii')
+    match_first_epoch = _re.search(_regex_first_epoch, header_first)
+    match_last_epoch = _re.search(_regex_first_epoch, header_last) #EPOCH OF LAST MAP (LAST FILE to continue the header as headers can have different line quantity)
+    match_num_maps_b = _re.search(_regex_num_maps_b, header_last)
+    match_num_maps_e = _re.search(_regex_num_maps_e, header_last)
+    match_aux_begin = _re.search(_regex_aux_start, header_last)
+    match_aux_end = _re.search(_regex_aux_end, header_last)
+    match_end_header = _re.search(_regex_end_header, header_last)
+
+    rest = header_last[match_num_maps_e.end():match_end_header.end()]
+    if (match_aux_begin is not None) and (match_aux_end is not None): #jpl files have no DCB aux section
+        rest = header_last[match_num_maps_e.end():match_aux_begin.start()] + header_last[match_aux_end.end():match_end_header.end()]
+    return header_first[:match_first_epoch.end()] + header_last[match_last_epoch.end():match_num_maps_b.end()] + num_maps + rest
+
+def _gim_map_template(lat,lon,hgt):
+    '''Returns %-template of a single map body (LAT/LON1/LON2/DLON/H records + 16 I5 values per line) for the grid'''
+    n_lon = lon.shape[0]
+    values = ('%5d'*16 + '\n')*(n_lon//16) + (('%5d'*(n_lon%16) + '\n') if n_lon%16 else '')
+    return ''.join('  {:6.1f}{:6.1f}{:6.1f}{:6.1f}{:6.1f}{:28s}LAT/LON1/LON2/DLON/H\n'.format(lat_band,lon[0],lon[-1],lon[1]-lon[0],hgt,'') + values
+                   for lat_band in lat)
+
+def _write_merged_ionex(write_set):
+    '''Merges cached daily GIMs and streams the merged IONEX file to disk. The file is written to a tmp name and renamed on success.
+    Byte offsets of every TEC and RMS map are saved to index_path as csv so a time window can be read with seek.
+    write_set is [merged_file_path, index_path, gim_sets]'''
+    merged_file_path, index_path, gim_sets = write_set
+    gim = merge_gims([get_gim(gim_set) for gim_set in gim_sets])
+    n_maps = gim['epoch'].shape[0]
+    template = _gim_map_template(gim['lat'],gim['lon'],gim['hgt'])
+    epoch = gim['epoch'].astype('datetime64[s]')
+    epoch_fields = _np.column_stack([epoch.astype('datetime64[Y]').astype(int)+1970,
+                                     epoch.astype('datetime64[M]').astype(int)%12+1,
+                                     (epoch.astype('datetime64[D]')-epoch.astype('datetime64[M]')).astype(int)+1,
+                                     (epoch.astype('datetime64[h]')-epoch.astype('datetime64[D]')).astype(int),
+                                     (epoch.astype('datetime64[m]')-epoch.astype('datetime64[h]')).astype(int),
+                                     (epoch-epoch.astype('datetime64[m]')).astype(int)])
+
+    offsets = _np.zeros((2,n_maps+1),dtype=_np.int64)
+    tmp_path = merged_file_path + '.{}.tmp'.format(_os.getpid())
+    with open(tmp_path,'wb') as output:
+        offset = output.write(_gim_header(gim['header'],gim['header_last'],n_maps))
+        for k,(kind,maps) in enumerate((('TEC',gim['tec']),('RMS',gim['rms']))):
+            if maps is None: continue
+            for j in range(n_maps):
+                offsets[k,j] = offset
+                offset += output.write(('{:6d}{:<54s}START OF {} MAP{:<4s}\n'.format(j+1,' ',kind,' ')
+                                       + '{:6d}{:6d}{:6d}{:6d}{:6d}{:6d}{:<24s}EPOCH OF CURRENT MAP\n'.format(*(tuple(epoch_fields[j].tolist()) + (' ',)))
+                                       + template % tuple(maps[j].ravel().tolist())
+                                       + '{:6d}{:<54s}END OF {} MAP{:<6s}\n'.format(j+1,' ',kind,' ')).encode('ascii'))
+            offsets[k,n_maps] = offset
+        output.write('{:<60s}{}{:<9s}\n'.format(' ','END OF FILE',' ').encode('ascii'))
+    _os.replace(tmp_path,merged_file_path)
+
+    index = _pd.DataFrame({'epoch':epoch,'tec_begin':offsets[0,:-1],'tec_end':offsets[0,1:],'rms_begin':offsets[1,:-1],'rms_end':offsets[1,1:]})
+    index.to_csv(index_path,index=False)
+    return merged_file_path
+
+def _cache_gim(in_set):
+    '''Runs get_gim only to populate the per-day cache. Returns path so no arrays are pickled back'''
+    get_gim(in_set)
+    return in_set[0]
+
+def read_merged_index(index_path):
+    return _pd.read_csv(index_path,parse_dates=['epoch'])
+
+def read_merged_window(merged_file_path,index_path,begin=None,end=None,kind='TEC'):
+    '''Returns raw bytes of merged IONEX maps (kind = TEC or RMS) within [begin, end] using byte offsets index. No parsing of the file'''
+    index = read_merged_index(index_path)
+    mask = _np.ones(index.shape[0],dtype=bool)
+    if begin is not None: mask &= index['epoch'] >= _pd.Timestamp(begin)
+    if end is not None: mask &= index['epoch'] <= _pd.Timestamp(end)
+    selected = index[mask]
+    if selected.shape[0] == 0: return b''
+    begin_offset, end_offset = selected['{}_begin'.format(kind.lower())].iloc[0], selected['{}_end'.format(kind.lower())].iloc[-1]
+    with open(merged_file_path,'rb') as merged:
+        merged.seek(begin_offset)
+        return merged.read(end_offset-begin_offset)
 
 
 class ionex:
-    '''FILES SHOULD BE DECOMPRESSED PRIOR TO PROCESSING. As for the script as for GipsyX processing if fetched by one file'''
+    '''Daily files are decompressed and parsed in-process (see read_ionex). Parsed maps are cached in IONEX_cache next to IONEX_merged'''
     
     def __init__(self,
                 ionex_prods_dir,#='/mnt/Data/bogdanm/Products/IONEX_Products', #IONEX dir
                 ionex_type, #='igs', #type of files
                 num_cores,
                 cache_path,
-                tqdm): #we take cache_path as files will be copied and decompressed before read
+                tqdm): #cache_path is kept for compatibility. Parsed daily maps are cached in gim_cache_path
         self.ionex_type = ionex_type #add checker here
         self.ionex_prods_dir = _os.path.abspath(ionex_prods_dir)
         self.output_path = _os.path.abspath(_os.path.join(self.ionex_prods_dir,_os.pardir))
         self.num_cores = num_cores    
         self.cache_path = cache_path
+        self.gim_cache_path = _os.path.join(self.output_path,'IONEX_cache',self.ionex_type) #parsed daily maps
         self.tqdm = tqdm
              
 
-    def get_merge_lists(self):
-        return self._create_lists4merge(self._extended_list(),self.years_present())
+    def get_merge_lists(self,extended_list=None):
+        extended_list = self._extended_list() if extended_list is None else extended_list
+        return self._create_lists4merge(extended_list,extended_list.iloc[:,0].unique())
 
     def _extended_list(self):
         if self.ionex_type == 'jpl': #jpl is jpl_native by default
@@ -98,8 +275,8 @@ class ionex:
     def years_present(self):
         return self._extended_list().iloc[:,0].unique()
 
-    def _get_ionex_list(self,year):
-        extended_list = self._extended_list()
+    def _get_ionex_list(self,year,extended_list=None):
+        extended_list = self._extended_list() if extended_list is None else extended_list
         if len(extended_list[extended_list.iloc[:,0]==year-1])==0 & len(extended_list[extended_list.iloc[:,0]==year+1])==0:
             list_files_out =  extended_list[extended_list.iloc[:,0]==year]
 
@@ -119,131 +296,59 @@ class ionex:
     def _create_lists4merge(self,ionex_files_list,years_present):
         merge_lists = _np.ndarray((len(years_present)),dtype=object)
         for i in range(len(years_present)):
-            merge_lists[i]=self._get_ionex_list(years_present[i])
+            merge_lists[i]=self._get_ionex_list(years_present[i],extended_list=ionex_files_list)
         return merge_lists
-    
-           
-        
-    def _GIM_gen_header(self,in_set,data_GIM_final):
-        file_paths = in_set[:,3]
-        cache_paths = in_set[:,4]
-        
-        
-        '''
-        No AUX section in the header needed! IGNORING IT
-        LINE with # of MAPS is modified
-        '''
-        num_maps = '{:6d}{:<54s}{}{:<3s}\n'.format(len(data_GIM_final),' ','# OF MAPS IN FILE',' ')
-        regex_first_epoch = (rb"EPOCH\sOF\sFIRST\sMAP\s*\n")
-
-
-        regex_num_maps_b = (rb"INTERVAL\s{12}\n")
-        regex_num_maps_e = (rb"#\sOF\sMAPS\sIN\sFILE\s{3}\n")
-
-
-        regex_aux_start =   (rb"DIFFERENTIAL\sCODE\sBIASES\s+START\sOF\sAUX\sDATA")
-        regex_aux_end   =   (rb"DIFFERENTIAL CODE BIASES\s+END OF AUX DATA\s+\n")
-
-        regex_end_header =  (rb"END\sOF\sHEADER\s+\n")
-
-        #extracting header part from the first document
-        first_file_path = prep_ionex_file(file_paths[0], cache_paths[0])
-        
-        with open (first_file_path,'rb') as ionex_first:
-            ionex_data_first = ionex_first.read()
-
-            match_first_epoch = _re.search(regex_first_epoch, ionex_data_first)
-        _rmtree(_os.path.dirname(first_file_path))    
-        #extracting header part from the last document ignoring aux data
-        last_file_path = prep_ionex_file(file_paths[-1], cache_paths[-1])
-        with open (last_file_path,'rb') as ionex_last:
-            ionex_data_last  = ionex_last.read()
-            match_last_epoch = _re.search(regex_first_epoch, ionex_data_last) #EPOCH OF LAST MAP (LAST FILE to continue the header as headers can have different line quantity)
-            
-            match_num_maps_b = _re.search(regex_num_maps_b, ionex_data_last)
-            match_num_maps_e = _re.search(regex_num_maps_e, ionex_data_last)
-
-            match_aux_begin  = _re.search(regex_aux_start, ionex_data_last)
-            match_aux_end    = _re.search(regex_aux_end, ionex_data_last)
-            match_end_header = _re.search(regex_end_header, ionex_data_last)
-        _rmtree(_os.path.dirname(last_file_path)) 
-        return ((ionex_data_first[:match_first_epoch.end()]\
-                + ionex_data_last[match_last_epoch.end():match_num_maps_b.end()]).decode('ascii')\
-                + num_maps\
-                + (ionex_data_last[match_num_maps_e.end():match_aux_begin.start()]\
-                + ionex_data_last[match_aux_end.end():match_end_header.end()]).decode('ascii'))
-    
-    def get_ionex_data(self,in_sets):
-        
 
-        num_cores = self.num_cores if len(in_sets) > self.num_cores else len(in_sets)
-        chunksize = int(_np.ceil(len(in_sets)/num_cores))
-        # Collecting ionex maps from multiple files in parallel
+    def _gim_sets(self,merge_list):
+        '''[file_path, gim_cache_dir] pairs for get_gim'''
+        return _np.column_stack([merge_list[:,3],
+                                _np.asarray([_os.path.join(self.gim_cache_path,str(year)) for year in merge_list[:,0]],dtype=object)])
+
+    def get_gim_data(self,in_sets):
+        '''Reads (or loads from per-day cache) all files in in_sets in parallel
+        and returns a single merged GIM dict with duplicate midnight maps removed'''
+        gim_sets = self._gim_sets(in_sets)
+        num_cores = self.num_cores if len(gim_sets) > self.num_cores else len(gim_sets)
         with _Pool(num_cores) as p:
-            if self.tqdm:
-                GIM_data = list(_tqdm.tqdm_notebook(p.imap(GIM_data_extraction, in_sets[:,[3,4]]), total=in_sets.shape[0]))
-            else:
-                GIM_data = p.map(GIM_data_extraction, in_sets[:,[3,4]])
-            # GIM_data_extraction expects only array with filepaths
-
-        # Need this piece of code to kill 00 values eliminating duplicates
-        for i in range(len(GIM_data)-1):
-            if (GIM_data[i][0].tail(1).dt.hour == 0).iloc[0]:
-                GIM_data[i].drop(GIM_data[i][0].tail(1).index[0],inplace = True)
-
-        # Merging all data into two arrays (TEC and RMS) 
-        data_GIM_final = _pd.DataFrame()
-        for element in GIM_data:
-            data_GIM_final = _pd.concat((data_GIM_final,element[[1,2]]))
-        # Resulting array with two columns
-        return data_GIM_final.values
+            if self.tqdm: gims = list(_tqdm.tqdm_notebook(p.imap(get_gim, gim_sets), total=gim_sets.shape[0]))
+            else: gims = p.map(get_gim, gim_sets)
+        return merge_gims(gims)
     
     def merge_ionex_dataset(self,force=False):
+        '''Archive is globbed once. Daily files are parsed into the cache in parallel (files shared by neighbouring years are parsed once),
+        then years are merged and written in parallel. Map byte offsets are saved to IONEX_merged_index/{type}{year}.csv'''
         # create dir to where the files will be written
-        
         path = self.output_path+'/IONEX_merged/'
-        if not _os.path.exists(path):
-            _os.makedirs(path)
-            
-        EOF = '{:<60s}{}{:<9s}\n'.format(' ','END OF FILE',' ')
-    
-        GIM_data=_np.ndarray((len(self.years_present())),dtype=object)
-        for i in range(len(self.years_present())):
-            
-            merged_file_path = path+self.ionex_type+str(self.years_present()[i])
+        index_dir = self.output_path+'/IONEX_merged_index/' #separate dir as IONEX_merged is globbed by ionex_type
+        for dir_path in [path,index_dir]:
+            if not _os.path.exists(dir_path):
+                _os.makedirs(dir_path)
+
+        extended_list = self._extended_list()
+        years_present = extended_list.iloc[:,0].unique()
+        merge_lists = self.get_merge_lists(extended_list)
+
+        write_sets = []
+        for i in range(len(years_present)):
+            merged_file_path = path+self.ionex_type+str(years_present[i])
 
             if _os.path.exists(merged_file_path) and force: #force mode
                 _os.remove(merged_file_path)    
             if not _os.path.exists(merged_file_path):
-                merge_list = self.get_merge_lists()[i]
-                cache_path_array = _np.ndarray((merge_list.shape[0]),dtype=object)
-                cache_path_array.fill(self.cache_path)
-                in_sets = _np.column_stack([merge_list,cache_path_array])
-                print('Gathering {} {}'.format(self.ionex_type, self.years_present()[i]))
-
-                GIM_data[i] = self.get_ionex_data(in_sets)
-
-                header = self._GIM_gen_header(in_sets,GIM_data[i])
-
-                buf = (header)
-                #writing TEC data
-                for j in range(len(GIM_data[i])):
-                    buf += ('{:6d}{:<54s}{}{:<4s}\n'.format(i+1,' ','START OF TEC MAP',' '))
-                    buf += (GIM_data[i][j,0])
-                    buf += ('{:6d}{:<54s}{}{:<6s}\n'.format(i+1,' ','END OF TEC MAP',' '))
-
-                #writing RMS data
-                for j in range(len(GIM_data[i])):
-                    buf += ('{:6d}{:<54s}{}{:<4s}\n'.format(i+1,' ','START OF RMS MAP',' '))
-                    buf += (GIM_data[i][j,1])
-                    buf += ('{:6d}{:<54s}{}{:<6s}\n'.format(i+1,' ','END OF RMS MAP',' '))
-
-                buf += (EOF)
-                with open(merged_file_path,'w') as output:
-                    output.write(buf)
+                print('Gathering {} {}'.format(self.ionex_type, years_present[i]))
+                write_sets.append([merged_file_path, index_dir+self.ionex_type+str(years_present[i])+'.csv', self._gim_sets(merge_lists[i])])
             else:
                 print('{} already exists'.format(merged_file_path))
-# ionex_files = ionex()
-# ionex_files.merge_ionex_dataset()
+        if len(write_sets) == 0: return
 
+        gim_sets = _np.concatenate([write_set[2] for write_set in write_sets])
+        gim_sets = gim_sets[_np.unique(gim_sets[:,0].astype(str),return_index=True)[1]]
+        num_cores = self.num_cores if len(gim_sets) > self.num_cores else len(gim_sets)
+        with _Pool(num_cores) as p:
+            if self.tqdm: list(_tqdm.tqdm_notebook(p.imap(_cache_gim, gim_sets), total=gim_sets.shape[0]))
+            else: p.map(_cache_gim, gim_sets)
 
+        num_cores = self.num_cores if len(write_sets) > self.num_cores else len(write_sets)
+        with _Pool(num_cores) as p:
+            for merged_file_path in p.imap_unordered(_write_merged_ionex, write_sets):
+                print('{} written'.format(merged_file_path))
@@ -4,26 +4,15 @@ import os as _os
 from subprocess import Popen as _Popen
 from multiprocessing import Pool as _Pool
 import tqdm as _tqdm
-from .gx_aux import J2000origin, _dump_read, drInfo_lbl, rnx_dr_lbl
+from .gx_aux import J2000origin, _dump_read, _dump_write, rnx_dr_lbl, mode2label, drInfo_partitions, drInfo_version, read_drInfo
 
-def get_merge_table(tmp_dir,stations_list,mode=None):
-    '''
-    Reads drInfo file and outputs merge_table for all available stations in drInfo in one single dataframe.
-    tmp_dir is expected to have drinfo.npz file produced by get_drinfo function
-    Analyses the properties of dr files and outputs classified dataset where class 3 files can be meged to 32 hours files centered on the midday.
-    Currently there are no special cases for the very first and last files of the station as if merged non-symmetrically won't be centred'''
-
-    tmp_dir = _os.path.abspath(tmp_dir)
-    rnx_dir = _os.path.join(tmp_dir,rnx_dr_lbl)
-    drinfo = _dump_read(filename='{}/{}.zstd'.format(rnx_dir,drInfo_lbl))  
+def _classify_drinfo(drinfo,mode=None):
+    '''Classifies the whole drInfo table in a single pass. Records are sorted once by station and begin, prev/next boundaries are taken
+    within each station with wrap-around at the station ends (same as np.roll on the per-station record)'''
     modes = [None, 'GPS', 'GLONASS','GPS+GLONASS']
     if mode not in modes:
         raise ValueError("Invalid mode. Expected one of: %s" % modes)
 
-
-    '''Creating classes according to record length'''
-    dr_classes = []
-
     if mode is None:
         complete_record = drinfo #all available files will be merged. Usually this is what I start with
     elif mode == 'GPS':
@@ -32,67 +21,118 @@ def get_merge_table(tmp_dir,stations_list,mode=None):
         complete_record = drinfo[drinfo['GLONASS']>=3] #need at least 3 satellites present in the file
     elif mode == 'GPS+GLONASS':
         complete_record = drinfo[(drinfo['GPS']>0)&(drinfo['GLONASS']>0)] #at least one satellite of each constellation for the processing
-    
-    for station in stations_list:
-        station_record = complete_record[complete_record['station_name'] == station].sort_values(by='begin')
-        if station_record.shape[0] == 0:
-            raise ValueError("No data found for mode {} for station {}".format(mode,station)) #need to return a list of stations
 
-        drinfo_rec_time = station_record['length'].values
-        if (drinfo_rec_time>24).sum() != 0: print('Files longer than 24 hours detected in drInfo. Ignoring those as are possibly corrupted.')
-        completeness = _np.zeros((drinfo_rec_time.shape),dtype=int)
-        #-----------------------------------------------------------------------
-        # Basic filtering module that uses total length of the datarecord.
-        # records with more than 12 hours of data but less than 20 hours of data get 1
-        completeness[((drinfo_rec_time>=12) & ((drinfo_rec_time)<20))]=1
+    record = complete_record.copy()
+    record['station_name'] = record['station_name'].astype(str)
+    record = record.sort_values(by=['station_name','begin'],kind='mergesort')
 
-        #records with more than 20 hours of data get 2
-        
-        completeness[(drinfo_rec_time>=20)& ((drinfo_rec_time)<24)]=2 # as we work with 24 daily files, we do not use files that are longer
-        #-----------------------------------------------------------------------
+    n = record.shape[0]
+    stations = record['station_name'].values
+    idx = _np.arange(n)
+    group_start = _np.ones(n,dtype=bool); group_start[1:] = stations[1:] != stations[:-1]
+    starts = idx[group_start]
+    ends = _np.append(starts[1:],n) - 1
+    prev_idx = idx - 1; prev_idx[starts] = ends #first record of the station points to its last one as np.roll does
+    next_idx = idx + 1; next_idx[ends] = starts
 
-        # BOUNDARY_1                                    # BOUNDARY_2
+    drinfo_rec_time = record['length'].values
+    if (drinfo_rec_time>24).sum() != 0: print('Files longer than 24 hours detected in drInfo. Ignoring those as are possibly corrupted.')
+    completeness = _np.zeros((drinfo_rec_time.shape),dtype=int)
+    #-----------------------------------------------------------------------
+    # Basic filtering module that uses total length of the datarecord.
+    # records with more than 12 hours of data but less than 20 hours of data get 1
+    completeness[((drinfo_rec_time>=12) & ((drinfo_rec_time)<20))]=1
 
-        # start_c - start_p         <=24h & >=4h        # end_n   - start_c  <=48h & >=28h
-        #  day      hour                                #  hour     day
+    #records with more than 20 hours of data get 2
+    completeness[(drinfo_rec_time>=20)& ((drinfo_rec_time)<24)]=2 # as we work with 24 daily files, we do not use files that are longer
+    #-----------------------------------------------------------------------
 
-        # start_c - end_p           <=1h  & >=0m        # start_n - start_c  <=25h  & >=24h | Only gaps of up to 1h are accepted
-        #  day      hour                                #  hour     day
-        # Missing data of 1 hour is acceptable
-        #-----------------------------------------------------------------------
+    # BOUNDARY_1                                    # BOUNDARY_2
 
-        station_start64 = station_record['begin'].values
-        station_end64 = station_record['end'].values
+    # start_c - start_p         <=24h & >=4h        # end_n   - start_c  <=48h & >=28h
+    #  day      hour                                #  hour     day
 
-        start_c_day=station_start64.astype('datetime64[D]') #this values should overwrite begin, otherwise duplicates may appear as if begin YYYY-MM-DD 02:25:00 + 27 !!! 05:25:00
-        start_p_hour=_np.roll(station_start64,1).astype('datetime64[h]')
-        start_n_hour=_np.roll(station_start64,-1).astype('datetime64[h]')
+    # start_c - end_p           <=1h  & >=0m        # start_n - start_c  <=25h  & >=24h | Only gaps of up to 1h are accepted
+    #  day      hour                                #  hour     day
+    # Missing data of 1 hour is acceptable
+    #-----------------------------------------------------------------------
 
-        # end_c_day=station_record[:,3].astype('datetime64[D]')
-        end_p_minute=_np.roll(station_end64,1).astype('datetime64[m]')
-        end_n_hour=_np.roll(station_end64,-1).astype('datetime64[h]')
+    start64 = record['begin'].values
+    end64 = record['end'].values
 
+    start_c_day=start64.astype('datetime64[D]') #this values should overwrite begin, otherwise duplicates may appear as if begin YYYY-MM-DD 02:25:00 + 27 !!! 05:25:00
+    start_p_hour=start64[prev_idx].astype('datetime64[h]')
+    start_n_hour=start64[next_idx].astype('datetime64[h]')
 
-        B1c1 = (start_c_day-start_p_hour <= _np.timedelta64(24,'[h]'))&(start_c_day-start_p_hour >= _np.timedelta64(3,'[h]'))
+    end_p_minute=end64[prev_idx].astype('datetime64[m]')
+    end_n_hour=end64[next_idx].astype('datetime64[h]')
 
-        B1c2 = (start_c_day-end_p_minute <= _np.timedelta64(1,'[h]'))&(start_c_day-end_p_minute >= _np.timedelta64(0,'[m]')) #value should be positive
+    B1c1 = (start_c_day-start_p_hour <= _np.timedelta64(24,'[h]'))&(start_c_day-start_p_hour >= _np.timedelta64(3,'[h]'))
 
-        B2c1 = (end_n_hour-start_c_day <= _np.timedelta64(48,'[h]'))&(end_n_hour-start_c_day >= _np.timedelta64(27,'[h]')) #start_c_day is the same as end_c_day
-        
-        B2c2 = (start_n_hour-start_c_day <= _np.timedelta64(25,'[h]'))&(start_n_hour-start_c_day >= _np.timedelta64(24,'[h]')) #check if next file is next day without missing days in between 
-        
-        
-        completeness[B1c1 & B1c2 & B2c1 & B2c2 & (completeness==2)] = 3
+    B1c2 = (start_c_day-end_p_minute <= _np.timedelta64(1,'[h]'))&(start_c_day-end_p_minute >= _np.timedelta64(0,'[m]')) #value should be positive
 
-        tmp_df = station_record.copy()
-        tmp_df['completeness'] = completeness
+    B2c1 = (end_n_hour-start_c_day <= _np.timedelta64(48,'[h]'))&(end_n_hour-start_c_day >= _np.timedelta64(27,'[h]')) #start_c_day is the same as end_c_day
 
-        tmp_df['path_prev'] =  tmp_dir + _np.roll(station_record['path'].values,1) 
-        tmp_df['path'] =  tmp_dir + station_record['path']
-        tmp_df['path_next'] =  tmp_dir +_np.roll(station_record['path'].values,-1)
+    B2c2 = (start_n_hour-start_c_day <= _np.timedelta64(25,'[h]'))&(start_n_hour-start_c_day >= _np.timedelta64(24,'[h]')) #check if next file is next day without missing days in between
+
+    completeness[B1c1 & B1c2 & B2c1 & B2c2 & (completeness==2)] = 3
+
+    record['completeness'] = completeness
+    paths = record['path'].values
+    record['path_prev'] = paths[prev_idx]
+    record['path_next'] = paths[next_idx]
+    return record
+
+def get_merge_table(tmp_dir,stations_list,mode=None):
+    '''
+    Reads drInfo partitions of the stations in stations_list and outputs merge_table for these stations in one single dataframe.
+    tmp_dir is expected to have drInfo partitions produced by get_drInfo function
+    Analyses the properties of dr files and outputs classified dataset where class 3 files can be meged to 32 hours files centered on the midday.
+    Classification is cached per station to rnx_dr/merge_table/{station}{mode_label}.zstd and is recomputed only when station's drInfo partitions change.
+    Currently there are no special cases for the very first and last files of the station as if merged non-symmetrically won't be centred'''
+
+    tmp_dir = _os.path.abspath(tmp_dir)
+    rnx_dir = _os.path.join(tmp_dir,rnx_dr_lbl)
+    modes = [None, 'GPS', 'GLONASS','GPS+GLONASS']
+    if mode not in modes:
+        raise ValueError("Invalid mode. Expected one of: %s" % modes)
+    cache_dir = _os.path.join(rnx_dir,'merge_table')
+    if not _os.path.exists(cache_dir): _os.makedirs(cache_dir)
+
+    stations = [str(station).lower() for station in stations_list]
+    partitions = drInfo_partitions(tmp_dir=tmp_dir,stations_list=stations)
+
+    versions = {}; dr_classes = {}; outdated = []
+    for station in stations:
+        station_partitions = partitions[partitions['station'] == station]
+        if station_partitions.shape[0] == 0:
+            raise ValueError("No drInfo found for station {}".format(station))
+        versions[station] = drInfo_version(station_partitions)
+        cache_path = '{}/{}{}.zstd'.format(cache_dir,station,'' if mode is None else mode2label(mode))
+        cached = _dump_read(cache_path) if _os.path.exists(cache_path) else None
+        if (cached is not None) and (cached['drinfo_version'] == versions[station]): dr_classes[station] = cached['merge_table']
+        else: outdated.append(station)
+
+    if len(outdated) > 0:
+        merge_table = _classify_drinfo(drinfo = read_drInfo(tmp_dir=tmp_dir,partitions=partitions[partitions['station'].isin(outdated)]),mode=mode)
+        merge_table_stations = merge_table['station_name'].str.lower()
+        for station in outdated:
+            dr_classes[station] = merge_table[merge_table_stations == station]
+            if dr_classes[station].shape[0] == 0: continue #not cached, raised below
+            cache_path = '{}/{}{}.zstd'.format(cache_dir,station,'' if mode is None else mode2label(mode))
+            tmp_path = '{}.{}.tmp'.format(cache_path,_os.getpid())
+            _dump_write(data = {'drinfo_version':versions[station],'merge_table':dr_classes[station]},filename=tmp_path,cname='zstd')
+            _os.replace(tmp_path,cache_path)
+
+    for station in stations:
+        if dr_classes[station].shape[0] == 0:
+            raise ValueError("No data found for mode {} for station {}".format(mode,station)) #need to return a list of stations
 
-        dr_classes.append(tmp_df)
-    return _pd.concat(dr_classes,axis=0)
+    selected = _pd.concat([dr_classes[station] for station in stations],axis=0)
+    selected['path_prev'] = tmp_dir + selected['path_prev']
+    selected['path'] = tmp_dir + selected['path']
+    selected['path_next'] = tmp_dir + selected['path_next']
+    return selected
 
 def _merge(merge_set):
     '''Expects a merge set of 3 files [merge_start, merge_end,file_prev,file,file_next]. Merges all files into file120h. file1 must be a class 3 file
@@ -1,4 +1,7 @@
 import os as _os,sys as _sys
+import re as _re
+import hashlib as _hashlib
+import tempfile as _tempfile
 import numpy as _np
 import pandas as _pd
 import tqdm as _tqdm
@@ -8,7 +11,9 @@ from subprocess import Popen as _Popen, PIPE as _PIPE
 from multiprocessing import Pool as _Pool
 from shutil import rmtree as _rmtree, move as _move, copy as _copy
 
-from .gx_aux import J2000origin as _J2000origin
+from .gx_aux import J2000origin as _J2000origin, _dump_read, _dump_write
+from .gx_aux import worker_scratch as _worker_scratch, clean_scratch as _clean_scratch, working_dir as _working_dir
+from .gx_compress import compress_files as _compress_files
 
 _sys.path.insert(0, "{}/lib/python{}.{}".format(_os.environ['GCOREBUILD'], \
                 _sys.version_info[0], _sys.version_info[1]))
@@ -43,6 +48,103 @@ def _date2igs(date):
     day_in_week = ((gps_seconds%_seconds_week)/86400).astype(_np.int)
     return gps_week.astype(_np.str).astype(object), day_in_week.astype(_np.str).astype(object)
 
+_regex_product = _re.compile(r'^([a-z]{2}[a-z0-9])(\d{4})(\d)\.(sp3|eph|clk|clk_30s)\.Z$',_re.IGNORECASE) #e.g. es218000.sp3.Z, COD18000.EPH.Z, jxf18000.clk_30s.Z
+_catalog_lbl = 'products_catalog'
+_catalog_columns = ['ac','gps_week','day','igs_day','file_type','repro','path','mtime','size']
+_converted_lbl = 'converted.zstd'
+
+#Last igs day of reprocessed products preferred per analysis centre (analysis choice, products of both kinds exist around it).
+#Reprocessed products are preferred up to and including the boundary day, operational after it. The kind used on a day is then
+#taken from the catalog: if the preferred kind is not complete for the day, the other one is used (see _select_repro)
+_repro_boundary = {'esa':17696, # according to docu it should be 17726 : according to CNES recommendations to use rouutine grg after 28/12/2013
+                   'gr2':17696,
+                   'com':17732} #REPRO_2015 used before 2014-01-01 (17733) as CODE repro2 do not have clk for GLONASS
+#products type: reprocessed ac, operational ac (names in catalog), sp3 and clk file types
+_repro_split = {'esa':['es2','esa','sp3','clk'],
+                'gr2':['gr2','grg','sp3','clk'],
+                'com':['cod','com','eph','clk']}
+
+def _scan_products_dir(dir_path,dirs_state,new_dirs_state,visited):
+    '''Recursively scans products directory. Directories which mtime did not change since the previous scan are taken from dirs_state
+    without listing (files are added to the archive by rename, e.g. rclone/wget, so directory mtime changes). Symlinked directories
+    are followed, visited (real paths) prevents cycles'''
+    real_path = _os.path.realpath(dir_path)
+    if real_path in visited: return
+    visited.add(real_path)
+    mtime = _os.stat(dir_path).st_mtime_ns
+    prev = dirs_state.get(dir_path)
+    if (prev is not None) and (prev['mtime'] == mtime):
+        subdirs, rows = prev['subdirs'], prev['rows']
+    else:
+        subdirs, rows = [], []
+        repro = 'repro' in dir_path.lower()
+        with _os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(): subdirs.append(entry.path); continue #follows symlinks as isfile did
+                match = _regex_product.match(entry.name)
+                if match is None: continue
+                stat = entry.stat()
+                ac,gps_week,day,file_type = match.groups()
+                rows.append((ac.lower(),int(gps_week),int(day),int(gps_week+day),file_type.lower(),repro,entry.path,stat.st_mtime_ns,stat.st_size))
+        subdirs.sort()
+    new_dirs_state[dir_path] = {'mtime':mtime,'subdirs':subdirs,'rows':rows}
+    for subdir in subdirs:
+        _scan_products_dir(subdir,dirs_state,new_dirs_state,visited)
+
+def products_catalog(products_dir,cache_dir,refresh=True):
+    '''Catalog of products archive: analysis centre, GPS week, day, file type, repro flag, path, mtime and size of every sp3/eph/clk file.
+    Built by one scan of products_dir and saved to cache_dir/products_catalog/{sha1 of products_dir}.zstd as the archive may be shared or read-only.
+    On refresh only directories that changed are listed again. Files of requested days are re-stat'ed on lookup (see _lookup_catalog)'''
+    products_dir = _os.path.abspath(products_dir)
+    catalog_dir = _os.path.join(cache_dir,_catalog_lbl)
+    if not _os.path.exists(catalog_dir): _os.makedirs(catalog_dir)
+    catalog_path = _os.path.join(catalog_dir,'{}.zstd'.format(_hashlib.sha1(products_dir.encode()).hexdigest()))
+    dirs_state = _dump_read(catalog_path) if _os.path.exists(catalog_path) else {}
+    if refresh or (len(dirs_state) == 0):
+        new_dirs_state = {}
+        _scan_products_dir(products_dir,dirs_state,new_dirs_state,set())
+        tmp_path = '{}.{}.tmp'.format(catalog_path,_os.getpid())
+        _dump_write(data = new_dirs_state,filename=tmp_path,cname='zstd',num_cores=1)
+        _os.replace(tmp_path,catalog_path)
+        dirs_state = new_dirs_state
+    rows = [row for dir_state in dirs_state.values() for row in dir_state['rows']]
+    return _pd.DataFrame(rows,columns=_catalog_columns)
+
+def _lookup_catalog(paths,catalog):
+    '''Returns mtime and size of each path. Only catalogued paths (requested days) are re-stat'ed as products overwritten in place
+    do not change directory mtime. Missing files get -1'''
+    catalogued = set(catalog['path'].values)
+    stats = []
+    for path in paths:
+        try: stat = _os.stat(path) if path in catalogued else None
+        except FileNotFoundError: stat = None
+        stats.append([-1,-1] if stat is None else [stat.st_mtime_ns,stat.st_size])
+    return _np.asarray(stats,dtype=_np.int64).reshape(-1,2)
+
+def _select_repro(catalog,products_type,igs_days,sp3_path,clk_path):
+    '''Per day sp3 and clk paths of products type with reprocessed and operational parts, taken from catalog (ac, repro flag, file type).
+    Kind preferred by _repro_boundary is used if both files of the day are catalogued, else the other kind if complete. Days with
+    neither keep the expected sp3_path, clk_path (reported missing)'''
+    repro_ac, oper_ac, sp3_type, clk_type = _repro_split[products_type]
+    def _kind_paths(ac,repro):
+        rows = catalog[((catalog['ac'] == ac) & (catalog['repro'] == repro)).values].sort_values('path')
+        paths = {file_type:dict(rows[(rows['file_type'] == file_type).values][['igs_day','path']].values.tolist())
+                 for file_type in [sp3_type,clk_type]}
+        return [(paths[sp3_type].get(day),paths[clk_type].get(day)) for day in igs_days]
+    kinds = {True:_kind_paths(repro_ac,True),False:_kind_paths(oper_ac,False)}
+    sp3_path, clk_path = sp3_path.copy(), clk_path.copy()
+    n_other = 0
+    for i,day in enumerate(igs_days):
+        preferred = day <= _repro_boundary[products_type]
+        for repro in [preferred,not preferred]:
+            sp3, clk = kinds[repro][i]
+            if (sp3 is not None) and (clk is not None):
+                sp3_path[i], clk_path[i] = sp3, clk
+                n_other += repro != preferred
+                break
+    if n_other > 0: print('{} days use {} products as preferred ones are not complete'.format(n_other,products_type))
+    return sp3_path, clk_path
+
 def _gen_sets(begin,end,products_type,products_dir,run_dir):
     '''Generates filenames list'''
     products_dir = _os.path.abspath(products_dir)
@@ -65,9 +167,8 @@ def _gen_sets(begin,end,products_type,products_dir,run_dir):
         clk_path = products_dir + '/' + gps_week+ '/' + products_type +igs_days +'.clk_30s.Z' #only 30s clk files present
     elif (products_type == 'esa'):
         igs_days_num = igs_days.astype(int)
-        boudary_date = 17696 # according to docu it should be 17726 : according to CNES recommendations to use rouutine grg after 28/12/2013
-        reprocessed_bool = igs_days_num<=boudary_date      # 
-        non_reprocessed_bool =  igs_days_num>boudary_date  #
+        reprocessed_bool = igs_days_num<=_repro_boundary['esa']
+        non_reprocessed_bool =  igs_days_num>_repro_boundary['esa']
         
         sp3_path_non_repro = products_dir + '/' + gps_week[non_reprocessed_bool]+ '/' + products_type +igs_days[non_reprocessed_bool] +'.sp3.Z'
         clk_path_non_repro = products_dir + '/' + gps_week[non_reprocessed_bool]+ '/' + products_type +igs_days[non_reprocessed_bool] +'.clk.Z'
@@ -98,9 +199,8 @@ def _gen_sets(begin,end,products_type,products_dir,run_dir):
         clk_path = products_dir + '/' + gps_week+ '/repro2/' + products_type +igs_days +'.clk.Z'
     elif products_type == 'gr2': #es2 and gr2 are complete with clk and sp3
         igs_days_num = igs_days.astype(int)
-        boudary_date = 17696 # according to docu it should be 17726 : according to CNES recommendations to use rouutine grg after 28/12/2013
-        reprocessed_bool = igs_days_num<=boudary_date      # 
-        non_reprocessed_bool =  igs_days_num>boudary_date  #
+        reprocessed_bool = igs_days_num<=_repro_boundary['gr2']
+        non_reprocessed_bool =  igs_days_num>_repro_boundary['gr2']
         
         sp3_path_repro = products_dir + '/' + gps_week[reprocessed_bool]+ '/repro2/' + products_type +igs_days[reprocessed_bool] +'.sp3.Z'
         clk_path_repro = products_dir + '/' + gps_week[reprocessed_bool]+ '/repro2/' + products_type +igs_days[reprocessed_bool] +'.clk.Z'
@@ -135,9 +235,8 @@ def _gen_sets(begin,end,products_type,products_dir,run_dir):
         #Use COD operational parts of data before 2014-01-01
         products_type = products_type.upper()
         igs_days_num = igs_days.astype(int)
-        boudary_date = 17733 # 2014-01-01
-        reprocessed_bool = igs_days_num<boudary_date      # 
-        non_reprocessed_bool =  igs_days_num>=boudary_date  #
+        reprocessed_bool = igs_days_num<=_repro_boundary['com']
+        non_reprocessed_bool =  igs_days_num>_repro_boundary['com']
         if reprocessed_bool.sum() >0: print('using REPRO_2015 type products to cover pre 2014-01-01 as CODE repro2 do not have clk for GLONASS')
         
         sp3_path_non_repro = products_dir + '/' + years[non_reprocessed_bool] + '/' + products_type + igs_days[non_reprocessed_bool] +'.EPH.Z'
@@ -153,9 +252,16 @@ def _gen_sets(begin,end,products_type,products_dir,run_dir):
     else:
         raise Exception('Product type not understood. Please check.')
         
-    #checking if files are locally available
-    sp3_path_avail_mask = _np.asarray([_os.path.isfile(f) for f in sp3_path])
-    clk_path_avail_mask = _np.asarray([_os.path.isfile(f) for f in clk_path])
+    #checking if files are locally available. Single (incremental) scan of the archive instead of isfile on each path
+    catalog_roots = [products_dir]
+    if products_type == 'COM': catalog_roots.append(_os.path.join(products_dir_repro,'REPRO_2015'))
+    catalog = _pd.concat([products_catalog(root,cache_dir=run_dir) for root in catalog_roots if _os.path.isdir(root)],axis=0)
+    if products_type.lower() in _repro_split:
+        sp3_path, clk_path = _select_repro(catalog,products_type.lower(),igs_days.astype(int),sp3_path,clk_path)
+    sp3_stats = _lookup_catalog([_os.path.normpath(path) for path in sp3_path],catalog)
+    clk_stats = _lookup_catalog([_os.path.normpath(path) for path in clk_path],catalog)
+    sp3_path_avail_mask = sp3_stats[:,0] != -1
+    clk_path_avail_mask = clk_stats[:,0] != -1
     
     sp3_avail= sp3_path[sp3_path_avail_mask].shape[0]/igs_days.shape[0]
     sp3_unavail = sp3_path[~sp3_path_avail_mask].shape[0]/igs_days.shape[0]
@@ -184,59 +290,122 @@ def _gen_sets(begin,end,products_type,products_dir,run_dir):
         out_array.fill(out_dir) #filling with default values
         out_array = out_array + '/' + date_array.astype('datetime64[Y]').astype(str) #updating out paths with year folders
 
-        tmp_dir = _os.path.join(run_dir,'tmp_igs2jpl') #creating tmp directory processes will work in
+        sets = _pd.DataFrame(_np.column_stack((sp3_path,clk_path,date_array,date_array_J2000,out_array)),columns = ['sp3','clk', 'date', 'dateJ','out'])
+        sets[['sp3_mtime','sp3_size']] = sp3_stats
+        sets[['clk_mtime','clk_size']] = clk_stats
+
+        #scheduling only days that were not converted yet or which sources changed since the conversion
+        sets['date'] = sets['date'].astype(str)
+        converted = _seed_converted(out_dir,sets)
+        pos_exists = _np.asarray([_os.path.isfile(_os.path.join(out_path,date + '.pos.gz')) for out_path,date in sets[['out','date']].values])
+        merged = sets.merge(converted,on='date',how='left',suffixes=('','_converted'))
+        unchanged = _np.ones(sets.shape[0],dtype=bool)
+        for column in _converted_columns[1:]:
+            unchanged &= (merged[column].values == merged[column+'_converted'].values)
+        sets = sets[~(unchanged & pos_exists)].reset_index(drop=True)
+        print('{} days converted and up to date, {} days scheduled for conversion'.format((unchanged & pos_exists).sum(),sets.shape[0]))
+        if sets.shape[0] == 0: return sets
+
+        tmp_dir = _os.path.join(run_dir,'tmp_igs2jpl',products_type.lower()) #workers create own scratch dirs inside. Separate per products type so runs may go concurrently
         if _os.path.isdir(tmp_dir): _rmtree(tmp_dir) #clearing memory before processing
-        _os.makedirs(tmp_dir) #this should automatically create out and tmp dirs
-        tmp_array = _np.ndarray((date_array.shape),dtype=object)
-        tmp_array.fill(tmp_dir) #filling with default values
+        _os.makedirs(tmp_dir)
+        sets['tmp'] = tmp_dir
+
+        [_os.makedirs(out_path) for out_path in sets['out'].unique() if not _os.path.exists(out_path)] #creating unique year directories
+        return sets
+
+_converted_columns = ['date','sp3','clk','sp3_mtime','sp3_size','clk_mtime','clk_size']
+
+def _read_converted(out_dir):
+    '''Reads record of converted days (date and source sp3/clk paths with their mtime and size at conversion time) from igs2gipsyx out_dir'''
+    converted_path = _os.path.join(out_dir,_converted_lbl)
+    if _os.path.exists(converted_path): return _dump_read(converted_path)
+    return _pd.DataFrame(columns=_converted_columns)
+
+def _outputs_mtime(sets):
+    '''Oldest mtime (ns) of .pos.gz and .tdp.gz outputs of each day of sets, -1 if any is missing'''
+    mtimes = _np.full(sets.shape[0],-1,dtype=_np.int64)
+    for i,(out_path,date) in enumerate(sets[['out','date']].values):
+        try: mtimes[i] = min(_os.stat(_os.path.join(out_path,date + ext)).st_mtime_ns for ext in ['.pos.gz','.tdp.gz'])
+        except FileNotFoundError: pass
+    return mtimes
+
+def _seed_converted(out_dir,sets):
+    '''Converted record of out_dir with days of sets that have no record yet but were converted before the record existed.
+    Such days are taken as converted from the current sources if both outputs are present and newer than the sp3 and clk sources'''
+    converted = _read_converted(out_dir)
+    not_recorded = ~sets['date'].isin(converted['date']).values
+    if not_recorded.sum() == 0: return converted
+    outputs_mtime = _outputs_mtime(sets[not_recorded])
+    seed_mask = (outputs_mtime != -1) & (outputs_mtime >= sets['sp3_mtime'].values[not_recorded]) & (outputs_mtime >= sets['clk_mtime'].values[not_recorded])
+    if seed_mask.sum() == 0: return converted
+    print('Seeding converted record of {} with {} days already present'.format(out_dir,seed_mask.sum()))
+    _update_converted(out_dir,sets[not_recorded][seed_mask])
+    return _read_converted(out_dir)
+
+def _update_converted(out_dir,sets):
+    '''Adds days of sets which outputs are present to the converted record of out_dir. Record is re-read before the update and replaced atomically'''
+    done_mask = _np.asarray([_os.path.isfile(_os.path.join(out_path,date + '.pos.gz')) and _os.path.isfile(_os.path.join(out_path,date + '.tdp.gz'))
+                                    for out_path,date in sets[['out','date']].values],dtype=bool)
+    if (~done_mask).sum() > 0: print('Conversion failed for: {}'.format(sets['date'][~done_mask].to_list()))
+    converted = _read_converted(out_dir)
+    converted = _pd.concat([converted[~converted['date'].isin(sets['date'][done_mask])],sets[_converted_columns][done_mask]],axis=0)
+    converted = converted.sort_values(by='date').reset_index(drop=True)
+    converted_path = _os.path.join(out_dir,_converted_lbl)
+    tmp_path = '{}.{}.tmp'.format(converted_path,_os.getpid())
+    _dump_write(data = converted,filename=tmp_path,cname='zstd',num_cores=1)
+    _os.replace(tmp_path,converted_path)
 
-        [_os.makedirs(out_path) for out_path in out_array if not _os.path.exists(out_path)] #creating unique year directories
-        return _pd.DataFrame(_np.column_stack((sp3_path,clk_path,date_array,date_array_J2000,out_array,tmp_array)),columns = ['sp3','clk', 'date', 'dateJ','out','tmp'])
-    
 def _sp3ToPosTdp(np_set):
-    
-    process = _mp.current_process()
-
-    tmp_dir = _os.path.abspath(_os.path.join(np_set['tmp'],str(process._identity[0])))
-    #creates tmp dirs in igs2gipsyx directory #'/mnt/data/bogdanm/Products/CODE/igs2gipsyx/com/tmp'
-                                              # /mnt/data/bogdanm/Products/CODE/igs2gipsyx/COM/tmp
-    if not _os.path.isdir(tmp_dir): _os.makedirs(tmp_dir)
-    _os.chdir(tmp_dir)
-    
-    # print(np_set['sp3'],np_set['out'])
-    frame = _IgsGcoreConversions.sp3ToPosTdp(np_set['sp3'], 
-                                    _os.path.join(np_set['out'], str(np_set['date'])+'.pos.gz'), 
-                                    _DEFAULT_COEFF,igsCm=True, workDir=tmp_dir, 
-                                    tdpOut=None)
-    
-    refClk = _IgsGcoreConversions.clkToTdp(np_set['clk'], 
-                                    _os.path.join(np_set['out'], str(np_set['date'])+'.tdp.gz'), 
-                                    stationClk=False)
-    
-    miscProducts = _IgsGcoreConversions.ConvertedGcoreProds(np_set['dateJ'], np_set['out'], refClk, frame)
-    miscProducts.make()
+    '''Converts sp3 and clk of a single day. Runs in the worker scratch dir (np_set['tmp']/<pid>) which is cleaned after each day.
+    sp3ToPosTdp gets the explicit workDir, clkToTdp and ConvertedGcoreProds write intermediate files to cwd so they run inside working_dir'''
+    tmp_dir = _worker_scratch(np_set['tmp'])
+    try:
+        with _working_dir(tmp_dir):
+            frame = _IgsGcoreConversions.sp3ToPosTdp(np_set['sp3'], 
+                                            _os.path.join(np_set['out'], str(np_set['date'])+'.pos.gz'), 
+                                            _DEFAULT_COEFF,igsCm=True, workDir=tmp_dir, 
+                                            tdpOut=None)
+            
+            refClk = _IgsGcoreConversions.clkToTdp(np_set['clk'], 
+                                            _os.path.join(np_set['out'], str(np_set['date'])+'.tdp.gz'), 
+                                            stationClk=False)
+            
+            miscProducts = _IgsGcoreConversions.ConvertedGcoreProds(np_set['dateJ'], np_set['out'], refClk, frame)
+            miscProducts.make()
+    finally:
+        _clean_scratch(tmp_dir)
 
 def igs2jpl(begin,end,products_type,products_dir,tqdm,num_cores=None,run_dir = '/run/user/1017/'):
+    '''Converts only the days that are missing in igs2gipsyx or which sp3/clk source changed since the last conversion.
+    products_type and products_dir may be lists of equal length so several products types are converted in one process pool'''
     #products_dir = '/mnt/data/bogdanm/Products/CODE/source/MGEX/'
-    sets = _gen_sets(begin,end,products_type,products_dir,run_dir = run_dir)
-    sets = sets.to_records()
+    products_types = [products_type] if isinstance(products_type,str) else list(products_type)
+    products_dirs = [products_dir] if isinstance(products_dir,str) else list(products_dir)
+    sets_list = []
+    for products_type,products_dir in zip(products_types,products_dirs):
+        sets = _gen_sets(begin,end,products_type,products_dir,run_dir = run_dir)
+        if not isinstance(sets,_pd.DataFrame): return sets #missing products
+        if sets.shape[0] > 0: sets_list.append(sets)
+    if len(sets_list) == 0: print('Nothing to convert'); return
+    sets = _pd.concat(sets_list,axis=0,ignore_index=True)
     
     with _Pool(num_cores) as p:
-        if tqdm: list(_tqdm.tqdm_notebook(p.imap(_sp3ToPosTdp, sets), total=sets.shape[0]))
-        else: p.map(_sp3ToPosTdp, sets)
-    
+        if tqdm: list(_tqdm.tqdm_notebook(p.imap(_sp3ToPosTdp, sets.to_records()), total=sets.shape[0]))
+        else: p.map(_sp3ToPosTdp, sets.to_records())
 
-    tmp_dir = _os.path.join(run_dir,'tmp_igs2jpl') #creating tmp directory processes will work in
-    try:_rmtree(tmp_dir) #clearing memory before processing
-    except: print('Could not remove tmp')
-    # tmp_dir = _os.path.abspath(_os.path.join(products_dir,_os.pardir,_os.pardir,'igs2gipsyx',products_type.lower(),'tmp'))
-    #'/mnt/data/bogdanm/Products/CODE/igs2gipsyx/com/tmp'
-    
-    #cleaning tmp directory as newer instances of process_id will create mess
+    for products_sets in sets_list:
+        _update_converted(out_dir = _os.path.dirname(products_sets['out'][0]),sets=products_sets)
+        try:_rmtree(products_sets['tmp'][0]) #workers' scratch dirs of the products type
+        except: print('Could not remove tmp')
 
 
-def jpl2merged_orbclk(begin,end,GNSSproducts_dir,num_cores=None,h24_bool=True,makeShadow_bool=True,tqdm=True,run_dir = '/run/user/1017/'):
-    '''GipsyX can only merge daily products so effectively we end up having 3 days merged (72 hours, centre 24 +- 24) and not 30 hours'''
+def jpl2merged_orbclk(begin,end,GNSSproducts_dir,num_cores=None,h24_bool=True,makeShadow_bool=True,tqdm=True,run_dir = '/run/user/1017/',batched=True):
+    '''GipsyX can only merge daily products so effectively we end up having 3 days merged (72 hours, centre 24 +- 24) and not 30 hours.
+    Only days which merged products are missing in the target dir are generated, existing days are kept.
+    batched=True runs FetchGNSSproducts.makeFiles in-process: days are split into blocks of consecutive days, each block is processed by one worker
+    that keeps its FetchGNSSproducts instance and a staged copy of the neighbour days products on run_dir (tmpfs) between days.
+    batched=False runs fetchGNSSproducts_J2000.py for each day'''
     begin64 = _np.datetime64(begin).astype('datetime64[D]')
     end64 = _np.datetime64(end).astype('datetime64[D]')
     products_day = _np.arange(begin64,end64)
@@ -250,33 +419,115 @@ def jpl2merged_orbclk(begin,end,GNSSproducts_dir,num_cores=None,h24_bool=True,ma
     
     output_merged_dir = _os.path.abspath(GNSSproducts_dir)
     target_path = _os.path.abspath(_os.path.join(output_merged_dir,_os.pardir,_os.pardir,'init',_os.path.basename(output_merged_dir)))
-    if _os.path.exists(target_path):
-        _rmtree(target_path)
         
     target_dir = target_path +'/' + year_str
     for dir in target_dir.unique(): #creating folder structure before conversion
-        _os.makedirs(dir)
+        if not _os.path.exists(dir): _os.makedirs(dir)
     
     repository = _np.ndarray((products_day.shape),object)
     h24 = _np.ndarray((products_day.shape),bool)
     makeShadow = _np.ndarray((products_day.shape),bool)
     
-    tmp_merge_path = _os.path.abspath(run_dir)+ '/tmp_merge/'
-    run = tmp_merge_path +_pd.Series(products_day).astype(str)
-    # Need to clear run before new execution just in case
-    if _os.path.exists(tmp_merge_path) : _rmtree(tmp_merge_path)
-  
-    repository.fill(GNSSproducts_dir)
+    run = _np.ndarray((products_day.shape),object) #per day run dirs within run-unique tmp_merge base, set below
+
+    repository.fill(output_merged_dir)
     h24.fill(h24_bool)
     makeShadow.fill(makeShadow_bool)
     
-    input_sets = _np.column_stack([products_begin,products_end,repository,target_dir,h24,makeShadow,products_day,run])
-
-    with _Pool(processes = num_cores) as p:
-        if tqdm: list(_tqdm.tqdm_notebook(p.imap(_gen_orbclk, input_sets), total=input_sets.shape[0]))
-        else: p.map(_gen_orbclk, input_sets)
-    _rmtree(tmp_merge_path) #cleaning
-
+    input_sets = _np.column_stack([products_begin,products_end,repository,target_dir,h24,makeShadow,products_day.astype(str),run])
+    #pos file is published last so its presence marks the complete day
+    missing = _np.asarray([not _os.path.isfile('{}/{}.pos.gz'.format(target,day)) for target,day in input_sets[:,[3,6]]],dtype=bool)
+    print('{} days present in {}. Generating {} days'.format((~missing).sum(),target_path,missing.sum()))
+    input_sets = input_sets[missing]
+    if input_sets.shape[0] == 0: return
+
+    if not _os.path.exists(run_dir): _os.makedirs(run_dir)
+    tmp_merge_path = _tempfile.mkdtemp(prefix='tmp_merge_',dir=run_dir) #concurrent runs never share staged products and day dirs
+    input_sets[:,7] = tmp_merge_path + '/' + input_sets[:,6]
+    try:
+        if batched:
+            #blocks of consecutive days so each worker reuses staged neighbour days products
+            n_blocks = min(input_sets.shape[0], (num_cores if num_cores is not None else _mp.cpu_count())*4)
+            blocks = [block for block in _np.array_split(input_sets,n_blocks) if block.shape[0]>0]
+            with _Pool(processes = num_cores) as p:
+                if tqdm: list(_tqdm.tqdm_notebook(p.imap(_gen_orbclk_block, blocks), total=len(blocks)))
+                else: p.map(_gen_orbclk_block, blocks)
+        else:
+            with _Pool(processes = num_cores) as p:
+                if tqdm: list(_tqdm.tqdm_notebook(p.imap(_gen_orbclk, input_sets), total=input_sets.shape[0]))
+                else: p.map(_gen_orbclk, input_sets)
+    finally:
+        _rmtree(tmp_merge_path,ignore_errors=True) #this run only
+
+
+def _publish_orbclk(run_dir,products_day,targetDir):
+    '''Renames GNSS.* files produced in run_dir to products_day.*, gzips them and copies to targetDir under tmp names followed by rename.
+    pos file is published last as it marks the complete day'''
+    files_ori = sorted(_glob.glob('{}/GNSS.*'.format(run_dir)))
+    if len(files_ori) == 0:
+        print(str(products_day),'problem found'); return
+    files_renamed = [_os.path.join(run_dir,str(products_day) + '.' + _os.path.basename(file).split('.',1)[1]) for file in files_ori]
+    for file_ori,file_renamed in zip(files_ori,files_renamed):
+        _os.rename(file_ori,file_renamed)
+    #gzip in worker threads (in-process, no shell)
+    files_gz = sorted(_compress_files(files_renamed),key=lambda file: file.endswith('.pos.gz'))
+    if not _os.path.exists(targetDir):
+        _os.makedirs(targetDir)
+    for file_gz in files_gz:
+        dst = _os.path.join(targetDir,_os.path.basename(file_gz))
+        tmp_dst = '{}.{}.tmp'.format(dst,_os.getpid())
+        _copy(src=file_gz,dst=tmp_dst) #run_dir is on tmpfs so plain rename is not possible
+        _os.replace(tmp_dst,dst)
+        _os.remove(file_gz)
+
+_fetcher = None #FetchGNSSproducts instance of the worker process. Created on first call and reused for all days processed by the worker
+
+def _stage_products(repository,stage_dir,days):
+    '''Keeps worker-local copy of repository products for days in stage_dir (tmpfs). Year directories are real, all other top-level entries
+    of the repository are symlinked. Files of days already staged are reused, days not needed anymore are removed'''
+    if not _os.path.exists(stage_dir):
+        _os.makedirs(stage_dir)
+        for entry in _os.listdir(repository):
+            if not (_os.path.isdir(_os.path.join(repository,entry)) and entry.isdigit()):
+                _os.symlink(_os.path.join(repository,entry),_os.path.join(stage_dir,entry))
+    days = set(str(day) for day in days)
+    for staged in _glob.glob('{}/[0-9][0-9][0-9][0-9]/*'.format(stage_dir)):
+        if _os.path.basename(staged)[:10] not in days: _os.remove(staged)
+    for day in days:
+        year_dir = _os.path.join(stage_dir,day[:4])
+        if not _os.path.exists(year_dir): _os.makedirs(year_dir)
+        for src in _glob.glob('{}/{}/{}*'.format(repository,day[:4],day)):
+            dst = _os.path.join(year_dir,_os.path.basename(src))
+            if not _os.path.exists(dst): _copy(src=src,dst=dst)
+
+def _gen_orbclk_block(input_sets):
+    '''Generates merged products for a block of consecutive days in-process with a single FetchGNSSproducts instance.
+    Neighbour days products needed for the 30h window are staged once on tmpfs and reused by the following days'''
+    global _fetcher
+    if _fetcher is None: _fetcher = FetchGNSSproducts()
+    worker_dir = _worker_scratch(_os.path.dirname(_os.path.abspath(input_sets[0][7]))) #tmp_merge_abc123/<pid>
+    stage_dir = _os.path.join(worker_dir,'repository')
+    run_dir = _os.path.join(worker_dir,'run')
+
+    for input_set in input_sets:
+        startTime,endTime,GNSSproducts,targetDir,h24,makeShadow,products_day = input_set[:7]
+        day64 = _np.datetime64(products_day)
+        _stage_products(repository=GNSSproducts,stage_dir=stage_dir,days=_np.arange(day64-1,day64+2))
+
+        if _os.path.exists(run_dir): _rmtree(run_dir)
+        _os.makedirs(run_dir)
+        _fetcher.targetDir = run_dir
+        _fetcher.repository = stage_dir
+        _fetcher.highRate = False
+        _fetcher.quat = False
+        _fetcher.prodType = 'fid'
+        _fetcher.hr24 = bool(h24)
+        try:
+            _fetcher.makeFiles(int(startTime),int(endTime),intersection=False,shad=bool(makeShadow))
+        except Exception as e:
+            print(str(products_day),'fetchGNSSproducts error: {}'.format(e)); continue
+        _publish_orbclk(run_dir=run_dir,products_day=products_day,targetDir=targetDir)
+    _rmtree(worker_dir)
 
 def _gen_orbclk(input_set):
     startTime = input_set[0]
@@ -294,7 +545,7 @@ def _gen_orbclk(input_set):
         _os.makedirs(run_dir)
     
     
-    args = ['/home/bogdanm/Desktop/GipsyX_Wrapper/fetchGNSSproducts_J2000.py',
+    args = [_os.path.join(_os.path.dirname(_os.path.dirname(_os.path.abspath(__file__))),'fetchGNSSproducts_J2000.py'),
                       '-startTime',str(startTime),
                       '-endTime', str(endTime),
                       '-GNSSproducts', GNSSproducts,
@@ -306,23 +557,7 @@ def _gen_orbclk(input_set):
     process = _Popen(args,stdout=_PIPE)
     out, err = process.communicate()
 
-    #rename
-    files_ori = _glob.glob('{}/GNSS.*'.format(run_dir))
-
-    try:
-        files_ori_df = _pd.Series(files_ori).str.split('.',expand=True)
-    except: print(str(products_day),'problem found')
-        
-    files_renamed = files_ori_df[0].str.slice(0,-4) + str(products_day) + '.' + files_ori_df[1]
-    for i in range(files_renamed.shape[0]):
-        _os.rename(files_ori[i],files_renamed[i])
-    #gzip
-    _Popen(['gzip *'],cwd=run_dir,shell=True).communicate()
-    #move one level up
-    if not _os.path.exists(targetDir):
-        _os.makedirs(targetDir)
-    for i in range(files_renamed.shape[0]):
-        _move(src=files_renamed[i]+'.gz',dst=targetDir)
+    _publish_orbclk(run_dir=run_dir,products_day=products_day,targetDir=targetDir)
     _rmtree(run_dir)
     return out,err
 
@@ -338,67 +573,68 @@ def _gen_orbclk(input_set):
 # 2. modify having the output to cm_*pos.gz
 # 3. copy output renaming it to the original
 
-def ce2cm(init_ce_path,num_cores = 10,tqdm=True):
-    cache='/run/user/1017/'
-    cache_path = _os.path.join(cache,'ce2cm_cache')
+def ce2cm(init_ce_path,num_cores = 10,tqdm=True,cache_path='/run/user/1017'):
+    '''Creates init_ce_path_cm products tree incrementally. Non-pos products are symlinked to the CE files, pos files are converted with
+    orbitCmCorrection only if missing in the CM tree or if CE pos file changed (CM pos files get the mtime of the CE source).
+    cache_path is the project cache (tmpfs). Every run gets its own scratch base there, each worker converts into its own dir within it
+    and outputs are renamed into place'''
+    cache_path = _os.path.abspath(cache_path)
     if not _os.path.exists(cache_path): _os.makedirs(cache_path)
-    
+
     init_ce_path = _os.path.abspath(init_ce_path) 
     cm_dirname = _os.path.basename(init_ce_path)+'_cm'
     init_cm_path = _os.path.join(_os.path.dirname(init_ce_path),cm_dirname)
-    if _os.path.exists(init_cm_path):
-        print('CM folder exists. Removing.')
-        _rmtree(init_cm_path)
-    print('Copying {} to {}'.format(_os.path.basename(init_ce_path),cm_dirname))
     
-    
-#     dst = _copytree(src=init_ce_path,dst=init_cm_path)
-    print('Finished copying to {}'.format(init_cm_path))
-#     pos_files = _glob.glob(init_cm_path+'/*/*pos.gz')
-#     print('Found {} pos files. Running'.format(len(pos_files)))
-    
-    #files to make symlinks
-    product_files = _pd.Series(_glob.glob(init_ce_path+'/*/*.gz'))
-    product_file_names_df = product_files.str.split('/',expand=True).iloc[:,-1].str.split('.',expand=True)
-    symlink_files = product_files[product_file_names_df[1] != 'pos'].to_list()
-    # files to copy (.pos)
-    pos_files = product_files[product_file_names_df[1] == 'pos'].to_list()
-    
-    basedir = _os.path.abspath(_os.path.join(symlink_files[0],_os.pardir,_os.pardir,_os.pardir))
-    files_symlinks = _pd.Series(symlink_files).str.split('/',expand=True).iloc[:,-3:]
-    symlink_src = (basedir + '/' + files_symlinks.iloc[:,0]+'/'+files_symlinks.iloc[:,1]+'/'+files_symlinks.iloc[:,2])
-    symlink_dst = (basedir + '/' + files_symlinks.iloc[:,0]+'_cm/'+files_symlinks.iloc[:,1]+'/'+files_symlinks.iloc[:,2])
+    product_files = sorted(_glob.glob(init_ce_path+'/*/*.gz'))
+    symlink_src,symlink_dst,pos_src,pos_dst = [],[],[],[]
+    for product_file in product_files:
+        year_dir = _os.path.basename(_os.path.dirname(product_file))
+        dst = _os.path.join(init_cm_path,year_dir,_os.path.basename(product_file))
+        if _os.path.basename(product_file).split('.')[1] != 'pos':
+            symlink_src.append(product_file); symlink_dst.append(dst)
+        else:
+            pos_src.append(product_file); pos_dst.append(dst)
 
-    year_dirs = basedir + '/' + files_symlinks.iloc[:,0][0]+'_cm/' + files_symlinks.iloc[:,1].unique()
-    for dir_path in year_dirs:
+    for dir_path in set(_os.path.dirname(dst) for dst in symlink_dst + pos_dst):
         if not _os.path.exists(dir_path): _os.makedirs(dir_path)
-    print('creating symlinks for products files (except for *.pos.gz)')
-    for i in range(len(symlink_src)):
-        _os.symlink(src=_os.path.relpath(path=symlink_src[i],start=_os.path.dirname(symlink_dst[i])),dst=symlink_dst[i])
-    
-    files_pos = _pd.Series(pos_files).str.split('/',expand=True).iloc[:,-3:]
-    pos_src = (basedir + '/' + files_pos.iloc[:,0]+'/'+files_pos.iloc[:,1]+'/'+files_pos.iloc[:,2])
-    pos_dst = (basedir + '/' + files_pos.iloc[:,0]+'_cm/'+files_pos.iloc[:,1]+'/'+files_pos.iloc[:,2])
-    cache_path_series = _np.ndarray(pos_src.shape,dtype=object)
-    cache_path_series.fill(cache_path)
-    pos_path_series = _pd.concat([pos_src,pos_dst,_pd.Series(cache_path_series)],axis=1).values
-#     return pos_path_series
-    with _Pool(processes = num_cores) as p:
-        if tqdm: list(_tqdm.tqdm_notebook(p.imap(_ce2cm_single_thread, pos_path_series), total=len(pos_path_series)))
-        else: p.map(_ce2cm_single_thread, pos_path_series)
-    _rmtree(path=cache_path)
+
+    n_symlinks = 0
+    for src,dst in zip(symlink_src,symlink_dst):
+        if not _os.path.lexists(dst):
+            _os.symlink(src=_os.path.relpath(path=src,start=_os.path.dirname(dst)),dst=dst); n_symlinks+=1
+    print('{} symlinks created for products files (except for *.pos.gz)'.format(n_symlinks))
+
+    #pos files that are missing or which CE source changed since conversion
+    pos_path_series = _np.asarray([[src,dst,None] for src,dst in zip(pos_src,pos_dst)
+                        if not (_os.path.exists(dst) and (_os.stat(dst).st_mtime_ns == _os.stat(src).st_mtime_ns))],dtype=object).reshape(-1,3)
+    print('{} of {} pos files to convert'.format(pos_path_series.shape[0],len(pos_src)))
+    if pos_path_series.shape[0] > 0:
+        scratch_base = _tempfile.mkdtemp(prefix='ce2cm_',dir=cache_path)
+        pos_path_series[:,2] = scratch_base
+        num_cores = num_cores if pos_path_series.shape[0] > num_cores else pos_path_series.shape[0]
+        try:
+            with _Pool(processes = num_cores) as p:
+                if tqdm: list(_tqdm.tqdm_notebook(p.imap(_ce2cm_single_thread, pos_path_series), total=len(pos_path_series)))
+                else: p.map(_ce2cm_single_thread, pos_path_series)
+        finally:
+            _rmtree(scratch_base,ignore_errors=True) #workers' dirs of this run only
     
 
 def _ce2cm_single_thread(pos_path_series):
-    pos_src,pos_dst,cache_path = pos_path_series
-    # fuction will rewrite the input pos file by cm corrected version
-#     pos_src = _os.path.abspath(pos_src)
-    
-    #copy to cache. create single test folder
-    _copy(src=pos_src,dst=cache_path)
-    
-    input_path = _os.path.join(cache_path,_os.path.basename(pos_src))
+    '''Runs orbitCmCorrection reading CE pos file directly and writing into worker cache dir. Output gets source mtime and is moved
+    into the CM tree under a tmp name followed by rename'''
+    pos_src,pos_dst,scratch_base = pos_path_series
+    worker_cache = _worker_scratch(scratch_base) #smth like /cache/ce2cm_abc123/12345/
+    output_path = _os.path.join(worker_cache,_os.path.basename(pos_dst))
 
-    process = _Popen(['orbitCmCorrection','-s','-i',input_path,'-o',pos_dst])
+    process = _Popen(['orbitCmCorrection','-s','-i',pos_src,'-o',output_path])
     process.wait()
-    _os.remove(input_path)
\ No newline at end of file
+    if (process.returncode != 0) or (not _os.path.exists(output_path)):
+        print('orbitCmCorrection failed on {}'.format(pos_src))
+        if _os.path.exists(output_path): _os.remove(output_path)
+        return
+    src_stat = _os.stat(pos_src)
+    _os.utime(output_path,ns=(src_stat.st_atime_ns,src_stat.st_mtime_ns))
+    tmp_dst = '{}.{}.tmp'.format(pos_dst,_os.getpid())
+    _move(src=output_path,dst=tmp_dst) #preserves mtime
+    _os.replace(tmp_dst,pos_dst)
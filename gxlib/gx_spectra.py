@@ -0,0 +1,164 @@
+'''Welch PSD of ENV series for many stations and constellations. All components and constellations of a station are one 2-D batch
+sharing the cached Parzen-tapered window. Gaps are not zero-filled: Welch segments are taken within contiguous blocks of data only,
+series whose gap-free segments miss a large part of the data fall back to Lomb-Scargle.
+Stations run in the pool, each worker loads its own mGNSS env gather and returns only its PSD table that is also persisted to
+spectra cache dir, so plotting does not recompute it'''
+import os as _os
+from multiprocessing import Pool as _Pool
+
+import numpy as _np
+import pandas as _pd
+from scipy import signal as _signal
+
+from .gx_aux import _dump_read, _dump_write
+from .gx_eterna import env2eterna as _env2eterna
+from .gx_hardisp import gen_synth_otl as _gen_synth_otl
+from .gx_hardisp import read_blq as _read_blq
+
+_spectra_cache_lbl = 'spectra'
+_windows = {} #(samples, fraction): window
+_constellations = ['GPS','GLONASS','GPS+GLONASS']
+
+def gen_parzen(samples,fraction):
+    '''Window of ones with Parzen tapers on both ends, samples*fraction in total. Built once per (samples, fraction) in the process'''
+    key = (samples,fraction)
+    if key not in _windows:
+        window = _np.ones(samples)
+        parzen_window = _signal.windows.parzen(round(samples*fraction))
+        parzen_window_left = parzen_window[:round(parzen_window.shape[0]/2)]
+        parzen_window_right = parzen_window[round(parzen_window.shape[0]/2):]
+        window[:parzen_window_left.shape[0]] = parzen_window_left
+        window[-parzen_window_right.shape[0]:] = parzen_window_right
+        window.flags.writeable = False #shared between calls
+        _windows[key] = window
+    return _windows[key]
+
+def _segment_starts(valid,nperseg,step):
+    '''Start indices of segments of nperseg samples moved by step within every contiguous run of valid samples'''
+    edges = _np.diff(_np.concatenate([[0],valid.astype(_np.int8),[0]]))
+    run_begins, run_ends = _np.flatnonzero(edges == 1), _np.flatnonzero(edges == -1)
+    n_segments = _np.maximum((run_ends - run_begins - nperseg)//step + 1,0)
+    offsets = _np.arange(n_segments.sum()) - _np.repeat(_np.cumsum(n_segments) - n_segments,n_segments)
+    return _np.repeat(run_begins,n_segments) + offsets*step
+
+def _welch_coverage(valid,nperseg):
+    '''Fraction of valid samples within the contiguous runs long enough for Welch segments. Run tails shorter than a step are
+    counted in, as plain Welch drops them too'''
+    edges = _np.diff(_np.concatenate([[0],valid.astype(_np.int8),[0]]))
+    runs = _np.flatnonzero(edges == -1) - _np.flatnonzero(edges == 1)
+    return runs[runs >= nperseg].sum()/max(runs.sum(),1)
+
+def _lombscargle_psd(values,window_size,fs,min_coverage):
+    '''One-sided PSD (n_freq, k) of columns sharing missing values from Lomb-Scargle periodograms of segments of window_size samples
+    (half overlap) that keep at least min_coverage of their samples. Periodograms are averaged and scaled by 2/fs, so white noise has
+    the level of Welch PSD (segments are not tapered). On the rfft frequency grid the Lomb-Scargle sums are exact FFTs of the series
+    with missing samples left out (set to 0) and of the valid mask at double frequency. DC and Nyquist are NaN.
+    None if no segment has enough samples'''
+    valid = ~_np.isnan(values[:,0])
+    double_freq = (2*_np.arange(window_size//2 + 1)) % window_size
+    psd = 0
+    n_segments = 0
+    for start in range(0,max(values.shape[0] - window_size,0) + 1,window_size - window_size//2):
+        segment_valid = valid[start:start + window_size]
+        n = segment_valid.sum()
+        if n < min_coverage*window_size: continue
+        segment = values[start:start + window_size]
+        segment = _np.where(segment_valid[:,_np.newaxis],segment - _np.nanmean(segment,axis=0),0)
+        W = _np.conj(_np.fft.fft(segment_valid,n=window_size))[double_freq] #sum of exp(2i*w*t)
+        Q = _np.conj(_np.fft.rfft(segment,n=window_size,axis=0))*_np.exp(-0.5j*_np.angle(W))[:,_np.newaxis] #sum of y*exp(i*w*(t - tau))
+        with _np.errstate(invalid='ignore',divide='ignore'):
+            psd = psd + Q.real**2/(n + _np.abs(W))[:,_np.newaxis] + Q.imag**2/(n - _np.abs(W))[:,_np.newaxis]
+        n_segments += 1
+    if n_segments == 0: return None
+    psd = psd*2/(fs*n_segments)
+    psd[0] = _np.nan
+    if window_size%2 == 0: psd[-1] = _np.nan
+    return psd
+
+def welch_psd(values,window_size=14016,fs=48,min_coverage=0.5,min_welch_coverage=0.75):
+    '''Gap-aware one-sided Welch PSD of every column of values (n, k). Segments (half overlap, mean removed) are taken within contiguous
+    runs of valid samples only, so missing values (NaN) are neither zero-filled nor interpolated. Without gaps the result equals
+    scipy.signal.welch. Columns with the same missing values share segments. Columns whose runs long enough for a segment hold less than
+    min_welch_coverage of their valid samples (e.g. scattered outlier holes, a single clean stretch in a gappy series) fall back to
+    Lomb-Scargle of segments holding at least min_coverage of their samples (see _lombscargle_psd), Welch is kept if there are none.
+    Columns without any usable segment are NaN. Returns frequencies (cycles per day for fs=48) and PSD (n_freq, k)'''
+    values = _np.asarray(values,dtype=_np.float64)
+    values = values.reshape(values.shape[0],-1)
+    window = gen_parzen(window_size,0.1)
+    scale = 1/(fs*(window**2).sum())
+    freq = _np.fft.rfftfreq(window_size,1/fs)
+    psd = _np.full((freq.shape[0],values.shape[1]),_np.nan)
+
+    valid = ~_np.isnan(values)
+    masks, inverse = _np.unique(valid.T,axis=0,return_inverse=True)
+    inverse = inverse.ravel()
+    for mask_id in range(masks.shape[0]):
+        columns = _np.flatnonzero(inverse == mask_id)
+        starts = _segment_starts(masks[mask_id],window_size,window_size - window_size//2) #same segments as welch default noverlap
+        if _welch_coverage(masks[mask_id],window_size) < min_welch_coverage: #Welch would drop most of the data
+            fallback = _lombscargle_psd(values[:,columns],window_size,fs,min_coverage)
+            if fallback is not None:
+                psd[:,columns] = fallback
+                continue
+        if starts.shape[0] == 0: continue
+        segments = values[starts[:,_np.newaxis] + _np.arange(window_size)][:,:,columns] #(n_segments, window_size, n_columns)
+        segments = (segments - segments.mean(axis=1,keepdims=True))*window[:,_np.newaxis]
+        power = _np.abs(_np.fft.rfft(segments,axis=1))**2*scale
+        power[:,1:(None if window_size%2 else -1)] *= 2 #one-sided, DC and Nyquist are not doubled
+        psd[:,columns] = power.mean(axis=0)
+    return freq, psd
+
+def psd_df(data,window_size=14016,fs=48):
+    '''PSD dataframe of data columns indexed by frequency'''
+    freq, psd = welch_psd(data.values,window_size=window_size,fs=fs)
+    return _pd.DataFrame(psd,index=freq,columns=data.columns)
+
+def station_spectra(ets,window_size=14016):
+    '''PSD table of {constellation: env_et} of a single station. Columns are (constellation, component), one welch call for all'''
+    data = _pd.concat([ets[constellation] for constellation in _constellations],axis=1,keys=_constellations)
+    return psd_df(data,window_size=window_size)
+
+def _spectra_path(cache_dir,station_name,restore_otl,remove_outliers,window_size,backend,blq_file,sampling):
+    '''Cache path of station PSD table. Restored OTL tables are keyed by backend, crc of blq file and sampling too'''
+    otl = '_'.join(['otl',backend,'{:08x}'.format(_read_blq(blq_file)['crc']),str(sampling)]) if restore_otl else 'nootl'
+    return _os.path.join(cache_dir,'{}_{}{}_{}_segments.zstd'.format(station_name.lower(),otl,'' if remove_outliers else '_raw',window_size))
+
+def _spectra_single_thread(values_set):
+    '''Loads station gather (or takes gather), prepares ETERNA-like series of all constellations, restores OTL if needed and
+    computes PSD table. If gather is a path, table is read from cache_dir if newer than the gather and not force. Tables of
+    in-memory gathers are always computed (and not persisted) as there is nothing to check the cached table against'''
+    gather,station_name,remove_outliers,restore_otl,blq_file,sampling,hardisp_path,eterna_path,backend,window_size,cache_dir,force = values_set
+    spectra_path = None
+    if (cache_dir is not None) and isinstance(gather,str):
+        spectra_path = _spectra_path(cache_dir,station_name,restore_otl,remove_outliers,window_size,backend,blq_file,sampling)
+        if (not force) and _os.path.exists(spectra_path) and (_os.path.getmtime(spectra_path) >= _os.path.getmtime(gather)):
+            return _dump_read(spectra_path)
+
+    gather = _dump_read(gather) if isinstance(gather,str) else gather
+    ets = {constellation:_env2eterna(gather[constellation],remove_outliers) for constellation in _constellations}
+    if restore_otl:
+        #timeframe is the same for the three constellations so we can take any of them. GPS in this case
+        synth_otl = _gen_synth_otl(dataset = ets['GPS'],station_name = station_name,hardisp_path=hardisp_path,blq_file=blq_file,sampling=sampling,backend=backend,
+                                   eterna_path=eterna_path)
+        ets = {constellation:et + synth_otl for constellation,et in ets.items()}
+    spectra = station_spectra(ets,window_size=window_size)
+    no_segments = spectra.columns[spectra.isnull().all(axis=0).values]
+    if len(no_segments) > 0:
+        print('{}: no usable segment for {}. PSD is NaN'.format(station_name,', '.join('/'.join(column) for column in no_segments)))
+
+    if spectra_path is not None:
+        tmp_path = '{}.{}.tmp'.format(spectra_path,_os.getpid())
+        _dump_write(filename=tmp_path,data=spectra,num_cores=1,cname='zstd')
+        _os.replace(tmp_path,spectra_path)
+    return spectra
+
+def spectra(gathers,stations_list,num_cores,blq_file,hardisp_path,eterna_path=None,restore_otl=True,remove_outliers=True,sampling=1800,
+            backend='hardisp',window_size=14016,cache_dir=None,force=False):
+    '''PSD tables (list, order of stations_list) of mGNSS gathers or paths to their dumps. Stations run in parallel.
+    If cache_dir is given, tables of gathers given as paths are persisted there and reused until the gather changes (all recomputed if force).
+    backend of synthetic OTL is hardisp or native (needs eterna_path for the tidal potential catalogue)'''
+    if (cache_dir is not None) and (not _os.path.exists(cache_dir)): _os.makedirs(cache_dir)
+    sets = [[gather,station_name,remove_outliers,restore_otl,blq_file,sampling,hardisp_path,eterna_path,backend,window_size,cache_dir,force]
+            for gather,station_name in zip(gathers,stations_list)]
+    with _Pool(max(1,min(num_cores,len(sets)))) as p:
+        return list(p.imap(_spectra_single_thread,sets,chunksize=1))
@@ -0,0 +1,77 @@
+'''Parsed staDb shared by all modules. staDb is parsed once per version (crc32 of the file, same as computed by gen_staDb) and kept
+in the process. Optionally the parsed tables are stored in cache_dir as {crc}.pickle so other processes and nodes skip parsing'''
+import binascii as _binascii
+import os as _os
+import pickle as _pickle
+
+import numpy as _np
+import pandas as _pd
+
+from .gx_const import J2000origin
+
+_staDb_cache = {} #crc: parsed staDb
+_staDb_objects = {} #crc: gcore StationDataBase object
+
+def staDb_crc(staDb_path):
+    '''crc32 of staDb file as computed by gen_staDb'''
+    with open(staDb_path,'rb') as f:
+        return _binascii.crc32(f.read()) & 0xffffffff
+
+def _epoch2J2000(date,time):
+    '''staDb epoch (e.g. 1-01-01 00:00:00) to J2000 seconds. Unparsable epochs give nan'''
+    try: return (_np.datetime64('{:0>10}T{}'.format(date,time)) - J2000origin).astype('timedelta64[s]').astype(_np.float64)
+    except ValueError: return _np.nan
+
+def _parse_staDb(staDb_path):
+    '''Parses ID, STATE, ANT and RX records of staDb into dataframes. Records keep file order'''
+    ID, STATE, ANT, RX = [], [], [], []
+    with open(staDb_path,'r') as f:
+        for line in f:
+            record, _, comment = line.partition('#')
+            fields = record.split()
+            if (len(fields) < 2) or (fields[0] == 'KEYWORDS:'): continue
+            if (fields[1] == 'ID') and (len(fields) >= 3):
+                ID.append([fields[0],fields[2],' '.join(fields[3:])])
+            elif (fields[1] == 'STATE') and (len(fields) >= 10):
+                STATE.append([fields[0],_epoch2J2000(fields[2],fields[3])] + [float(value) for value in fields[4:10]])
+            elif (fields[1] == 'ANT') and (len(fields) >= 9):
+                ANT.append([fields[0],_epoch2J2000(fields[2],fields[3]),fields[4],fields[5]] + [float(value) for value in fields[6:9]] + [comment.strip()])
+            elif (fields[1] == 'RX') and (len(fields) >= 5):
+                RX.append([fields[0],_epoch2J2000(fields[2],fields[3]),' '.join(fields[4:]),comment.strip()])
+    return {'ID':_pd.DataFrame(ID,columns=['Station','IERS','location']),
+            'STATE':_pd.DataFrame(STATE,columns=['Station','epoch','X','Y','Z','VX','VY','VZ']),
+            'ANT':_pd.DataFrame(ANT,columns=['Station','epoch','antenna','radome','east','north','vertical','comment']),
+            'RX':_pd.DataFrame(RX,columns=['Station','epoch','receiver','comment'])}
+
+def read_staDb(staDb_path,cache_dir=None):
+    '''Returns parsed staDb as dict of ID, STATE, ANT and RX dataframes (epochs in J2000 seconds) plus crc and names (stations in file order).
+    Parsed once per staDb crc in the process. If cache_dir is given, parsed tables are also read from/written to cache_dir/{crc}.pickle'''
+    crc = staDb_crc(staDb_path)
+    if crc in _staDb_cache: return _staDb_cache[crc]
+
+    cache_path = _os.path.join(cache_dir,'{:08X}.pickle'.format(crc)) if cache_dir is not None else None
+    if (cache_path is not None) and _os.path.exists(cache_path):
+        with open(cache_path,'rb') as f: parsed = _pickle.load(f)
+    else:
+        parsed = _parse_staDb(staDb_path)
+        parsed['crc'] = crc
+        parsed['names'] = _pd.unique(_pd.concat([parsed['ID']['Station'],parsed['STATE']['Station']])).tolist()
+        if cache_path is not None:
+            if not _os.path.exists(cache_dir): _os.makedirs(cache_dir)
+            tmp_path = '{}.{}.tmp'.format(cache_path,_os.getpid())
+            with open(tmp_path,'wb') as f: _pickle.dump(parsed,f)
+            _os.replace(tmp_path,cache_path)
+    _staDb_cache[crc] = parsed
+    return parsed
+
+def staDb_ref_xyz(staDb_path):
+    '''Station and X, Y, Z of every STATE record. Same as former read_csv based get_ref_xyz_sites'''
+    return read_staDb(staDb_path)['STATE'][['Station','X','Y','Z']].reset_index(drop=True)
+
+def staDb_object(staDb_path):
+    '''gcore StationDataBase object for staDb_path, constructed once per staDb crc in the process. gcore is imported only here'''
+    crc = staDb_crc(staDb_path)
+    if crc not in _staDb_objects:
+        import gcore.StationDataBase as _StationDataBase
+        _staDb_objects[crc] = _StationDataBase.StationDataBase(dataBase = staDb_path)
+    return _staDb_objects[crc]
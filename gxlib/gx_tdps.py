@@ -8,11 +8,11 @@ import numpy as _np
 import pandas as _pd
 import tqdm as _tqdm
 
-import gcore.EarthCoordTrans as _eo
-import gcore.StationDataBase as _StationDataBase
 import gipsyx.tropNom as _tropNom
 
-from .gx_aux import J2000origin, _dump_read, drInfo_lbl, rnx_dr_lbl
+from .gx_aux import J2000origin, drInfo_partitions
+from .gx_geodesy import rot_env2xyz as _rot_env2xyz
+from .gx_stadb import staDb_object as _staDb_object, staDb_ref_xyz as _staDb_ref_xyz
 
 PYGCOREPATH="{}/lib/python{}.{}".format(_os.environ['GCOREBUILD'], _sys.version_info[0], _sys.version_info[1])
 if PYGCOREPATH not in _sys.path:
@@ -42,11 +42,10 @@ def gen_tropnom(tmp_dir,staDb_path,rate,VMF1_dir,num_cores):
     num_cores = int(num_cores)
 
     #Creates a staDb object
-    staDb=_StationDataBase.StationDataBase(dataBase = staDb_path) #creating staDb object
+    staDb=_staDb_object(staDb_path) #staDb object, constructed once per staDb version in the process
     stns = staDb.getStationList() #creating array with available station names
     print(len(stns),'sites found in staDb:',stns) #verbal output of stations that will be present in tropNom files
-    drinfo_file = _dump_read(filename='{}/{}/{}.zstd'.format(tmp_dir,rnx_dr_lbl,drInfo_lbl))
-    drinfo_years_list = drinfo_file.begin.dt.year.unique()
+    drinfo_years_list = _np.sort(drInfo_partitions(tmp_dir=tmp_dir,stations_list=stns)['year'].unique()) #years from partition names, drInfo is not read
 
     #creating folder and file structure taking into account leap year.
     #resulting paths look as follows: year/doy/30h_tropNominal.vmf1
@@ -115,16 +114,7 @@ def get_ref_xyz(staDb):
     2	HERT	4.033461e+06	 23537.6625	    4.924318e+06
     3	LOFT	3.706041e+06	-55853.0000	    5.173496e+06
     4	WEAR	3.686877e+06	-143592.0000	5.185648e+06'''
-    read = _pd.read_csv(staDb,delimiter=r'\s+',names=list(range(11)))
-    positions = read[read.iloc[:,1]=='STATE']
-    #refxyz = get_xyz_site(positions)
-    xyz_table = positions[[0,4,5,6]]
-    xyz_table.reset_index(inplace=True,drop=True)
-    
-    staDb_xyz = _pd.DataFrame()
-    staDb_xyz['Station'] = xyz_table[0]
-    staDb_xyz[['X','Y','Z']] = xyz_table[[4,5,6]].astype('float')
-    return staDb_xyz
+    return _staDb_ref_xyz(staDb) #parsed once per staDb version
 
 def write_tdp(output_file, tdp_concat):
     '''Function writes tdp data array to the output file with GipsyX tdp formatting'''
@@ -143,7 +133,7 @@ def write_tdp(output_file, tdp_concat):
 def get_rot(ref_xyz_df):
     '''Expects output of get_ref_xyz. Returns ndarray of rot matrices (one for each station in the input)'''
     refxyz_np = ref_xyz_df[['X','Y','Z']].values
-    return _np.asarray([_eo.rotEnv2Xyz(refxyz) for refxyz in refxyz_np],dtype=object)
+    return _rot_env2xyz(refxyz_np) #(n,3,3)
 
 def _gen_penna_tdp_file(np_set):
     '''Reads tdp file generated by GipsyX from tropNom model and creates E N V signals in nominal X Y Z '''
@@ -0,0 +1,370 @@
+'''Native least-squares tidal harmonic analysis. In-process alternative to ETERNA analyse for the wave groups of gx_eterna.ini_extra.
+Each wave group regressor is built from the waves of the tidal potential catalogue (ETERNA commdat) within the group frequency band,
+weighted by potential amplitude relative to the main wave, as ETERNA does. Without catalogue the main wave with lunar nodal
+corrections (f, u) stands for the satellite waves of the group.
+Arguments follow the Schwiderski/IERS ARG2 convention used by BLQ files and hardisp, so amplitude and Greenwich phase lag
+are estimated directly and returned as the blq-like table of gx_eterna.extract_et.
+Many stations and components are solved at once: the design matrix is built once on the union time grid and series with
+the same data mask share a single least-squares solution'''
+import os as _os
+import re as _re
+import time as _time
+
+import numpy as _np
+import pandas as _pd
+
+from .gx_const import J2000origin
+
+_DEG = _np.pi/180
+
+#wave groups of ini_extra: Doodson-like multipliers of solar hour angle t_s, lunar longitude s, solar longitude h, lunar perigee p,
+#phase offset (deg, ARG2 convention), nodal correction key and frequency band (cpd, WAVEGROUPI of ini_extra).
+#14h group has no tidal waves and is not estimated
+_groups = _pd.DataFrame([
+    ['SA',  0, 0, 1, 0,   0, None,  0.001379, 0.004107],
+    ['SSA', 0, 0, 2, 0,   0, None,  0.004108, 0.020884],
+    ['MM',  0, 1, 0,-1,   0, 'MM',  0.020885, 0.054747],
+    ['MF',  0, 2, 0, 0,   0, 'MF',  0.054748, 0.091348],
+    ['Q1',  1,-3, 1, 1,  90, 'O1',  0.501370, 0.911390],
+    ['O1',  1,-2, 1, 0,  90, 'O1',  0.911391, 0.947991],
+    ['P1',  1, 0,-1, 0,  90, None,  0.981855, 0.998631],
+    ['S1',  1, 0, 0, 0,   0, None,  0.998632, 1.001369],
+    ['K1',  1, 0, 1, 0, -90, 'K1',  1.001370, 1.004107],
+    ['J1',  1, 1, 1,-1,   0, 'J1',  1.023623, 1.057485],
+    ['OO1', 1, 2, 1, 0,   0, 'OO1', 1.057486, 1.470243],
+    ['N2',  2,-3, 2, 1,   0, 'M2',  1.880265, 1.914128],
+    ['M2',  2,-2, 2, 0,   0, 'M2',  1.914129, 1.950419],
+    ['L2',  2,-1, 2,-1,   0, None,  1.950420, 1.984282],
+    ['S2',  2, 0, 0, 0,   0, None,  1.984283, 2.002736],
+    ['K2',  2, 0, 2, 0,   0, 'K2',  2.002737, 2.451943],
+    ['M4',  4,-4, 4, 0,   0, 'M4',  3.791963, 3.937898],
+    ],columns=['wave','t_s','s','h','p','offset','nodal','band_from','band_to']).set_index('wave')
+
+blq_waves = ['M2','S2','N2','K2','K1','O1','P1','Q1','MF','MM','SSA','14h'] #rows of extract_et table
+
+def _astro(time):
+    '''Solar hour angle t_s and mean longitudes s, h, p, N (deg) for J2000 seconds (UT). Same polynomials as IERS ARG2'''
+    T = (time/86400 + 51544.5 - 15019.5)/36525 #Julian centuries since 1900 Jan 0.5
+    t_s = ((time + 43200) % 86400)/86400*360 + 180 #J2000 origin is at 12h
+    s = 270.434358 + (481267.88314137 + (-0.001133 + 1.9e-6*T)*T)*T
+    h = 279.69668 + (36000.768930485 + 3.03e-4*T)*T
+    p = 334.329653 + (4069.0340329577 + (-0.010325 - 1.2e-5*T)*T)*T
+    N = 259.182533 + (-1934.142397 + 0.002106*T)*T
+    return t_s, s, h, p, N
+
+def _solar_perigee(time):
+    '''Mean longitude of solar perigee ps (deg) for J2000 seconds'''
+    T = (time/86400 + 51544.5 - 15019.5)/36525
+    return 281.220833 + (1.719175 + (4.53e-4 + 3.0e-6*T)*T)*T
+
+#daily rates (deg) of Doodson arguments tau (mean lunar time), s, h, p, N' (= -N) and ps. Used for wave frequencies only
+_doodson_rates = _np.asarray([347.80925087,13.17639648,0.98564735,0.11140353,0.05295377,0.00004707])
+
+#degree 2 line of potential catalogue: optional wave number and name, degree, Doodson multipliers k1..k6 and signed amplitude
+_regex_wave = _re.compile(r'^\s*(?:\d+\s+)?(?:[^\s]*[A-Za-z][^\s]*\s+)?(2)\s+((?:[+-]?\d+\s+){6})([+-]?\d*\.\d+(?:[eEdD][+-]?\d+)?)')
+_catalogue_files = ['tamura87.dat','hw95s.dat','etcpot.dat'] #looked up in eterna_path/commdat. TIDALPOTEN of ini_extra is 4 (Tamura)
+_catalogues = {} #path: catalogue
+
+def read_potential_catalogue(path):
+    '''Degree 2 waves of tidal potential catalogue as dataframe of Doodson multipliers k1..k6 (tau, s, h, p, N', ps), signed amplitude
+    and frequency (cpd). Lines that are not degree 2 waves (headers, other degrees) are skipped. Within a wave group all waves are of
+    the same degree and order so the signed amplitude gives their relative phase (Cartwright-Tayler convention)'''
+    rows = []
+    with open(path,'r') as f:
+        for line in f:
+            match = _regex_wave.match(line)
+            if match is None: continue
+            rows.append([int(k) for k in match.group(2).split()] + [float(match.group(3).replace('D','e').replace('d','e'))])
+    catalogue = _pd.DataFrame(rows,columns=['k1','k2','k3','k4','k5','k6','amplitude'])
+    catalogue['freq'] = catalogue[['k1','k2','k3','k4','k5','k6']].values.dot(_doodson_rates)/360
+    return catalogue
+
+def potential_catalogue(eterna_path):
+    '''Tidal potential catalogue of ETERNA installation (first of _catalogue_files found in eterna_path/commdat), parsed once per path.
+    None if eterna_path is None or no catalogue is found'''
+    if eterna_path is None: return None
+    for name in _catalogue_files:
+        path = _os.path.join(eterna_path,'commdat',name)
+        if path in _catalogues: return _catalogues[path]
+        if _os.path.exists(path):
+            catalogue = read_potential_catalogue(path)
+            if catalogue.shape[0] == 0: continue
+            _catalogues[path] = catalogue
+            return catalogue
+    print('No tidal potential catalogue in {}. Nodal corrections are used for wave groups'.format(_os.path.join(eterna_path,'commdat')))
+    return None
+
+def _doodson_args(time):
+    '''Doodson arguments tau, s, h, p, N', ps (deg) as (n, 6) for J2000 seconds. tau = t_s + h - s'''
+    t_s, s, h, p, N = _astro(time)
+    return _np.column_stack([t_s + h - s,s,h,p,-N,_solar_perigee(time)])
+
+def _nodal(key,N):
+    '''Nodal factor f and angle u (deg) as functions of lunar node longitude N (rad)'''
+    if _pd.isna(key): return _np.ones_like(N), _np.zeros_like(N) #no nodal modulation (solar waves)
+    if key == 'M2':  return 1.0004 - 0.0373*_np.cos(N) + 0.0002*_np.cos(2*N), -2.14*_np.sin(N)
+    if key == 'M4':
+        f, u = _nodal('M2',N)
+        return f**2, 2*u
+    if key == 'K2':  return (1.0241 + 0.2863*_np.cos(N) + 0.0083*_np.cos(2*N) - 0.0015*_np.cos(3*N),
+                             -17.74*_np.sin(N) + 0.68*_np.sin(2*N) - 0.04*_np.sin(3*N))
+    if key == 'K1':  return (1.0060 + 0.1150*_np.cos(N) - 0.0088*_np.cos(2*N) + 0.0006*_np.cos(3*N),
+                             -8.86*_np.sin(N) + 0.68*_np.sin(2*N) - 0.07*_np.sin(3*N))
+    if key == 'O1':  return (1.0089 + 0.1871*_np.cos(N) - 0.0147*_np.cos(2*N) + 0.0014*_np.cos(3*N),
+                             10.80*_np.sin(N) - 1.34*_np.sin(2*N) + 0.19*_np.sin(3*N))
+    if key == 'J1':  return (1.0129 + 0.1676*_np.cos(N) - 0.0170*_np.cos(2*N) + 0.0016*_np.cos(3*N),
+                             -12.94*_np.sin(N) + 1.34*_np.sin(2*N) - 0.19*_np.sin(3*N))
+    if key == 'OO1': return (1.1027 + 0.6504*_np.cos(N) + 0.0317*_np.cos(2*N) - 0.0014*_np.cos(3*N),
+                             -36.68*_np.sin(N) + 4.02*_np.sin(2*N) - 0.57*_np.sin(3*N))
+    if key == 'MF':  return (1.0429 + 0.4135*_np.cos(N) - 0.004*_np.cos(2*N),
+                             -23.74*_np.sin(N) + 2.68*_np.sin(2*N) - 0.38*_np.sin(3*N))
+    if key == 'MM':  return 1.0000 - 0.1300*_np.cos(N) + 0.0013*_np.cos(2*N), _np.zeros_like(N)
+    raise ValueError('Unknown nodal correction {}'.format(key))
+
+def _group_waves(group,catalogue):
+    '''Catalogue waves of the group band with amplitudes relative to the main wave (Doodson multipliers of the group, largest if absent)
+    and their multipliers relative to it. None if the band has no waves of the group species'''
+    k1 = group.t_s
+    waves = catalogue[(catalogue['freq'] >= group.band_from) & (catalogue['freq'] <= group.band_to) & (catalogue['k1'] == k1)]
+    if waves.shape[0] == 0: return None
+    multipliers = waves[['k1','k2','k3','k4','k5','k6']].values
+    main_multipliers = _np.asarray([k1,group.s + k1,group.h - k1,group.p,0,0]) #t_s = tau + s - h
+    is_main = (multipliers == main_multipliers).all(axis=1)
+    main = _np.flatnonzero(is_main)[0] if is_main.any() else _np.argmax(_np.abs(waves['amplitude'].values))
+    return waves['amplitude'].values/waves['amplitude'].values[main], multipliers - multipliers[main]
+
+def _catalogue_nodal(group,catalogue,doodson_args):
+    '''Group factor F and angle U (deg) from catalogue satellites: F*exp(iU) = sum of relative amplitude*exp(i*relative argument).
+    Replaces nodal f, u of the main wave. None if the band has no catalogue waves'''
+    group_waves = _group_waves(group,catalogue)
+    if group_waves is None: return None
+    weights, relative = group_waves
+    phasor = _np.zeros(doodson_args.shape[0],dtype=_np.complex128)
+    for weight,multipliers in zip(weights,relative):
+        phasor += weight*_np.exp(1j*_DEG*doodson_args.dot(multipliers))
+    return _np.abs(phasor), _np.angle(phasor,deg=True)
+
+def design_matrix(time,groups=_groups,catalogue=None):
+    '''Design matrix (n, 2 + 2*n_groups) for J2000 seconds: offset, linear trend and F*cos(V+U), F*sin(V+U) per wave group.
+    F, U come from catalogue waves of the group band if catalogue is given (see potential_catalogue), else nodal f, u'''
+    time = _np.asarray(time,dtype=_np.float64)
+    t_s, s, h, p, N = _astro(time)
+    if catalogue is not None: doodson_args = _doodson_args(time)
+    N = N*_DEG
+    span = max(time[-1] - time[0],1.0) if time.shape[0] > 0 else 1.0
+    A = _np.empty((time.shape[0],2 + 2*groups.shape[0]))
+    A[:,0] = 1
+    A[:,1] = (time - time.mean())/span if time.shape[0] > 0 else 0 #normalized for conditioning
+    for i,group in enumerate(groups.itertuples()):
+        f_u = _catalogue_nodal(group,catalogue,doodson_args) if catalogue is not None else None
+        f, u = f_u if f_u is not None else _nodal(group.nodal,N)
+        arg = (group.t_s*t_s + group.s*s + group.h*h + group.p*p + group.offset + u)*_DEG
+        A[:,2 + 2*i] = f*_np.cos(arg)
+        A[:,3 + 2*i] = f*_np.sin(arg)
+    return A
+
+def _solve(A,Y):
+    '''Least-squares for series Y (n, k) sharing design A (n, m). Returns coefficients (m, k) and their variances/covariances
+    needed for amplitude and phase: cov (m, m) unscaled and residual variance (k,)'''
+    n, m = A.shape
+    if n <= m: return _np.full((m,Y.shape[1]),_np.nan), _np.full((m,m),_np.nan), _np.full(Y.shape[1],_np.nan)
+    coeff, _, rank, _ = _np.linalg.lstsq(A,Y,rcond=None)
+    residuals = Y - A.dot(coeff)
+    sigma2 = (residuals**2).sum(axis=0)/(n - rank)
+    return coeff, _np.linalg.pinv(A.T.dot(A)), sigma2
+
+def _amplitude_phase(a,b,var_a,var_b,cov_ab):
+    '''Amplitude, its std, phase (deg) and its std from cos/sin coefficients a, b and their (co)variances'''
+    amplitude = _np.hypot(a,b)
+    with _np.errstate(invalid='ignore',divide='ignore'):
+        amplitude_std = _np.sqrt((a**2*var_a + b**2*var_b + 2*a*b*cov_ab))/amplitude
+        phase_std = _np.rad2deg(_np.sqrt((b**2*var_a + a**2*var_b - 2*a*b*cov_ab))/amplitude**2)
+    return amplitude, amplitude_std, _np.rad2deg(_np.arctan2(b,a)), phase_std
+
+def harmonic_analysis(time,values,groups=_groups,catalogue=None):
+    '''Fits wave groups to k series given as values (n, k) on time (n,) J2000 seconds, NaN where no data.
+    Series with identical NaN masks share one solution. Returns amplitude, amplitude std, Greenwich phase lag and its std (deg),
+    each (n_groups, k) in units of values. Model is value = amplitude*f*cos(V + u - phase)'''
+    time = _np.asarray(time,dtype=_np.float64)
+    values = _np.asarray(values,dtype=_np.float64)
+    A = design_matrix(time,groups,catalogue)
+    valid = ~_np.isnan(values)
+    masks, inverse = _np.unique(valid.T,axis=0,return_inverse=True)
+    inverse = inverse.ravel()
+
+    n_groups, k = groups.shape[0], values.shape[1]
+    a, b, var_a, var_b, cov_ab = [_np.full((n_groups,k),_np.nan) for _ in range(5)]
+    for mask_id in range(masks.shape[0]):
+        columns = _np.flatnonzero(inverse == mask_id)
+        rows = masks[mask_id]
+        coeff, cov, sigma2 = _solve(A[rows],values[rows][:,columns])
+        a[:,columns], b[:,columns] = coeff[2::2], coeff[3::2]
+        var_a[:,columns] = _np.diag(cov)[2::2][:,_np.newaxis]*sigma2
+        var_b[:,columns] = _np.diag(cov)[3::2][:,_np.newaxis]*sigma2
+        cov_ab[:,columns] = _np.diag(cov,k=1)[2::2][:,_np.newaxis]*sigma2
+    return _amplitude_phase(a,b,var_a,var_b,cov_ab)
+
+def _segment_normals(A,values,segment_id,n_segments):
+    '''Normal equation contributions of each segment for every series: N (s, k, m, m), b (s, k, m), y'y (s, k) and counts (s, k).
+    Missing values (NaN) have zero weight. time and so segment_id are sorted'''
+    valid = ~_np.isnan(values)
+    Y = _np.where(valid,values,0)
+    n_series, m = values.shape[1], A.shape[1]
+    N, b = _np.zeros((n_segments,n_series,m,m)), _np.zeros((n_segments,n_series,m))
+    yy, counts = _np.zeros((n_segments,n_series)), _np.zeros((n_segments,n_series))
+    bounds = _np.searchsorted(segment_id,_np.arange(n_segments + 1))
+    for segment in range(n_segments):
+        rows = slice(bounds[segment],bounds[segment + 1])
+        N[segment] = _np.einsum('ni,nk,nj->kij',A[rows],valid[rows].astype(_np.float64),A[rows],optimize=True)
+        b[segment] = Y[rows].T.dot(A[rows])
+        yy[segment], counts[segment] = (Y[rows]**2).sum(axis=0), valid[rows].sum(axis=0)
+    return N, b, yy, counts
+
+#order in which groups are kept when a window cannot separate them (larger waves first)
+_rayleigh_priority = ['M2','K1','O1','S2','N2','P1','K2','Q1','MF','MM','SSA','SA','L2','J1','OO1','S1','M4']
+
+def group_frequencies(groups=_groups):
+    '''Main wave frequencies (cpd) of wave groups from daily rates of t_s, s, h and p'''
+    return groups[['t_s','s','h','p']].values.dot([360,13.17639648,0.98564735,0.11140353])/360
+
+def resolvable_groups(span,groups=_groups):
+    '''Groups that a series of span seconds separates by Rayleigh criterion (span >= 1/frequency difference) from each other and from
+    offset (zero frequency). Groups are taken in _rayleigh_priority order, a group too close to an already kept one is dropped'''
+    frequencies = dict(zip(groups.index,group_frequencies(groups)))
+    kept, kept_frequencies = [], [0.0]
+    for wave in [wave for wave in _rayleigh_priority if wave in frequencies] + [wave for wave in groups.index if wave not in _rayleigh_priority]:
+        if _np.all(_np.abs(frequencies[wave] - _np.asarray(kept_frequencies))*span/86400 >= 1):
+            kept.append(wave); kept_frequencies.append(frequencies[wave])
+    return [wave for wave in groups.index if wave in kept]
+
+def windowed_analysis(time,values,window,step,groups=_groups,catalogue=None,min_coverage=0.5):
+    '''Sliding window harmonic analysis of k series (values (n, k) on sorted time (n,) J2000 seconds, NaN where no data).
+    Series are cut into segments of step seconds on a grid fixed to 0h UT of J2000 day (so windows of separately analysed series align);
+    normal equations are accumulated once per segment
+    and each window (window seconds, whole number of steps) is solved from the sum of its segments. Windows with too few data are NaN.
+    Only groups that the window separates by Rayleigh criterion are estimated (see resolvable_groups), the others are NaN. Windows with
+    less than min_coverage of the samples the window holds (e.g. partial last window) are NaN as the criterion does not hold for them.
+    Returns window begins (J2000 seconds) and amplitude, amplitude std, phase, phase std, each (n_windows, n_groups, k)'''
+    per_window = window/step
+    if (per_window < 1) or (abs(per_window - round(per_window)) > 1e-9):
+        raise ValueError('Window of {} s is not a whole number of steps of {} s'.format(window,step))
+    per_window = int(round(per_window))
+    resolved = resolvable_groups(window,groups)
+    if len(resolved) < groups.shape[0]:
+        print('Window of {:g} days does not separate {}. These groups are not estimated'.format(window/86400,
+              ', '.join(wave for wave in groups.index if wave not in resolved)))
+    all_groups, groups = groups, groups.loc[resolved]
+
+    time = _np.asarray(time,dtype=_np.float64)
+    values = _np.asarray(values,dtype=_np.float64)
+    A = design_matrix(time,groups,catalogue)
+    m = A.shape[1]
+
+    t0 = ((time[0] + 43200)//step)*step - 43200 #J2000 origin is at 12h
+    segment_id = ((time - t0)//step).astype(_np.int64)
+    n_segments = int(segment_id[-1]) + 1
+    n_windows = n_segments - per_window + 1
+    if n_windows < 1: raise ValueError('Window of {} s is longer than the series'.format(window))
+
+    def _window_sums(x): #sum of per_window consecutive segments for every window
+        cumulative = _np.concatenate([_np.zeros_like(x[:1]),_np.cumsum(x,axis=0)])
+        return cumulative[per_window:] - cumulative[:-per_window]
+    N, b, yy, counts = [_window_sums(x) for x in _segment_normals(A,values,segment_id,n_segments)]
+
+    N_inv = _np.linalg.pinv(N)
+    x = _np.einsum('wkij,wkj->wki',N_inv,b)
+    with _np.errstate(invalid='ignore',divide='ignore'):
+        sigma2 = (yy - (x*b).sum(axis=-1))/(counts - m)
+    sampling = _np.median(_np.diff(time)) if time.shape[0] > 1 else window
+    too_few = (counts <= m) | (counts < min_coverage*window/sampling)
+    x[too_few], sigma2[too_few] = _np.nan, _np.nan
+
+    cos_idx = _np.arange(2,m,2)
+    variance = _np.diagonal(N_inv,axis1=-2,axis2=-1)*sigma2[...,_np.newaxis]
+    cov_ab = N_inv[...,cos_idx,cos_idx + 1]*sigma2[...,_np.newaxis]
+    to_cube = lambda array: array.transpose(0,2,1) #(windows, series, groups) -> (windows, groups, series)
+    results = _amplitude_phase(to_cube(x[...,cos_idx]),to_cube(x[...,cos_idx + 1]),
+                               to_cube(variance[...,cos_idx]),to_cube(variance[...,cos_idx + 1]),to_cube(cov_ab))
+    positions = all_groups.index.get_indexer(resolved)
+    cubes = []
+    for result in results: #unresolved groups are NaN
+        cube = _np.full((n_windows,all_groups.shape[0],values.shape[1]),_np.nan)
+        cube[:,positions] = result
+        cubes.append(cube)
+    return (t0 + _np.arange(n_windows)*step,) + tuple(cubes)
+
+def _blq_cube(amplitude,amplitude_std,phase,phase_std,components,windows,groups=_groups):
+    '''blq-like tables of extract_et (amplitude in m from mm input, phases in deg within +-180) of a single station stacked over windows.
+    Inputs are (n_windows, n_groups, n_components). Phases of east and north are reported for west and south as extract_et does'''
+    positions = groups.index.get_indexer(blq_waves)
+    present = positions >= 0
+    phase = phase[:,positions[present]] + _np.where(_np.isin(components,['east','north']),180,0)
+    fields = [(amplitude[:,positions[present]]/1000).round(5),(amplitude_std[:,positions[present]]/1000).round(5),
+              _np.where(phase > 180,phase - 360,phase),phase_std[:,positions[present]]]
+    cube = _np.full((len(windows),len(blq_waves),len(components),4),_np.nan)
+    cube[:,present] = _np.stack(fields,axis=-1)
+    return _pd.DataFrame(cube.reshape(len(windows)*len(blq_waves),-1),
+                        index = _pd.MultiIndex.from_product([windows,blq_waves]),
+                        columns = _pd.MultiIndex.from_product([components,['amplitude','phase'],['value','std']]))
+
+def _blq_table(amplitude,amplitude_std,phase,phase_std,components,groups=_groups):
+    '''blq-like table of extract_et for a single station. Inputs are (n_groups, n_components)'''
+    return _blq_cube(amplitude[_np.newaxis],amplitude_std[_np.newaxis],phase[_np.newaxis],phase_std[_np.newaxis],
+                     components,[0],groups).droplevel(0)
+
+def _union_series(stations_et):
+    '''Union time grid of [station_name, env_et, parameter_name] records, values (n, total components) and components per station'''
+    time = _np.unique(_np.concatenate([env_et.index.values.astype(_np.float64) for _,env_et,_ in stations_et]))
+    values, components = [], []
+    for station_name,env_et,parameter_name in stations_et:
+        values.append(env_et.reindex(time).values.astype(_np.float64))
+        components.append(['east','north','up'] if env_et.shape[-1] == 3 else parameter_name)
+    return time, _np.hstack(values), components
+
+def _station_slices(components):
+    bounds = _np.cumsum([0] + [len(station_components) for station_components in components])
+    return [slice(begin,end) for begin,end in zip(bounds[:-1],bounds[1:])]
+
+def analyse_native(stations_et,groups=_groups,catalogue=None):
+    '''Native analysis of [station_name, env_et, parameter_name] records (as prepared for ETERNA). All stations and components
+    are solved together on the union time grid. Returns blq-like table with the same layout as ETERNA based analyze_env'''
+    time, values, components = _union_series(stations_et)
+    amplitude, amplitude_std, phase, phase_std = harmonic_analysis(time,values,groups,catalogue)
+    tables = [_blq_table(amplitude[:,columns],amplitude_std[:,columns],phase[:,columns],phase_std[:,columns],station_components,groups)
+              for columns,station_components in zip(_station_slices(components),components)]
+    return _pd.concat(tables,keys=[station_et[0] for station_et in stations_et])
+
+def analyse_native_windows(stations_et,window_days=365,step_days=30,groups=_groups,catalogue=None):
+    '''Sliding window native analysis of [station_name, env_et, parameter_name] records. Series are prepared once and every
+    window is solved from per-segment normal equations (see windowed_analysis). Returns station x window x constituent cube as
+    blq-like table indexed by (station, window begin, wave)'''
+    time, values, components = _union_series(stations_et)
+    window_begin, amplitude, amplitude_std, phase, phase_std = windowed_analysis(time,values,window=window_days*86400,step=step_days*86400,groups=groups,catalogue=catalogue)
+    windows = window_begin.astype('timedelta64[s]') + J2000origin
+    tables = [_blq_cube(amplitude[...,columns],amplitude_std[...,columns],phase[...,columns],phase_std[...,columns],station_components,windows,groups)
+              for columns,station_components in zip(_station_slices(components),components)]
+    return _pd.concat(tables,keys=[station_et[0] for station_et in stations_et])
+
+def benchmark_engines(sets,num_cores=None):
+    '''Runs analyze_env sets (analyze_env(..., return_sets=True)) with ETERNA and native engines.
+    Prints timings and returns (native, eterna, difference) blq-like tables. ETERNA runs are forced so timing is not from cache'''
+    from .gx_eterna import analyze_env_sets as _analyze_env_sets
+    num_cores = len(sets) if num_cores is None else num_cores
+    sets = [list(values_set) for values_set in sets]
+    for values_set in sets: values_set[10] = True #force
+
+    begin = _time.time()
+    eterna = _analyze_env_sets(sets,num_cores=num_cores,engine='eterna')
+    eterna_time = _time.time() - begin
+    begin = _time.time()
+    native = _analyze_env_sets(sets,num_cores=num_cores,engine='native')
+    native_time = _time.time() - begin
+
+    difference = native.astype(float) - eterna.astype(float)
+    phase_diff = difference.loc(axis=1)[:,'phase','value']
+    difference.loc(axis=1)[:,'phase','value'] = (phase_diff + 180) % 360 - 180
+    print('ETERNA: {:.1f} s, native: {:.1f} s ({:.1f}x)'.format(eterna_time,native_time,eterna_time/native_time))
+    print('Median abs difference. Amplitude: {:.5f} m, phase: {:.2f} deg'.format(
+        _np.nanmedian(_np.abs(difference.loc(axis=1)[:,'amplitude','value'].values)),
+        _np.nanmedian(_np.abs(difference.loc(axis=1)[:,'phase','value'].values))))
+    return native, eterna, difference
@@ -4,14 +4,12 @@ import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import numpy as _np
 import pandas as _pd
-#PARZEN window function
-from scipy import signal
 
 import GipsyX_Wrapper.trees_options as trees_options
-from GipsyX_Wrapper.gd2e_wrap import (gd2e_class, gx_aux, gx_convert, gx_eterna, gx_ionex,
+from GipsyX_Wrapper.gd2e_wrap import (gd2e_class, gx_aux, gx_convert, gx_ionex,
                        gx_merge, gx_tdps, gx_trees)
-from GipsyX_Wrapper.gxlib import gx_hardisp
-from GipsyX_Wrapper.gxlib.gx_aux import _update_mindex, check_date_margins, date2yyyydoy
+from GipsyX_Wrapper.gxlib import gx_products, gx_spectra
+from GipsyX_Wrapper.gxlib.gx_aux import check_date_margins, date2yyyydoy
 from shutil import rmtree as _rmtree, copy as _copy
 
 class mGNSS_class:
@@ -86,7 +84,7 @@ class mGNSS_class:
                                                             self.pos_s, self.wetz_s,
                                                             self.tropNom_input, self.ElMin, ambres = self.ambres,tree_options=self.tree_options) #static projects are marked as project_name_[mode]_static
         self.static_clk = static_clk
-        self.staDb_path = gx_aux.gen_staDb(self.tmp_dir,self.project_name,self.stations_list,self.IGS_logs_dir) if staDb_path is None else staDb_path #single staDb path for all modes.
+        self.staDb_path = gx_aux.gen_staDb(self.tmp_dir,self.project_name,self.stations_list,self.IGS_logs_dir,num_cores=self.num_cores) if staDb_path is None else staDb_path #single staDb path for all modes.
         #Need to be able to fetch external StaDb for pbs
 
         self.cache_path = self.prep_cache_path(cache_path)
@@ -202,7 +200,7 @@ class mGNSS_class:
         gx_aux.get_drInfo(num_cores=self.num_cores,tmp_dir=self.tmp_dir,tqdm=self.tqdm,selected_rnx = self.select_rnx())
 
     def gather_drInfo(self):
-        '''Should be run with single node'''
+        '''Summary of drInfo partitions. Safe to run on any number of nodes'''
         gx_aux.gather_drInfo(num_cores=self.num_cores,tmp_dir=self.tmp_dir,tqdm=self.tqdm)
         
     def _merge_table(self,mode):
@@ -233,6 +231,15 @@ class mGNSS_class:
         common_index = self._get_common_index(gps,glo,gps_glo)
         return gps.loc[common_index].copy(),glo.loc[common_index].copy(),gps_glo.loc[common_index].copy()
 
+    def gather_mGNSS_paths(self,stations_list=None,sigma_cut=0.05):
+        '''Paths of mGNSS env gathers. Missing gathers are created station by station so only one is held in memory'''
+        gather_path =  _os.path.join(self.tmp_dir,'gd2e','env_gathers',self.project_name)
+        if stations_list is None: stations_list = self.stations_list
+        paths = ['{}/{}.zstd'.format(gather_path,station.lower()) for station in stations_list]
+        for station,path in zip(stations_list,paths):
+            if not _os.path.exists(path): self.gather_mGNSS(stations_list=[station],sigma_cut=sigma_cut)
+        return paths
+
     def gather_mGNSS(self,force=False,stations_list=None,sigma_cut=0.05):
         '''get envs. For each station do common index, create unique levels and concat'''
         gather_path =  _os.path.join(self.tmp_dir,'gd2e','env_gathers',self.project_name)
@@ -253,9 +260,9 @@ class mGNSS_class:
             if force:
                 if _os.path.exists(filename): _os.remove(filename)
             if not _os.path.exists(filename):
-                gps_envs = self.gps.envs(force=force,sigma_cut=sigma_cut)
-                glo_envs = self.glo.envs(force=force,sigma_cut=sigma_cut)
-                gps_glo_envs = self.gps_glo.envs(force=force,sigma_cut=sigma_cut)
+                gps_envs = self.gps.envs(force=force,sigma_cut=sigma_cut,stations_list=stations_list)
+                glo_envs = self.glo.envs(force=force,sigma_cut=sigma_cut,stations_list=stations_list)
+                gps_glo_envs = self.gps_glo.envs(force=force,sigma_cut=sigma_cut,stations_list=stations_list)
                 break
             else:
                 gather.append(gx_aux._dump_read(filename))
@@ -311,13 +318,16 @@ class mGNSS_class:
     def gather_residuals_mGNSS(self):
         return self.gps.residuals(),self.glo.residuals(),self.gps_glo.residuals()
     
-    def analyze(self,gps_only,restore_otl = True,remove_outliers=True,sampling=1800,force=False,begin=None,end=None):
+    def analyze(self,gps_only,restore_otl = True,remove_outliers=True,sampling=1800,force=False,begin=None,end=None,engine='eterna',otl_backend='hardisp'):
+        '''engine is native (in-process harmonic analysis) or eterna. otl_backend of synthetic OTL is hardisp or native'''
         begin_date, end_date = check_date_margins(begin=begin, end=end, years_list=self.years_list)
         eterna_gathers_dir =  _os.path.join(self.tmp_dir,'gd2e','eterna_gathers')
 
         if gps_only:
             suffix = 'gps.zstd' if restore_otl else 'nootl_gps.zstd'
         else: suffix = '.zstd' if restore_otl else 'nootl.zstd'
+        if engine != 'eterna': suffix = '{}_{}'.format(engine,suffix) #eterna gathers keep former names
+        if otl_backend != 'hardisp': suffix = '{}otl_{}'.format(otl_backend,suffix)
 
         if not _os.path.exists(eterna_gathers_dir): _os.makedirs(eterna_gathers_dir)
         filename = '{}_{}_{}_{}'.format(self.project_name, date2yyyydoy(begin_date), date2yyyydoy(end_date), suffix)
@@ -330,25 +340,17 @@ class mGNSS_class:
             if gps_only:
                 '''If force == True -> reruns Eterna even if Eterna files exist.
                 no gather is needed for the case of single gps constellation. Chunking is done within gd2e_wrap'''
-                tmp_synth = self.gps.analyze_env(force=force,mode = 'GPS',otl_env=True, begin = begin_date, end = end_date)
-                tmp_gps = self.gps.analyze_env(force=force,mode = 'GPS',restore_otl=restore_otl, begin = begin_date, end = end_date)
+                tmp_synth = self.gps.analyze_env(force=force,mode = 'GPS',otl_env=True, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)
+                tmp_gps = self.gps.analyze_env(force=force,mode = 'GPS',restore_otl=restore_otl, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)
                 tmp_blq_concat = _pd.concat([tmp_synth,tmp_gps],keys=['OTL','GPS'],axis=1)
             else:
-                '''here we need to specify the syncronized gather. So break envs into chunks here'''
-                stations_sublists = gx_aux.split10(array=self.stations_list,split_arrays_size=self.num_cores)
-                buf=[]
-                for stations_sublist in stations_sublists:
-                    print('Chunking the stations_list. Processing',stations_sublist)
-                    envs = self.gather_mGNSS(force=False,stations_list=stations_sublist)
-                    #if envs gets filtered on mode on this stage - some memory can be saved
-                    tmp_synth = self.gps.analyze_env(envs=envs,force=force,mode = 'GPS',otl_env=True, begin = begin_date, end = end_date)              
-                    tmp_gps = self.gps.analyze_env(envs=envs,force=force,mode = 'GPS',restore_otl=restore_otl, begin = begin_date, end = end_date)
-                    tmp_glo = self.glo.analyze_env(envs=envs,force=force,mode='GLONASS',restore_otl=restore_otl, begin = begin_date, end = end_date)
-                    tmp_gps_glo = self.gps_glo.analyze_env(envs=envs,force=force,mode='GPS+GLONASS',restore_otl=restore_otl, begin = begin_date, end = end_date)
-                    tmp_blq_concat_partial = _pd.concat([tmp_synth,tmp_gps,tmp_glo,tmp_gps_glo],keys=['OTL','GPS','GLONASS','GPS+GLONASS'],axis=1)
-                    buf.append(tmp_blq_concat_partial)
-                # return buf
-                tmp_blq_concat = _pd.concat(buf,axis=0) #concatanating the partials vertically
+                '''syncronized gathers are streamed from disk: every worker loads its own station'''
+                envs = self.gather_mGNSS_paths()
+                tmp_synth = self.gps.analyze_env(envs=envs,force=force,mode = 'GPS',otl_env=True, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)              
+                tmp_gps = self.gps.analyze_env(envs=envs,force=force,mode = 'GPS',restore_otl=restore_otl, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)
+                tmp_glo = self.glo.analyze_env(envs=envs,force=force,mode='GLONASS',restore_otl=restore_otl, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)
+                tmp_gps_glo = self.gps_glo.analyze_env(envs=envs,force=force,mode='GPS+GLONASS',restore_otl=restore_otl, begin = begin_date, end = end_date, engine = engine, otl_backend = otl_backend)
+                tmp_blq_concat = _pd.concat([tmp_synth,tmp_gps,tmp_glo,tmp_gps_glo],keys=['OTL','GPS','GLONASS','GPS+GLONASS'],axis=1)
             gx_aux._dump_write(data = tmp_blq_concat,filename=gather_path,num_cores=2,cname='zstd') # dumping to disk mGNSS eterna gather
                 
         else:
@@ -424,46 +426,20 @@ class mGNSS_class:
             tmp_blq_concat = gx_aux._dump_read(gather_path)          
         return tmp_blq_concat
 
-    def spectra(self,restore_otl = True,remove_outliers=True,sampling=1800):
-        gather = self.gather_mGNSS()
-        tmp=[]
-        if not restore_otl:
-            for i in range(len(gather)): #looping through stations
-                gps_et = gx_eterna.env2eterna(gather[i]['GPS'],remove_outliers)
-                glo_et = gx_eterna.env2eterna(gather[i]['GLONASS'],remove_outliers)
-                gps_glo_et = gx_eterna.env2eterna(gather[i]['GPS+GLONASS'],remove_outliers)
-                
-                tmp_gps = get_spectra(gps_et)
-                tmp_glo = get_spectra(glo_et)                    
-                tmp_gps_glo = get_spectra(gps_glo_et)
-
-                tmp_mGNSS = _pd.concat([_update_mindex(tmp_gps,'GPS'),_update_mindex(tmp_glo,'GLONASS'),_update_mindex(tmp_gps_glo,'GPS+GLONASS')],axis=1)
-                tmp.append(tmp_mGNSS)
-                
-        else:
-            
-            for i in range(len(gather)): #looping through stations
-                gps_et = gx_eterna.env2eterna(gather[i]['GPS'],remove_outliers)
-                glo_et = gx_eterna.env2eterna(gather[i]['GLONASS'],remove_outliers)
-                gps_glo_et = gx_eterna.env2eterna(gather[i]['GPS+GLONASS'],remove_outliers)
-                #timeframe is the same so we can take any of three. gps_et in this case
-                synth_otl = gx_hardisp.gen_synth_otl(dataset = gps_et,station_name = self.stations_list[i],hardisp_path=self.hardisp_path,blq_file=self.blq_file,sampling=sampling)
-                
-                gps_et+=synth_otl
-                glo_et+=synth_otl
-                gps_glo_et+=synth_otl
-                
-
-                tmp_gps = get_spectra(gps_et)
-                tmp_glo = get_spectra(glo_et)                    
-                tmp_gps_glo = get_spectra(gps_glo_et)
-
-                tmp_mGNSS = _pd.concat([_update_mindex(tmp_gps,'GPS'),_update_mindex(tmp_glo,'GLONASS'),_update_mindex(tmp_gps_glo,'GPS+GLONASS')],axis=1)
-                tmp.append(tmp_mGNSS)
-                
-        return tmp
+    def spectra(self,restore_otl = True,remove_outliers=True,sampling=1800,backend='hardisp',window_size=14016,force=False):
+        '''Welch PSD tables of all stations (GPS, GLONASS and GPS+GLONASS columns). Stations run in parallel and tables are persisted
+        to tmp_dir/gd2e/spectra/project_name. backend of synthetic OTL restoration: hardisp or native (uses eterna_path catalogue)'''
+        return gx_spectra.spectra(gathers=self.gather_mGNSS_paths(),stations_list=self.stations_list,num_cores=self.num_cores,
+                                  blq_file=self.blq_file,hardisp_path=self.hardisp_path,eterna_path=self.eterna_path,restore_otl=restore_otl,remove_outliers=remove_outliers,
+                                  sampling=sampling,backend=backend,window_size=window_size,force=force,
+                                  cache_dir=_os.path.join(self.tmp_dir,'gd2e',gx_spectra._spectra_cache_lbl,self.project_name))
     
     
+    def ce2cm(self,init_ce_path=None):
+        '''Converts CE products (gnss_products_dir by default) to CM products tree using project cache_path. Only new or changed pos files are converted'''
+        gx_products.ce2cm(init_ce_path=self.gnss_products_dir if init_ce_path is None else init_ce_path,
+                          num_cores=self.num_cores,tqdm=self.tqdm,cache_path=self.cache_path)
+
     def gd2e(self):
         for project in [self.gps,self.glo,self.gps_glo]:
             project.gd2e()
@@ -474,28 +450,11 @@ class mGNSS_class:
 
 
 def gen_parzen(samples,fraction):
-    window = _np.ones(samples)
-    samples_fraction = round(samples*fraction)
-
-    parzen_window =  signal.parzen(samples_fraction,)
-
-    parzen_window_left = parzen_window[:round(parzen_window.shape[0]/2)]
-    parzen_window_right = parzen_window[round(parzen_window.shape[0]/2):]
-
-    window[:parzen_window_left.shape[0]] = parzen_window_left
-    window[-parzen_window_right.shape[0]:] = parzen_window_right
-#     return parzen_window_left.shape,parzen_window_right.shape
-    return window
+    return gx_spectra.gen_parzen(samples,fraction)
 
 def get_spectra(data,window_size = 14016):
-    data.fillna(0,inplace=True)
-    constellation_spectra = []
-    for component in data:
-        comp_spectrum = _np.asarray(signal.welch(data[component].values,fs=48,return_onesided=True,window=gen_parzen(window_size,0.1)))
-        tmp_df = _pd.DataFrame(data = comp_spectrum[1],index = comp_spectrum[0], columns = [component])
-        constellation_spectra.append(tmp_df)
-    constellation_spectra_df = _pd.concat(constellation_spectra,axis=1)
-    return constellation_spectra_df
+    '''Gap-aware Welch PSD of data columns. data is not modified'''
+    return gx_spectra.psd_df(data,window_size=window_size)
 
 
 
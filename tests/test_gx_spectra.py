@@ -0,0 +1,70 @@
+'''Gap handling of gx_spectra.welch_psd. Needs the package importable as GipsyX_Wrapper with its dependencies (gx_aux)'''
+import numpy as np
+import pytest
+from scipy import signal
+
+gx_spectra = pytest.importorskip('GipsyX_Wrapper.gxlib.gx_spectra')
+
+FS = 48 #samples per day (1800 s)
+WINDOW = 14016
+
+def _gappy_series(seed=0):
+    '''Two years of white noise (std 2) plus M2 of 3 amplitude with gaps of a GNSS station: daily file losses every few weeks,
+    a 10-day receiver outage and outlier removal holes, so no gap-free run reaches WINDOW samples'''
+    rng = np.random.default_rng(seed)
+    n = 2*365*FS
+    t = np.arange(n)/FS
+    values = rng.normal(0,2,n) + 3*np.cos(2*np.pi*1.932274*t)
+    for day in np.cumsum(rng.integers(20,60,40)): #lost daily files
+        values[day*FS:(day + 1)*FS] = np.nan
+    values[300*FS:310*FS] = np.nan #receiver outage
+    values[rng.choice(n,200,replace=False)] = np.nan #removed outliers
+    return values
+
+def _longest_run(values):
+    runs = np.diff(np.flatnonzero(np.diff(np.concatenate([[1],np.isnan(values).astype(int),[1]]))))
+    return runs[::2].max()
+
+def test_no_gaps_equals_scipy_welch():
+    values = np.random.default_rng(1).normal(0,1,(3*WINDOW,2))
+    freq, psd = gx_spectra.welch_psd(values,window_size=WINDOW,fs=FS)
+    ref_freq, ref_psd = signal.welch(values,fs=FS,window=gx_spectra.gen_parzen(WINDOW,0.1),nperseg=WINDOW,axis=0)
+    assert np.allclose(freq,ref_freq)
+    assert np.allclose(psd,ref_psd)
+
+def test_gappy_series_falls_back_to_lombscargle():
+    values = _gappy_series()
+    assert _longest_run(values) < WINDOW
+    freq, psd = gx_spectra.welch_psd(values[:,np.newaxis],window_size=WINDOW,fs=FS)
+    assert not np.isnan(psd[1:-1]).any() #DC and Nyquist are not estimated
+    noise = (freq > 3) & (freq < 20)
+    assert psd[noise,0].mean() == pytest.approx(2*2**2/FS,rel=0.05) #one-sided white noise level as of Welch
+    assert abs(freq[np.nanargmax(psd[:,0])] - 1.932274) < 0.01
+
+def test_full_segments_are_kept_where_they_fit():
+    values = _gappy_series()
+    full = np.random.default_rng(2).normal(0,2,values.shape[0])
+    freq, psd = gx_spectra.welch_psd(np.column_stack([values,full]),window_size=WINDOW,fs=FS)
+    _, ref_psd = gx_spectra.welch_psd(full[:,np.newaxis],window_size=WINDOW,fs=FS)
+    assert np.allclose(psd[:,1],ref_psd[:,0])
+    assert not np.isnan(psd[1:-1,0]).any()
+
+def test_no_usable_segment_is_nan():
+    values = _gappy_series()
+    values[np.random.default_rng(3).random(values.shape[0]) < 0.6] = np.nan #less than min_coverage in every segment
+    freq, psd = gx_spectra.welch_psd(values[:,np.newaxis],window_size=WINDOW,fs=FS)
+    assert np.isnan(psd).all()
+
+def test_clean_stretch_in_gappy_series_uses_lombscargle():
+    '''One clean 300-day stretch must not make Welch throw away the remaining years of gappy data'''
+    rng = np.random.default_rng(4)
+    n = 10*365*FS
+    values = rng.normal(0,2,n)
+    values[rng.random(n) < 0.02] = np.nan #scattered holes
+    values[1000*FS:1300*FS] = rng.normal(0,2,300*FS)
+    assert _longest_run(values) >= WINDOW
+    freq, psd = gx_spectra.welch_psd(values[:,np.newaxis],window_size=WINDOW,fs=FS)
+    ref = gx_spectra._lombscargle_psd(values[:,np.newaxis],WINDOW,FS,0.5)
+    assert np.allclose(psd,ref,equal_nan=True)
+    noise = (freq > 3) & (freq < 20)
+    assert psd[noise,0].std()/psd[noise,0].mean() < 0.5